@@ -17,6 +17,7 @@ from decouple import config
 from decouple import Csv
 import os
 import raven
+import tempfile
 
 from django.contrib.messages import constants as messages
 from django.utils.safestring import mark_safe
@@ -100,6 +101,25 @@ else:
         }
     }
 
+# Cache
+# Search indexes publish version counters through the cache, so it must
+# be shared by all worker processes. The default is a file-based cache
+# in the temporary directory. A per-process memory cache
+# (django.core.cache.backends.locmem.LocMemCache) is only suitable for
+# a single process and triggers a warning outside of debug mode.
+CACHES = {
+    "default": {
+        "BACKEND": config(
+            "CACHE_BACKEND",
+            default="django.core.cache.backends.filebased.FileBasedCache",
+        ),
+        "LOCATION": config(
+            "CACHE_LOCATION",
+            default=os.path.join(tempfile.gettempdir(), "matd3_cache"),
+        ),
+    }
+}
+
 # Password validation
 
 AUTH_PASSWORD_VALIDATORS = [
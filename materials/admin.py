@@ -7,6 +7,7 @@ from django.urls import reverse
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 
+from . import derived
 from . import models
 from mainproject.settings import MATD3_NAME
 
@@ -322,6 +323,10 @@ class SubsetInline(BaseMixin, nested_admin.NestedStackedInline):
     fields = [f.name for f in models.Subset._meta.local_fields]
     inlines = [NumericalValueFixedInline]
 
+    def get_queryset(self, request):
+        # The inline headers show the number of data points
+        return super().get_queryset(request).with_num_datapoints()
+
 
 class FilesInline(BaseMixin, nested_admin.NestedStackedInline):
     model = models.AdditionalFile
@@ -359,6 +364,15 @@ class DatasetAdmin(BaseAdmin):
     )
     filter_horizontal = ["linked_to"]
 
+    def save_related(self, request, form, formsets, change):
+        """Additionally update the summary after all inlines are saved.
+
+        Deleting fixed values has no receiver that would do this.
+
+        """
+        super().save_related(request, form, formsets, change)
+        derived.update_summaries([form.instance.pk])
+
     def view_on_site(self, obj):
         return reverse("materials:dataset", kwargs={"pk": obj.pk})
 
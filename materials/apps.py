@@ -1,5 +1,27 @@
 # This file is covered by the BSD license. See LICENSE in the root directory.
 from django.apps import AppConfig
+from django.conf import settings
+from django.core import checks
+
+
+def check_shared_cache(app_configs, **kwargs):
+    """Warn if the cache is not shared between worker processes.
+
+    The search indexes learn about changes made by other workers
+    through version counters in the cache.
+
+    """
+    backend = settings.CACHES['default']['BACKEND']
+    if settings.DEBUG or not backend.endswith('LocMemCache'):
+        return []
+    return [checks.Warning(
+        'The default cache is local to each process.',
+        hint=('With more than one worker process, search indexes will not '
+              'see changes made by other workers. Set CACHE_BACKEND to a '
+              'shared cache such as '
+              'django.core.cache.backends.filebased.FileBasedCache.'),
+        id='materials.W001',
+    )]
 
 
 class MaterialsConfig(AppConfig):
@@ -18,3 +40,4 @@ class MaterialsConfig(AppConfig):
         except Exception:
             pass
         from materials import signals  # noqa
+        checks.register(check_shared_cache, checks.Tags.caches)
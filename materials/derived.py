@@ -0,0 +1,351 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Rebuilding and checking derived data such as indexes and packed values.
+
+Each kind of derived data has a rebuild function, which replaces the
+derived rows of the given data sets (or of their systems), and a
+verify function, which yields a description of each difference
+between the derived rows and what rebuild would write. Both take a
+list of data set pks. See the rebuild_derived command.
+
+"""
+import os
+
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+import numpy
+
+from . import models
+from . import packing
+from . import search
+from mainproject import settings
+
+
+def subsets_of(dataset_pks):
+    return list(
+        models.Subset.objects.filter(dataset__in=dataset_pks)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+
+
+def rebuild_packed(dataset_pks):
+    packing.pack_subsets(subsets_of(dataset_pks))
+
+
+def verify_packed(dataset_pks):
+    subsets = subsets_of(dataset_pks)
+    values = packing.values_by_subset(subsets)
+    packed = packing.packed_arrays(subsets)
+    for pk in subsets:
+        subset_values = values.get(pk, [])
+        if not packing.is_packable(subset_values):
+            if pk in packed:
+                yield f"Subset {pk} is packed but its values cannot be"
+        elif pk not in packed:
+            yield f"Subset {pk} is not packed"
+        else:
+            expected = packing.value_arrays(subset_values)
+            if expected.keys() != packed[pk].keys() or not all(
+                numpy.array_equal(x, packed[pk][name], equal_nan=True)
+                for name, x in expected.items()
+            ):
+                yield f"Packed values of subset {pk} differ from the rows"
+
+
+def lattice_subsets_of(dataset_pks):
+    return models.Subset.objects.filter(
+        dataset__in=dataset_pks, dataset__primary_property__name="atomic structure"
+    )
+
+
+def rebuild_lattices(dataset_pks):
+    search.update_lattices(list(lattice_subsets_of(dataset_pks)))
+
+
+def verify_lattices(dataset_pks):
+    subsets = lattice_subsets_of(dataset_pks)
+    expected = {x.subset_id: x for x in search.lattices(subsets)}
+    stored = {
+        x.subset_id: x
+        for x in models.SubsetLattice.objects.filter(subset__in=subsets)
+    }
+    for pk in sorted(expected.keys() | stored.keys()):
+        if pk not in stored:
+            yield f"Subset {pk} has no lattice row"
+        elif pk not in expected:
+            yield f"Subset {pk} has a lattice row but no lattice constants"
+        elif any(
+            getattr(expected[pk], name) != getattr(stored[pk], name)
+            for name in ("dataset_id",) + search.LATTICE_PARAMETERS
+        ):
+            yield f"Lattice row of subset {pk} differs from the rows"
+
+
+def datasets_of(dataset_pks):
+    return models.Dataset.objects.filter(pk__in=dataset_pks).select_related(
+        "primary_property"
+    )
+
+
+def rebuild_ranges(dataset_pks):
+    for dataset in datasets_of(dataset_pks):
+        search.update_value_ranges(dataset)
+
+
+def range_key(value_range):
+    return value_range.physical_property_id, value_range.qualifier
+
+
+def verify_ranges(dataset_pks):
+    stored = {}
+    for x in models.DatasetValueRange.objects.filter(dataset__in=dataset_pks):
+        stored.setdefault(x.dataset_id, {})[range_key(x)] = x
+    fields = ("minimum", "maximum", "representative", "count", "is_experimental")
+    for dataset in datasets_of(dataset_pks):
+        expected = {range_key(x): x for x in search.value_ranges(dataset)}
+        dataset_stored = stored.get(dataset.pk, {})
+        if expected.keys() != dataset_stored.keys() or any(
+            getattr(x, name) != getattr(dataset_stored[key], name)
+            for key, x in expected.items()
+            for name in fields
+        ):
+            yield f"Value ranges of data set {dataset.pk} differ from the rows"
+
+
+def systems_of(dataset_pks):
+    return models.System.objects.filter(dataset__in=dataset_pks).distinct()
+
+
+def lone_systems():
+    """Return the systems without data sets.
+
+    No chunk of data sets reaches these, so rebuild_derived processes
+    their documents separately.
+
+    """
+    return models.System.objects.filter(dataset=None)
+
+
+def rebuild_documents(dataset_pks):
+    search.update_search_documents(systems_of(dataset_pks))
+
+
+def verify_documents_of(systems):
+    expected = {x.system_id: x for x in search.search_documents(systems)}
+    stored = {
+        x.system_id: x
+        for x in models.SystemSearchDocument.objects.filter(system__in=list(expected))
+    }
+    for pk, document in expected.items():
+        if pk not in stored:
+            yield f"System {pk} has no search document"
+        elif any(
+            getattr(document, name) != getattr(stored[pk], name)
+            for name in ("formula", "group", "iupac", "compound_name", "tags")
+        ):
+            yield f"Search document of system {pk} differs from the system"
+
+
+def verify_documents(dataset_pks):
+    return verify_documents_of(systems_of(dataset_pks))
+
+
+def author_datasets_of(dataset_pks):
+    return models.Dataset.objects.filter(pk__in=dataset_pks).prefetch_related(
+        "reference__authors"
+    )
+
+
+def rebuild_authors(dataset_pks):
+    search.update_author_index(datasets=author_datasets_of(dataset_pks))
+
+
+def author_key(row):
+    return row.author_id, row.dataset_id, row.system_id, row.last_name, row.initials
+
+
+def verify_authors(dataset_pks):
+    expected = {}
+    for x in search.author_index(datasets=author_datasets_of(dataset_pks)):
+        expected.setdefault(x.dataset_id, set()).add(author_key(x))
+    stored = {}
+    for x in models.DatasetAuthorIndex.objects.filter(dataset__in=dataset_pks):
+        stored.setdefault(x.dataset_id, set()).add(author_key(x))
+    for pk in sorted(expected.keys() | stored.keys()):
+        if expected.get(pk) != stored.get(pk):
+            yield f"Author index of data set {pk} differs from the authors"
+
+
+def grouped_counts(queryset, field, dataset_pks):
+    return dict(
+        queryset.filter(**{f"{field}__in": dataset_pks})
+        .order_by()
+        .values_list(field)
+        .annotate(count=Count("pk"))
+    )
+
+
+def summaries(dataset_pks):
+    """Return the DatasetSummary rows of the given data sets unsaved.
+
+    Each fact is read for all data sets with one query.
+
+    """
+    num_subsets = grouped_counts(models.Subset.objects, "dataset", dataset_pks)
+    num_datapoints = grouped_counts(
+        models.Datapoint.objects, "subset__dataset", dataset_pks
+    )
+    geometry_files = {}
+    for dataset, name in (
+        models.AdditionalFile.objects.filter(
+            dataset__in=dataset_pks, dataset_file__endswith="geometry.in"
+        )
+        .exclude(dataset__primary_property__name="atomic structure")
+        .order_by("pk")
+        .values_list("dataset", "dataset_file")
+    ):
+        if os.path.basename(name) == "geometry.in":
+            geometry_files.setdefault(
+                dataset, os.path.join(settings.MEDIA_URL, name)
+            )
+    temperatures = {}
+    for value in (
+        models.NumericalValueFixed.objects.filter(
+            subset__dataset__in=dataset_pks, physical_property__name="temperature"
+        )
+        .annotate(dataset=F("subset__dataset"))
+        .select_related("unit")
+        .order_by("subset", "pk")
+    ):
+        temperatures.setdefault(value.dataset, []).append(
+            f"{value.formatted()} {value.unit}"
+        )
+    verified = set(
+        models.Dataset.verified_by.through.objects.filter(
+            dataset__in=dataset_pks
+        ).values_list("dataset", flat=True)
+    )
+    representatives = dict(
+        models.DatasetValueRange.objects.filter(
+            dataset__in=dataset_pks, qualifier=models.NumericalValue.PRIMARY
+        ).values_list("dataset", "representative")
+    )
+    return [
+        models.DatasetSummary(
+            dataset_id=pk,
+            num_subsets=num_subsets.get(pk, 0),
+            num_datapoints=num_datapoints.get(pk, 0),
+            geometry_file_location=geometry_files.get(pk, ""),
+            fixed_temperatures=(
+                "(T = " + ", ".join(temperatures[pk]) + ")"
+                if pk in temperatures
+                else ""
+            ),
+            verified=pk in verified,
+            representative_value=representatives.get(pk),
+        )
+        for pk in models.Dataset.objects.filter(pk__in=dataset_pks).values_list(
+            "pk", flat=True
+        )
+    ]
+
+
+def update_summaries(dataset_pks):
+    """Create or replace the summaries of the given data sets."""
+    rows = summaries(dataset_pks)
+    with transaction.atomic():
+        models.DatasetSummary.objects.filter(dataset__in=dataset_pks).delete()
+        models.DatasetSummary.objects.bulk_create(rows)
+
+
+def update_summaries_on_commit(dataset_pks):
+    """Drop the summaries of the given data sets and rebuild them on commit.
+
+    The data sets may be deleted later in the same transaction, e.g.,
+    when their subsets are deleted as part of a cascade, so the
+    summaries are only rebuilt once that is settled.
+
+    """
+    dataset_pks = list(dataset_pks)
+    models.DatasetSummary.objects.filter(dataset__in=dataset_pks).delete()
+    transaction.on_commit(lambda: update_summaries(dataset_pks))
+
+
+def update_ranges_on_commit(dataset_pks):
+    """Drop the value ranges of the given data sets and rebuild them on commit.
+
+    Same as update_summaries_on_commit for the range search index.
+
+    """
+    dataset_pks = list(dataset_pks)
+    models.DatasetValueRange.objects.filter(dataset__in=dataset_pks).delete()
+    transaction.on_commit(lambda: rebuild_ranges(dataset_pks))
+
+
+def discard_datapoints_of(subset_pks):
+    """Account for data points or values deleted from the given subsets.
+
+    The packed values are dropped, so that readers fall back to the
+    rows, and the value ranges and summaries are rebuilt once per data
+    set.
+
+    """
+    dataset_pks = set(
+        models.Subset.objects.filter(pk__in=subset_pks).values_list(
+            "dataset", flat=True
+        )
+    )
+    models.PackedSubset.objects.filter(subset__in=subset_pks).delete()
+    update_ranges_on_commit(dataset_pks)
+    update_summaries_on_commit(dataset_pks)
+
+
+def verify_summaries(dataset_pks):
+    stored = {
+        x.dataset_id: x
+        for x in models.DatasetSummary.objects.filter(dataset__in=dataset_pks)
+    }
+    for expected in summaries(dataset_pks):
+        pk = expected.dataset_id
+        if pk not in stored:
+            yield f"Data set {pk} has no summary"
+        elif any(
+            getattr(expected, name) != getattr(stored[pk], name)
+            for name in models.SUMMARY_FIELDS
+        ):
+            yield f"Summary of data set {pk} differs from the rows"
+
+
+KINDS = {
+    "packed": (rebuild_packed, verify_packed),
+    "lattices": (rebuild_lattices, verify_lattices),
+    "ranges": (rebuild_ranges, verify_ranges),
+    "documents": (rebuild_documents, verify_documents),
+    "authors": (rebuild_authors, verify_authors),
+    # After the ranges, whose representative values are summarized
+    "summaries": (update_summaries, verify_summaries),
+}
+
+
+def process(kinds, dataset_pks, verify=False):
+    """Rebuild or verify the given kinds of derived data of some data sets.
+
+    A rebuild is done in one transaction. Return the list of
+    differences found by verify, which is empty for a rebuild.
+
+    """
+    if verify:
+        return [x for kind in kinds for x in KINDS[kind][1](dataset_pks)]
+    with transaction.atomic():
+        for kind in kinds:
+            KINDS[kind][0](dataset_pks)
+    return []
+
+
+def process_lone_systems(verify=False):
+    """Same as process for the documents of the systems without data sets."""
+    if verify:
+        return list(verify_documents_of(lone_systems()))
+    search.update_search_documents(lone_systems())
+    return []
@@ -16,15 +16,19 @@ class SearchForm(forms.Form):
         label="Search term", max_length=100, required=False
     )  # Make search_text optional
 
-    band_gap_min = forms.FloatField(required=False)
-    band_gap_max = forms.FloatField(required=False)
+    physical_property = forms.ModelChoiceField(
+        queryset=models.Property.objects.all(), required=False
+    )
+    minimum = forms.FloatField(required=False)
+    maximum = forms.FloatField(required=False)
     is_experimental = forms.ChoiceField(choices=IS_EXPERIMENTAL_CHOICES, required=False)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fields["search_text"].widget.attrs["class"] = "form-control"
-        self.fields["band_gap_min"].widget.attrs["class"] = "form-control"
-        self.fields["band_gap_max"].widget.attrs["class"] = "form-control"
+        self.fields["physical_property"].widget.attrs["class"] = "form-control"
+        self.fields["minimum"].widget.attrs["class"] = "form-control"
+        self.fields["maximum"].widget.attrs["class"] = "form-control"
         self.fields["is_experimental"].widget.attrs["class"] = "form-control"
 
 
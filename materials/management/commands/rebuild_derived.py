@@ -0,0 +1,154 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+import json
+import multiprocessing
+import os
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import connections
+
+from materials import derived
+from materials import models
+
+
+def process_chunk(args):
+    return derived.process(*args)
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild derived data (packed values, lattice parameters, value "
+        "ranges, search documents, the author index, data set summaries) or "
+        "check it against the rows it is derived from."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--kind",
+            action="append",
+            choices=list(derived.KINDS),
+            help="Kind of derived data to process, can be repeated (default: all)",
+        )
+        parser.add_argument(
+            "--datasets",
+            nargs="+",
+            type=int,
+            help="Process only these data sets",
+        )
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="Report differences from the rows instead of rebuilding",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of worker processes (rebuilds on SQLite use one)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100,
+            help="Number of data sets processed per transaction",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help=(
+                "File recording the finished data sets and the differences "
+                "found so far. An interrupted run continues from here when "
+                "given the same file."
+            ),
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore the contents of the checkpoint file",
+        )
+
+    def handle(self, *args, **options):
+        # In the order of KINDS, as later kinds may use earlier ones
+        kinds = [x for x in derived.KINDS if x in (options["kind"] or derived.KINDS)]
+        verify = options["verify"]
+        datasets = models.Dataset.objects.order_by("pk")
+        if options["datasets"]:
+            datasets = datasets.filter(pk__in=options["datasets"])
+        dataset_pks = list(datasets.values_list("pk", flat=True))
+        checkpoint = options["checkpoint"]
+        done = set()
+        # Differences found so far, including those of an interrupted run
+        mismatches = []
+        if checkpoint and os.path.exists(checkpoint) and not options["restart"]:
+            with open(checkpoint) as f:
+                state = json.load(f)
+            if state["kinds"] != kinds or state["verify"] != verify:
+                raise CommandError(
+                    f"{checkpoint} belongs to a run with other options, "
+                    "use --restart to start over"
+                )
+            done.update(state["done"])
+            mismatches.extend(state["mismatches"])
+            for line in mismatches:
+                self.stdout.write(line)
+        pending = [pk for pk in dataset_pks if pk not in done]
+        chunk_size = options["chunk_size"]
+        chunks = [
+            (kinds, pending[i : i + chunk_size], verify)
+            for i in range(0, len(pending), chunk_size)
+        ]
+        workers = options["workers"]
+        if connection.vendor == "sqlite" and not verify:
+            # Concurrent writers would wait for each other's locks
+            workers = 1
+        if workers > 1:
+            # Each process needs its own database connection
+            connections.close_all()
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                for chunk, result in zip(chunks, pool.imap(process_chunk, chunks)):
+                    self.finish_chunk(chunk, result, done, mismatches, options)
+        else:
+            for chunk in chunks:
+                self.finish_chunk(
+                    chunk, process_chunk(chunk), done, mismatches, options
+                )
+        if "documents" in kinds and not options["datasets"]:
+            result = derived.process_lone_systems(verify)
+            for line in result:
+                self.stdout.write(line)
+            mismatches.extend(result)
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        if verify:
+            if mismatches:
+                raise CommandError(
+                    f"Found {len(mismatches)} differences in "
+                    f"{len(dataset_pks)} data sets."
+                )
+            self.stdout.write(
+                f"The derived data of {len(dataset_pks)} data sets match the rows."
+            )
+        else:
+            self.stdout.write(
+                f"Rebuilt {', '.join(kinds)} of {len(dataset_pks)} data sets."
+            )
+
+    def finish_chunk(self, chunk, result, done, mismatches, options):
+        """Report the result of a chunk and record it in the checkpoint."""
+        kinds, dataset_pks, verify = chunk
+        for line in result:
+            self.stdout.write(line)
+        mismatches.extend(result)
+        done.update(dataset_pks)
+        if options["checkpoint"]:
+            state = {
+                "kinds": kinds,
+                "verify": verify,
+                "done": sorted(done),
+                "mismatches": mismatches,
+            }
+            with open(f"{options['checkpoint']}.tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(f"{options['checkpoint']}.tmp", options["checkpoint"])
+        if options["verbosity"] > 1:
+            self.stdout.write(f"{len(done)} data sets done")
@@ -0,0 +1,52 @@
+# Generated by Django 3.1.14 on 2026-10-18 19:40
+
+from django.db import migrations, models
+from django.db.models.functions import Length
+
+ELEMENT_LENGTH = 10
+
+
+def check_element_lengths(apps, schema_editor):
+    """Make sure no element is cut off when the column is shortened.
+
+    Elements are chemical symbols, so surrounding whitespace is removed
+    and anything still too long is reported instead of truncated.
+
+    """
+    Stoichiometry_Elements = apps.get_model(
+        'materials', 'Stoichiometry_Elements')
+    rows = Stoichiometry_Elements.objects.annotate(
+        length=Length('element')).filter(length__gt=ELEMENT_LENGTH)
+    too_long = []
+    for row in rows:
+        row.element = row.element.strip()
+        if len(row.element) > ELEMENT_LENGTH:
+            too_long.append(row.pk)
+        else:
+            row.save(update_fields=['element'])
+    if too_long:
+        raise RuntimeError(
+            f'Stoichiometry_Elements rows {too_long} have elements longer '
+            f'than {ELEMENT_LENGTH} characters. Fix or delete them and run '
+            'the migration again.')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0134_remove_dataset_dimensionality'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_element_lengths,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='stoichiometry_elements',
+            name='element',
+            field=models.CharField(max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='stoichiometry_elements',
+            index=models.Index(fields=['element', 'float_value'], name='materials_s_element_de1eb2_idx'),
+        ),
+    ]
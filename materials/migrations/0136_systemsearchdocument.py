@@ -0,0 +1,108 @@
+# Generated by Django 3.1.14 on 2026-10-18 19:41
+
+from django.db import migrations, models
+from django.db.utils import OperationalError
+import django.db.models.deletion
+
+COLUMNS = 'formula, "group", iupac, compound_name, tags'
+NEW = 'new.formula, new."group", new.iupac, new.compound_name, new.tags'
+OLD = 'old.formula, old."group", old.iupac, old.compound_name, old.tags'
+SQLITE_FTS = [
+    'CREATE VIRTUAL TABLE materials_systemsearchdocument_fts USING fts5('
+    f"{COLUMNS}, content='materials_systemsearchdocument', "
+    "content_rowid='system_id')",
+    'CREATE TRIGGER materials_systemsearchdocument_ai AFTER INSERT ON '
+    'materials_systemsearchdocument BEGIN '
+    f'INSERT INTO materials_systemsearchdocument_fts(rowid, {COLUMNS}) '
+    f'VALUES (new.system_id, {NEW}); END',
+    'CREATE TRIGGER materials_systemsearchdocument_ad AFTER DELETE ON '
+    'materials_systemsearchdocument BEGIN '
+    'INSERT INTO materials_systemsearchdocument_fts('
+    f'materials_systemsearchdocument_fts, rowid, {COLUMNS}) '
+    f"VALUES ('delete', old.system_id, {OLD}); END",
+    'CREATE TRIGGER materials_systemsearchdocument_au AFTER UPDATE ON '
+    'materials_systemsearchdocument BEGIN '
+    'INSERT INTO materials_systemsearchdocument_fts('
+    f'materials_systemsearchdocument_fts, rowid, {COLUMNS}) '
+    f"VALUES ('delete', old.system_id, {OLD}); "
+    f'INSERT INTO materials_systemsearchdocument_fts(rowid, {COLUMNS}) '
+    f'VALUES (new.system_id, {NEW}); END',
+]
+SQLITE_FTS_DROP = [
+    'DROP TRIGGER IF EXISTS materials_systemsearchdocument_ai',
+    'DROP TRIGGER IF EXISTS materials_systemsearchdocument_ad',
+    'DROP TRIGGER IF EXISTS materials_systemsearchdocument_au',
+    'DROP TABLE IF EXISTS materials_systemsearchdocument_fts',
+]
+MYSQL_FTS = [
+    'CREATE FULLTEXT INDEX materials_systemsearchdocument_fts ON '
+    'materials_systemsearchdocument '
+    '(formula, `group`, iupac, compound_name, tags)',
+]
+MYSQL_FTS_DROP = [
+    'DROP INDEX materials_systemsearchdocument_fts ON '
+    'materials_systemsearchdocument',
+]
+
+
+def create_fulltext_index(apps, schema_editor):
+    """Create the full-text index if the backend supports one.
+
+    Without it (e.g., SQLite compiled without FTS5) search falls back
+    to substring matching.
+
+    """
+    vendor = schema_editor.connection.vendor
+    statements = {'sqlite': SQLITE_FTS, 'mysql': MYSQL_FTS}.get(vendor, [])
+    try:
+        for statement in statements:
+            schema_editor.execute(statement)
+    except OperationalError:
+        pass
+
+
+def drop_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    statements = {'sqlite': SQLITE_FTS_DROP,
+                  'mysql': MYSQL_FTS_DROP}.get(vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def populate_documents(apps, schema_editor):
+    System = apps.get_model('materials', 'System')
+    SystemSearchDocument = apps.get_model('materials', 'SystemSearchDocument')
+    documents = []
+    for system in System.objects.prefetch_related('tags'):
+        documents.append(SystemSearchDocument(
+            system=system,
+            formula=system.formula,
+            group=system.group,
+            iupac=system.iupac,
+            compound_name=system.compound_name,
+            tags=' '.join(tag.tag for tag in system.tags.all()),
+        ))
+    SystemSearchDocument.objects.bulk_create(documents, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0135_stoichiometry_elements_element_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SystemSearchDocument',
+            fields=[
+                ('system', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='materials.system')),
+                ('formula', models.CharField(max_length=200)),
+                ('group', models.CharField(blank=True, max_length=1000)),
+                ('iupac', models.CharField(blank=True, max_length=500)),
+                ('compound_name', models.CharField(max_length=1000)),
+                ('tags', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+        migrations.RunPython(populate_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,91 @@
+# Generated by Django 3.1.14 on 2026-10-18 19:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+import itertools
+import statistics
+
+UNRANGED_PROPERTIES = ('atomic structure', 'band structure')
+
+
+def populate_value_ranges(apps, schema_editor):
+    """Index all existing data sets (see search.update_value_ranges)."""
+    Dataset = apps.get_model('materials', 'Dataset')
+    DatasetValueRange = apps.get_model('materials', 'DatasetValueRange')
+    NumericalValue = apps.get_model('materials', 'NumericalValue')
+    PhaseTransition = apps.get_model('materials', 'PhaseTransition')
+    datasets = {
+        x[0]: x[1:] for x in Dataset.objects.exclude(
+            primary_property__name__in=UNRANGED_PROPERTIES).values_list(
+                'pk', 'primary_property', 'secondary_property',
+                'is_experimental')}
+    values = NumericalValue.objects.filter(
+        datapoint__subset__dataset__in=datasets).values_list(
+            'datapoint__subset__dataset', 'qualifier', 'value').order_by(
+                'datapoint__subset__dataset', 'qualifier')
+    transitions = {}
+    for dataset_pk, value in PhaseTransition.objects.filter(
+            subset__dataset__in=datasets).values_list(
+                'subset__dataset', 'value'):
+        transitions.setdefault(dataset_pk, []).append(value)
+    ranges = []
+    for (dataset_pk, qualifier), rows in itertools.groupby(
+            values.iterator(), key=lambda x: x[:2]):
+        group = [x[2] for x in rows]
+        if qualifier == 0:
+            group += transitions.pop(dataset_pk, [])
+        property_pk = datasets[dataset_pk][qualifier]
+        if property_pk:
+            ranges.append((dataset_pk, property_pk, qualifier, group))
+    for dataset_pk, group in transitions.items():
+        ranges.append((dataset_pk, datasets[dataset_pk][0], 0, group))
+    DatasetValueRange.objects.bulk_create(
+        [DatasetValueRange(
+            dataset_id=dataset_pk,
+            physical_property_id=property_pk,
+            qualifier=qualifier,
+            minimum=min(group),
+            maximum=max(group),
+            representative=statistics.median(group),
+            count=len(group),
+            is_experimental=datasets[dataset_pk][2],
+        ) for dataset_pk, property_pk, qualifier, group in ranges],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0136_systemsearchdocument'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetValueRange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('qualifier', models.PositiveSmallIntegerField(choices=[(0, 'primary'), (1, 'secondary')])),
+                ('minimum', models.FloatField()),
+                ('maximum', models.FloatField()),
+                ('representative', models.FloatField()),
+                ('count', models.PositiveIntegerField()),
+                ('is_experimental', models.BooleanField()),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='value_ranges', to='materials.dataset')),
+                ('physical_property', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='materials.property')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='datasetvaluerange',
+            index=models.Index(fields=['physical_property', 'minimum', 'maximum'], name='materials_d_physica_c92502_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='datasetvaluerange',
+            index=models.Index(fields=['physical_property', 'maximum'], name='materials_d_physica_e5ad9a_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='datasetvaluerange',
+            unique_together={('dataset', 'qualifier')},
+        ),
+        migrations.RunPython(populate_value_ranges,
+                             migrations.RunPython.noop),
+    ]
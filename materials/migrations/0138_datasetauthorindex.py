@@ -0,0 +1,64 @@
+# Generated by Django 3.1.14 on 2026-10-18 19:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+import unicodedata
+
+
+def normalize_name(name):
+    name = unicodedata.normalize('NFKD', name.casefold())
+    name = ''.join(x for x in name if not unicodedata.combining(x))
+    return ' '.join(re.findall(r'[^\W_]+', name))
+
+
+def populate_author_index(apps, schema_editor):
+    Author = apps.get_model('materials', 'Author')
+    Dataset = apps.get_model('materials', 'Dataset')
+    DatasetAuthorIndex = apps.get_model('materials', 'DatasetAuthorIndex')
+    authors = {author.pk: author for author in Author.objects.all()}
+    rows = []
+    for dataset_pk, system_pk, author_pk in Dataset.objects.filter(
+            reference__authors__isnull=False).values_list(
+                'pk', 'system', 'reference__authors').distinct():
+        author = authors[author_pk]
+        rows.append(DatasetAuthorIndex(
+            author_id=author_pk,
+            dataset_id=dataset_pk,
+            system_id=system_pk,
+            last_name=normalize_name(author.last_name)[:100],
+            initials=''.join(
+                x[0] for x in normalize_name(author.first_name).split())[:20],
+        ))
+    DatasetAuthorIndex.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0137_datasetvaluerange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetAuthorIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_name', models.CharField(max_length=100)),
+                ('initials', models.CharField(blank=True, max_length=20)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='materials.author')),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='materials.dataset')),
+                ('system', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='materials.system')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='datasetauthorindex',
+            index=models.Index(fields=['last_name', 'initials'], name='materials_d_last_na_b14f75_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='datasetauthorindex',
+            unique_together={('author', 'dataset')},
+        ),
+        migrations.RunPython(populate_author_index,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.1.14 on 2026-10-18 19:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0138_datasetauthorindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubsetLattice',
+            fields=[
+                ('subset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='lattice', serialize=False, to='materials.subset')),
+                ('a', models.FloatField()),
+                ('b', models.FloatField()),
+                ('c', models.FloatField()),
+                ('alpha', models.FloatField()),
+                ('beta', models.FloatField()),
+                ('gamma', models.FloatField()),
+                ('volume', models.FloatField()),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='materials.dataset')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='subsetlattice',
+            index=models.Index(fields=['a', 'b', 'c'], name='materials_s_a_6a0865_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subsetlattice',
+            index=models.Index(fields=['b', 'c'], name='materials_s_b_72bef1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subsetlattice',
+            index=models.Index(fields=['c', 'a'], name='materials_s_c_fddd75_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subsetlattice',
+            index=models.Index(fields=['volume'], name='materials_s_volume_b854f1_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.14 on 2026-10-18 20:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0139_subsetlattice'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['visible', 'created_by'], name='materials_d_visible_120325_idx'),
+        ),
+    ]
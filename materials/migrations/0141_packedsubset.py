@@ -0,0 +1,21 @@
+# Generated by Django 3.1.14 on 2026-10-18 20:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0140_dataset_visible_created_by_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackedSubset',
+            fields=[
+                ('subset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='packed', serialize=False, to='materials.subset')),
+                ('data', models.BinaryField()),
+            ],
+        ),
+    ]
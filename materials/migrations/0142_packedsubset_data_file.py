@@ -0,0 +1,24 @@
+# Generated by Django 3.1.14 on 2026-10-18 20:39
+
+from django.db import migrations, models
+import materials.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0141_packedsubset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packedsubset',
+            name='data_file',
+            field=models.FileField(blank=True, upload_to=materials.models.packed_file_path),
+        ),
+        migrations.AlterField(
+            model_name='packedsubset',
+            name='data',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.1.14 on 2026-10-18 20:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0142_packedsubset_data_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetSummary',
+            fields=[
+                ('dataset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='materials.dataset')),
+                ('num_subsets', models.PositiveIntegerField()),
+                ('num_datapoints', models.PositiveIntegerField()),
+                ('geometry_file_location', models.CharField(blank=True, max_length=255)),
+                ('fixed_temperatures', models.TextField(blank=True)),
+                ('verified', models.BooleanField()),
+                ('representative_value', models.FloatField(null=True)),
+            ],
+        ),
+    ]
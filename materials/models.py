@@ -149,6 +149,27 @@ class System(models.Model):
         return self.group.replace(",", " ").split()
 
 
+class SystemSearchDocument(models.Model):
+    """Searchable text of a system, kept in sync by signals.
+
+    The full-text index over these columns is created by a migration
+    since its form depends on the database backend (see search.py).
+
+    """
+
+    system = models.OneToOneField(
+        System,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="search_document",
+    )
+    formula = models.CharField(max_length=200)
+    group = models.CharField(max_length=1000, blank=True)
+    iupac = models.CharField(max_length=500, blank=True)
+    compound_name = models.CharField(max_length=1000)
+    tags = models.TextField(blank=True)
+
+
 # stoichiometry tables
 class System_Stoichiometry(models.Model):
     system = models.ForeignKey(System, on_delete=models.CASCADE)
@@ -169,14 +190,168 @@ class Stoichiometry_Elements(models.Model):
         null=True,
         on_delete=models.CASCADE,  # Use CASCADE to delete related elements when system_stoichiometry is deleted
     )
-    element = models.CharField(max_length=1000)
+    element = models.CharField(max_length=10)
     string_value = models.CharField(max_length=1000, default="0")
     float_value = models.FloatField(default=0.0)
 
+    class Meta:
+        indexes = [models.Index(fields=["element", "float_value"])]
+
     def __str__(self):
         return f"Element {self.element} in stoichiometry {self.system_stoichiometry}"
 
 
+class DatasetQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """Return the data sets that the given user may see.
+
+        Hidden (unpublished) data sets are only visible to whoever
+        created them.
+
+        """
+        if user.is_authenticated:
+            return self.filter(models.Q(visible=True) | models.Q(created_by=user))
+        return self.filter(visible=True)
+
+    def with_summary(self):
+        """Annotate the facts stored in DatasetSummary.
+
+        These are used by the methods that would otherwise compute them,
+        e.g., is_verified and count_datapoints. Data sets without a
+        summary are annotated with None.
+
+        """
+        return self.annotate(
+            **{name: models.F(f"summary__{name}") for name in SUMMARY_FIELDS}
+        )
+
+    def for_listing(self):
+        """Fetch what pages show around the cached data set cards."""
+        return (
+            self.select_related(
+                "system", "primary_property", "secondary_property", "created_by"
+            )
+            .prefetch_related("verified_by", "note")
+            .with_summary()
+        )
+
+    def for_display(self):
+        """Fetch everything shown by dataset_contents.html in bulk.
+
+        The number of queries of a page listing these data sets is then
+        independent of how many data sets, subsets, and values there
+        are. Lattice constants are only fetched for atomic structures.
+        The numbers of all entries of each property are set separately
+        by count_all_entries.
+
+        """
+        lattice_datapoints = (
+            Datapoint.objects.filter(
+                subset__dataset__primary_property__name="atomic structure"
+            )
+            .annotate(
+                num_symbols=models.Count("symbols", distinct=True),
+                num_values=models.Count("values", distinct=True),
+            )
+            .filter(num_symbols=1, num_values=1)
+            .order_by("pk")
+            .prefetch_related(
+                "symbols",
+                models.Prefetch(
+                    "values",
+                    queryset=NumericalValue.objects.select_related(
+                        "error", "upperbound"
+                    ),
+                ),
+            )
+        )
+        subsets = (
+            Subset.objects.select_related("space_group_ID")
+            .with_num_datapoints()
+            .order_by("pk")
+            .prefetch_related(
+                models.Prefetch(
+                    "fixed_values",
+                    queryset=NumericalValueFixed.objects.select_related(
+                        "physical_property", "unit"
+                    ),
+                ),
+                "phase_transitions",
+                models.Prefetch(
+                    "datapoints",
+                    queryset=lattice_datapoints,
+                    to_attr="lattice_datapoints",
+                ),
+            )
+        )
+        return (
+            self.select_related(
+                "system",
+                "primary_property",
+                "primary_unit",
+                "secondary_property",
+                "secondary_unit",
+                "reference",
+                "created_by__userprofile",
+                "updated_by__userprofile",
+            )
+            .prefetch_related(
+                models.Prefetch("subsets", queryset=subsets),
+                "reference__authors",
+                models.Prefetch(
+                    "linked_to",
+                    queryset=Dataset.objects.select_related("primary_property"),
+                ),
+                models.Prefetch(
+                    "verified_by",
+                    queryset=get_user_model().objects.select_related("userprofile"),
+                ),
+                models.Prefetch(
+                    "synthesis",
+                    queryset=SynthesisMethod.objects.select_related("comment"),
+                ),
+                models.Prefetch(
+                    "experimental",
+                    queryset=ExperimentalDetails.objects.select_related("comment"),
+                ),
+                models.Prefetch(
+                    "computational",
+                    queryset=ComputationalDetails.objects.select_related(
+                        "comment"
+                    ).prefetch_related("repositories"),
+                ),
+                "files",
+                "note",
+            )
+            .with_summary()
+        )
+
+
+def count_all_entries(datasets):
+    """Set all_entries of the given data sets with one grouped query.
+
+    all_entries is the number of published data sets of the same system
+    and primary property (see Dataset.num_all_entries).
+
+    """
+    datasets = list(datasets)
+    counts = (
+        Dataset.objects.filter(
+            system__in={x.system_id for x in datasets},
+            primary_property__in={x.primary_property_id for x in datasets},
+            visible=True,
+        )
+        .order_by()
+        .values_list("system", "primary_property")
+        .annotate(count=models.Count("pk"))
+    )
+    counts = {(system, prop): count for system, prop, count in counts}
+    for dataset in datasets:
+        dataset.all_entries = counts.get(
+            (dataset.system_id, dataset.primary_property_id), 0
+        )
+
+
 class Dataset(Base):
     """Class for mainly tables and figures.
 
@@ -257,8 +432,11 @@ class Dataset(Base):
     space_group = models.CharField(max_length=20, blank=True)
     notice = models.CharField(max_length=1000, blank=True, default="")
 
+    objects = DatasetQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "data sets"
+        indexes = [models.Index(fields=["visible", "created_by"])]
 
     def __str__(self):
         return f"ID: {self.pk} ({self.primary_property})"
@@ -321,22 +499,72 @@ class Dataset(Base):
         super().delete(*args, **kwargs)
 
     def num_all_entries(self):
+        """Return the number of published data sets of this property.
+
+        Uses all_entries if it was set by count_all_entries.
+
+        """
+        if hasattr(self, "all_entries"):
+            return self.all_entries
         return (
             Dataset.objects.filter(system=self.system)
             .filter(primary_property=self.primary_property)
+            .filter(visible=True)
             .count()
         )
 
+    def summary_value(self, name):
+        """Return the given field of the summary if annotated, else None."""
+        return getattr(self, name, None)
+
+    def count_subsets(self):
+        if self.summary_value("num_subsets") is not None:
+            return self.num_subsets
+        return self.subsets.count()
+
+    def count_datapoints(self):
+        if self.summary_value("num_datapoints") is not None:
+            return self.num_datapoints
+        return Datapoint.objects.filter(subset__dataset=self).count()
+
+    def is_verified(self):
+        if self.summary_value("verified") is not None:
+            return self.verified
+        return self.verified_by.exists()
+
+    def get_representative_value(self):
+        """Return the median of the primary values as in the range index."""
+        if self.summary_value("num_subsets") is not None:
+            return self.representative_value
+        return (
+            self.value_ranges.filter(qualifier=NumericalValue.PRIMARY)
+            .values_list("representative", flat=True)
+            .first()
+        )
+
     def get_all_fixed_temperatures(self):
         """Return a formatted list of all fixed temperatures."""
+        if self.summary_value("fixed_temperatures") is not None:
+            return self.fixed_temperatures
+        if "subsets" in getattr(self, "_prefetched_objects_cache", {}):
+            fixed_values = [
+                value
+                for subset in self.subsets.all()
+                for value in subset.fixed_values.all()
+                if value.physical_property.name == "temperature"
+            ]
+        else:
+            fixed_values = NumericalValueFixed.objects.filter(
+                subset__dataset=self
+            ).filter(physical_property__name="temperature")
         values = []
-        for value in NumericalValueFixed.objects.filter(subset__dataset=self).filter(
-            physical_property__name="temperature"
-        ):
+        for value in fixed_values:
             values.append(f"{value.formatted()} {value.unit}")
         return "(T = " + ", ".join(values) + ")" if values else ""
 
     def get_geometry_file_location(self):
+        if self.summary_value("geometry_file_location") is not None:
+            return self.geometry_file_location
         if self.primary_property.name != "atomic structure":
             for file_ in self.files.all():
                 if os.path.basename(file_.dataset_file.name) == "geometry.in":
@@ -344,6 +572,12 @@ class Dataset(Base):
         return ""
 
 
+class SubsetQuerySet(models.QuerySet):
+    def with_num_datapoints(self):
+        """Annotate the number of data points of each subset."""
+        return self.annotate(num_datapoints=models.Count("datapoints"))
+
+
 class Subset(Base):
     """Subset of data.
 
@@ -381,11 +615,25 @@ class Subset(Base):
     space_group = models.CharField(default="", max_length=20, blank=True)
     crystal_system = models.PositiveSmallIntegerField(choices=CRYSTAL_SYSTEMS)
 
+    objects = SubsetQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "data subsets (read-only)"
 
     def __str__(self):
-        return f"ID: {self.pk} ({self.datapoints.count()} data points)"
+        return f"ID: {self.pk} ({self.count_datapoints()} data points)"
+
+    def count_datapoints(self):
+        """Return the number of data points.
+
+        Uses the num_datapoints annotation if present (see
+        SubsetQuerySet.with_num_datapoints).
+
+        """
+        num_datapoints = getattr(self, "num_datapoints", None)
+        if num_datapoints is None:
+            num_datapoints = self.datapoints.count()
+        return num_datapoints
 
     def get_fixed_values(self):
         """Return all fixed properties for the given subset."""
@@ -398,21 +646,25 @@ class Subset(Base):
 
     def get_lattice_constants(self):
         """Return three lattice constants and angles."""
-        symbols = (
-            Symbol.objects.filter(datapoint__subset=self)
-            .annotate(num=models.Count("datapoint__symbols"))
-            .filter(num=1)
-            .order_by("datapoint_id")
-            .values_list("value", flat=True)
-        )
-        values_float = (
-            NumericalValue.objects.filter(datapoint__subset=self)
-            .annotate(num=models.Count("datapoint__values"))
-            .filter(num=1)
-            .select_related("error")
-            .select_related("upperbound")
-            .order_by("datapoint_id")
-        )
+        if hasattr(self, "lattice_datapoints"):
+            symbols = [x.symbols.all()[0].value for x in self.lattice_datapoints]
+            values_float = [x.values.all()[0] for x in self.lattice_datapoints]
+        else:
+            symbols = (
+                Symbol.objects.filter(datapoint__subset=self)
+                .annotate(num=models.Count("datapoint__symbols"))
+                .filter(num=1)
+                .order_by("datapoint_id")
+                .values_list("value", flat=True)
+            )
+            values_float = (
+                NumericalValue.objects.filter(datapoint__subset=self)
+                .annotate(num=models.Count("datapoint__values"))
+                .filter(num=1)
+                .select_related("error")
+                .select_related("upperbound")
+                .order_by("datapoint_id")
+            )
         if self.dataset.primary_unit:
             units = 3 * [f" {self.dataset.primary_unit.label}"] + 3 * ["°"]
         else:
@@ -431,10 +683,36 @@ class Subset(Base):
         coordinates).
 
         """
-        for subset in self.dataset.subsets.all():
-            if subset.datapoints.count() > 6:
-                return subset.pk == self.pk
-        return False
+        if "subsets" in getattr(self.dataset, "_prefetched_objects_cache", {}):
+            for subset in self.dataset.subsets.all():
+                if subset.count_datapoints() > 6:
+                    return subset.pk == self.pk
+            return False
+        first = (
+            self.dataset.subsets.with_num_datapoints()
+            .filter(num_datapoints__gt=6)
+            .order_by("pk")
+            .values_list("pk", flat=True)
+            .first()
+        )
+        return first == self.pk
+
+
+class DatapointQuerySet(models.QuerySet):
+    def delete(self):
+        """Additionally update the data derived from the subsets' data points.
+
+        This is done here rather than by a receiver of post_delete so
+        that it runs once per call instead of once per data point.
+        Cascades from subsets and data sets are handled by those.
+
+        """
+        from . import derived  # derived imports this module
+
+        subsets = set(self.values_list("subset", flat=True))
+        result = super().delete()
+        derived.discard_datapoints_of(subsets)
+        return result
 
 
 class Datapoint(Base):
@@ -449,6 +727,16 @@ class Datapoint(Base):
         Subset, on_delete=models.CASCADE, related_name="datapoints"
     )
 
+    objects = DatapointQuerySet.as_manager()
+
+    def delete(self, *args, **kwargs):
+        """Same as DatapointQuerySet.delete."""
+        from . import derived
+
+        result = super().delete(*args, **kwargs)
+        derived.discard_datapoints_of([self.subset_id])
+        return result
+
 
 class NumericalValueBase(Base):
     ACCURATE = 0
@@ -469,6 +757,17 @@ class NumericalValueBase(Base):
         abstract = True
 
 
+class NumericalValueQuerySet(models.QuerySet):
+    def delete(self):
+        """Same as DatapointQuerySet.delete for values."""
+        from . import derived
+
+        subsets = set(self.values_list("datapoint__subset", flat=True))
+        result = super().delete()
+        derived.discard_datapoints_of(subsets)
+        return result
+
+
 class NumericalValue(NumericalValueBase):
     """Numerical value(s) associated with a data point."""
 
@@ -485,6 +784,17 @@ class NumericalValue(NumericalValueBase):
         default=PRIMARY, choices=QUALIFIER_TYPES
     )
 
+    objects = NumericalValueQuerySet.as_manager()
+
+    def delete(self, *args, **kwargs):
+        """Same as DatapointQuerySet.delete."""
+        from . import derived
+
+        subset_pk = self.datapoint.subset_id
+        result = super().delete(*args, **kwargs)
+        derived.discard_datapoints_of([subset_pk])
+        return result
+
     def formatted(self, F=""):
         """Return the value as a formatted string.
 
@@ -492,11 +802,22 @@ class NumericalValue(NumericalValueBase):
         attached to the value, e.g., ">12.3 (±0.4)".
 
         """
-        value_str = f"{self.VALUE_TYPES[self.value_type][1]}{self.value:{F}}"
-        if hasattr(self, "error"):
-            value_str += f" (±{self.error.value:{F}})"
-        if hasattr(self, "upperbound"):
-            value_str += f"...{self.upperbound.value:{F}}"
+        return self.format_value(
+            self.value,
+            self.value_type,
+            self.error.value if hasattr(self, "error") else None,
+            self.upperbound.value if hasattr(self, "upperbound") else None,
+            F,
+        )
+
+    @classmethod
+    def format_value(cls, value, value_type, error=None, upper_bound=None, F=""):
+        """Same as formatted for the fields of a value given separately."""
+        value_str = f"{cls.VALUE_TYPES[value_type][1]}{value:{F}}"
+        if error is not None:
+            value_str += f" (±{error:{F}})"
+        if upper_bound is not None:
+            value_str += f"...{upper_bound:{F}}"
         return value_str
 
 
@@ -678,3 +999,156 @@ class PhaseTransition(NumericalValueBase):
         if self.upper_bound:
             value_str += f"...{self.upper_bound}"
         return value_str
+
+
+class DatasetValueRange(models.Model):
+    """Pre-aggregated values of a data set for range searches.
+
+    There is one row per data set and qualifier (primary or secondary
+    property) summarizing all of its numerical values, including phase
+    transitions. The rows are derived data and are rebuilt by
+    search.update_value_ranges whenever a data set is saved or new data
+    are submitted.
+
+    """
+
+    dataset = models.ForeignKey(
+        Dataset, on_delete=models.CASCADE, related_name="value_ranges"
+    )
+    physical_property = models.ForeignKey(
+        Property, on_delete=models.CASCADE, related_name="+"
+    )
+    qualifier = models.PositiveSmallIntegerField(
+        choices=NumericalValue.QUALIFIER_TYPES
+    )
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+    # The median of all values
+    representative = models.FloatField()
+    count = models.PositiveIntegerField()
+    is_experimental = models.BooleanField()
+
+    class Meta:
+        unique_together = ("dataset", "qualifier")
+        indexes = [
+            models.Index(fields=["physical_property", "minimum", "maximum"]),
+            models.Index(fields=["physical_property", "maximum"]),
+        ]
+
+
+class DatasetAuthorIndex(models.Model):
+    """Accent-folded author names of every data set for author searches.
+
+    Derived from Author, Reference, and Dataset and kept up to date by
+    signals (see search.update_author_index).
+
+    """
+
+    author = models.ForeignKey(Author, on_delete=models.CASCADE, related_name="+")
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name="+")
+    system = models.ForeignKey(System, on_delete=models.CASCADE, related_name="+")
+    # Lowercase without accents or punctuation, e.g., "muller"
+    last_name = models.CharField(max_length=100)
+    # First letters of the first names, e.g., "jm" for Jean-Marc
+    initials = models.CharField(max_length=20, blank=True)
+
+    class Meta:
+        unique_together = ("author", "dataset")
+        indexes = [models.Index(fields=["last_name", "initials"])]
+
+
+class SubsetLattice(models.Model):
+    """Lattice parameters of an atomic structure for tolerance searches.
+
+    The same numbers are stored as six data points of the subset (see
+    Subset.get_lattice_constants). Lengths are in the primary unit of
+    the data set, angles in degrees. Rows are created on ingest and by
+    rebuild_derived --kind lattices (see search.update_lattices).
+
+    """
+
+    subset = models.OneToOneField(
+        Subset, on_delete=models.CASCADE, primary_key=True, related_name="lattice"
+    )
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name="+")
+    a = models.FloatField()
+    b = models.FloatField()
+    c = models.FloatField()
+    alpha = models.FloatField()
+    beta = models.FloatField()
+    gamma = models.FloatField()
+    volume = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["a", "b", "c"]),
+            models.Index(fields=["b", "c"]),
+            models.Index(fields=["c", "a"]),
+            models.Index(fields=["volume"]),
+        ]
+
+
+def packed_file_path(instance, filename):
+    return os.path.join(
+        "data_files", f"dataset_{instance.subset.dataset_id}", filename
+    )
+
+
+class PackedSubset(models.Model):
+    """Numerical values of a subset as contiguous arrays.
+
+    Reading a subset from here takes one row instead of one row per
+    value, error, and upper bound. data holds the arrays of
+    packing.value_arrays in the format of utils.pack_arrays. Subsets
+    with many data points are instead stored in data_file as a NumPy
+    structured array with one field per array, which is memory-mapped
+    when read so that only the requested part is loaded (see
+    packing.FILE_THRESHOLD). Only subsets where each data point has one
+    primary and, throughout the subset, either no or one secondary
+    value are packed (see packing.is_packable). The rows of
+    NumericalValue remain the source of truth: packed values are
+    created on ingest and by the rebuild_derived command, and are
+    deleted whenever a value of the subset changes.
+
+    """
+
+    subset = models.OneToOneField(
+        Subset, on_delete=models.CASCADE, primary_key=True, related_name="packed"
+    )
+    data = models.BinaryField(null=True)
+    data_file = models.FileField(upload_to=packed_file_path, blank=True)
+
+
+class DatasetSummary(models.Model):
+    """Facts about a data set shown on list pages and in the API.
+
+    Computing these takes several queries per data set, so they are
+    stored here instead and read with Dataset.objects.with_summary().
+    The rows are derived data and are rebuilt by
+    derived.update_summaries whenever the data set or one of its parts
+    changes (see signals.py) and by the rebuild_derived command.
+
+    """
+
+    dataset = models.OneToOneField(
+        Dataset, on_delete=models.CASCADE, primary_key=True, related_name="summary"
+    )
+    num_subsets = models.PositiveIntegerField()
+    num_datapoints = models.PositiveIntegerField()
+    # See Dataset.get_geometry_file_location
+    geometry_file_location = models.CharField(max_length=255, blank=True)
+    # See Dataset.get_all_fixed_temperatures
+    fixed_temperatures = models.TextField(blank=True)
+    verified = models.BooleanField()
+    # Same as the representative of the primary value range
+    representative_value = models.FloatField(null=True)
+
+
+SUMMARY_FIELDS = (
+    "num_subsets",
+    "num_datapoints",
+    "geometry_file_location",
+    "fixed_temperatures",
+    "verified",
+    "representative_value",
+)
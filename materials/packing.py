@@ -0,0 +1,224 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Packed representation of the numerical values of subsets.
+
+See models.PackedSubset. Readers use packed_arrays where available
+and value_arrays of the rows otherwise, so both must give the same
+arrays.
+
+"""
+import io
+import itertools
+import logging
+import math
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F
+import numpy
+
+from . import models
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = models.NumericalValue.PRIMARY
+SECONDARY = models.NumericalValue.SECONDARY
+# Subsets with at least this many data points are packed into a file
+FILE_THRESHOLD = 100_000
+
+
+def values_by_subset(subsets):
+    """Return the numerical values of the given subsets grouped by subset.
+
+    All values are fetched in one query, along with their errors and
+    upper bounds, ordered by data point and qualifier.
+
+    """
+    values = (
+        models.NumericalValue.objects.filter(datapoint__subset__in=subsets)
+        .annotate(subset=F("datapoint__subset"))
+        .select_related("error", "upperbound")
+        .order_by("subset", "datapoint", "qualifier")
+    )
+    return {
+        subset: list(subset_values)
+        for subset, subset_values in itertools.groupby(values, lambda x: x.subset)
+    }
+
+
+def split_values(values):
+    """Split values of a subset into the y- (primary) and x-values."""
+    axes = {"y": [], "x": []}
+    for value in values:
+        if value.qualifier == PRIMARY:
+            axes["y"].append(value)
+        else:
+            axes["x"].append(value)
+    return axes
+
+
+def value_arrays(values):
+    """Return the values of a subset as arrays.
+
+    These are y and x (if present) and the value types, errors, and
+    upper bounds of each. Errors and upper bounds are NaN where there
+    are none and are left out altogether if no value has one. x-first
+    is 1 for data points whose x-value was stored before the y-value,
+    which is the order of the rows, and is left out if there are none.
+
+    """
+    arrays = {}
+    axes = split_values(values)
+    if len(axes["x"]) == len(axes["y"]):
+        x_first = numpy.array(
+            [x.pk < y.pk for y, x in zip(axes["y"], axes["x"])], dtype=numpy.uint8
+        )
+        if x_first.any():
+            arrays["x-first"] = x_first
+    for axis, axis_values in axes.items():
+        if not axis_values:
+            continue
+        arrays[axis] = numpy.array([value.value for value in axis_values])
+        arrays[f"{axis}-type"] = numpy.array(
+            [value.value_type for value in axis_values], dtype=numpy.uint8
+        )
+        for name, related in (("error", "error"), ("upper", "upperbound")):
+            bounds = numpy.array(
+                [
+                    getattr(value, related).value
+                    if hasattr(value, related)
+                    else numpy.nan
+                    for value in axis_values
+                ]
+            )
+            if not numpy.isnan(bounds).all():
+                arrays[f"{axis}-{name}"] = bounds
+    return arrays
+
+
+def is_packable(values):
+    """Whether the values of a subset can be packed into arrays.
+
+    That is the case if the i-th x-value belongs to the same data point
+    as the i-th y-value, i.e., each data point has exactly one primary
+    value and either all or none have one secondary value.
+
+    """
+    shapes = {
+        tuple(value.qualifier for value in datapoint_values)
+        for _, datapoint_values in itertools.groupby(values, lambda x: x.datapoint_id)
+    }
+    return shapes <= {(PRIMARY,)} or shapes <= {(PRIMARY, SECONDARY)}
+
+
+def to_columns(arrays):
+    """Return value_arrays as one NumPy structured scalar.
+
+    Each array is a field of the scalar, so that the arrays are stored
+    one after another. Narrower types come last to keep the others
+    aligned.
+
+    """
+    arrays = sorted(arrays.items(), key=lambda x: -x[1].dtype.itemsize)
+    columns = numpy.empty(
+        (), [(name, x.dtype.newbyteorder("<"), x.shape) for name, x in arrays]
+    )
+    for name, x in arrays:
+        columns[name] = x
+    return columns
+
+
+def pack_subsets(subsets):
+    """Create or replace the packed values of the given subsets.
+
+    subsets is a list of subset pks. Subsets whose values cannot be
+    packed are skipped. Subsets with at least FILE_THRESHOLD data points
+    are written to .npy files next to the input files of the data set.
+    Return the number of subsets packed.
+
+    """
+    values = values_by_subset(subsets)
+    rows = []
+    with transaction.atomic():
+        # Their files are removed once this is committed
+        models.PackedSubset.objects.filter(subset__in=subsets).delete()
+        for pk in subsets:
+            subset_values = values.get(pk, [])
+            if not is_packable(subset_values):
+                continue
+            arrays = value_arrays(subset_values)
+            row = models.PackedSubset(subset_id=pk)
+            if len(arrays.get("y", ())) < FILE_THRESHOLD:
+                row.data = utils.pack_arrays({}, arrays)
+            else:
+                content = io.BytesIO()
+                numpy.save(content, to_columns(arrays))
+                row.data_file.save(
+                    f"subset_{pk}.npy", ContentFile(content.getvalue()), save=False
+                )
+            rows.append(row)
+        models.PackedSubset.objects.bulk_create(rows)
+    return len(rows)
+
+
+def read_packed(packed):
+    """Return the arrays of a PackedSubset.
+
+    Arrays stored in a file are memory-mapped, so only the parts that
+    are used, e.g., a window of data points, are read from disk.
+
+    """
+    if packed.data is not None:
+        return utils.unpack_arrays(packed.data)["arrays"]
+    columns = numpy.load(packed.data_file.path, mmap_mode="r")
+    return {name: columns[name] for name in columns.dtype.names}
+
+
+def packed_arrays(subsets):
+    """Return the packed arrays of the given subsets by subset pk.
+
+    subsets is a list or queryset of subsets. Subsets that are not
+    packed or whose file is missing are left out.
+
+    """
+    return read_all_packed(models.PackedSubset.objects.filter(subset__in=subsets))
+
+
+def read_all_packed(rows):
+    """Same as packed_arrays for PackedSubset instances."""
+    arrays = {}
+    for packed in rows:
+        try:
+            arrays[packed.subset_id] = read_packed(packed)
+        except OSError:
+            logger.warning(f"Cannot read packed values from {packed.data_file}")
+    return arrays
+
+
+def format_value(value, value_type, error, upper_bound):
+    """Same as NumericalValue.formatted, with NaN for no error or bound."""
+    return models.NumericalValue.format_value(
+        value,
+        value_type,
+        None if math.isnan(error) else error,
+        None if math.isnan(upper_bound) else upper_bound,
+    )
+
+
+def format_arrays(arrays):
+    """Return the formatted y- and x-values of value_arrays."""
+    axes = {}
+    for axis in "y", "x":
+        if axis not in arrays:
+            continue
+        missing = numpy.full(len(arrays[axis]), numpy.nan)
+        axes[axis] = [
+            format_value(*x)
+            for x in zip(
+                arrays[axis].tolist(),
+                arrays[f"{axis}-type"].tolist(),
+                arrays.get(f"{axis}-error", missing).tolist(),
+                arrays.get(f"{axis}-upper", missing).tolist(),
+            )
+        ]
+    return axes
@@ -4,6 +4,7 @@ import os
 import shutil
 
 from . import models
+from . import packing
 from mainproject import settings
 
 matplotlib.use('Agg')
@@ -103,13 +104,18 @@ def create_static_files(request, dataset):
         pyplot.savefig(os.path.join(qresp_loc, 'figure.png'))
         pyplot.close()
     elif dataset.secondary_property:
+        packed = packing.packed_arrays(dataset.subsets.all())
         for subset in dataset.subsets.all():
-            values = models.NumericalValue.objects.filter(
-                datapoint__subset=subset).order_by(
-                    'qualifier', 'datapoint__pk').values_list(
-                        'value', flat=True)
-            y_values = values[:len(values)//2]
-            x_values = values[len(values)//2:len(values)]
+            if subset.pk in packed:
+                y_values = packed[subset.pk].get('y', [])
+                x_values = packed[subset.pk].get('x', [])
+            else:
+                values = models.NumericalValue.objects.filter(
+                    datapoint__subset=subset).order_by(
+                        'qualifier', 'datapoint__pk').values_list(
+                            'value', flat=True)
+                y_values = values[:len(values)//2]
+                x_values = values[len(values)//2:len(values)]
             fixed_values = []
             for v in subset.fixed_values.all():
                 fixed_values.append(
@@ -138,7 +144,12 @@ def create_static_files(request, dataset):
         pyplot.close()
     else:
         value_sets = []
+        packed = packing.packed_arrays(dataset.subsets.all())
         for subset in dataset.subsets.all():
+            arrays = packed.get(subset.pk, {})
+            if 'y' in arrays and 'x' not in arrays:
+                value_sets.append(arrays['y'].tolist())
+                continue
             value_sets.append(models.NumericalValue.objects.filter(
                 datapoint__subset=subset).order_by(
                     'datapoint__pk').values_list('value', flat=True))
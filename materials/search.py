@@ -0,0 +1,1319 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Search indexes and query compilation for the search page."""
+import base64
+import bisect
+import hashlib
+import json
+import math
+import operator
+import re
+import statistics
+import threading
+import unicodedata
+import uuid
+from collections import defaultdict
+from functools import reduce
+
+import numpy
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db import connection
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import FilteredRelation
+from django.db.models import IntegerField
+from django.db.models import Q
+from django.db.models import Value
+from django.db.models import When
+from django.urls import reverse
+
+from . import models
+from . import utils
+
+COMPOSITION_VERSION_KEY = "materials-composition-version"
+AUTOCOMPLETE_VERSION_KEY = "materials-autocomplete-version"
+SIMILARITY_VERSION_KEY = "materials-similarity-version"
+TRIGRAM_VERSION_KEY = "materials-trigram-version"
+TRIGRAM_INDEX_KEY = "materials-trigram-index"
+SEARCH_RESULTS_KEY = "materials-search-results"
+# Seconds for which facets of a search can be narrowed without
+# searching again
+SEARCH_RESULTS_TIMEOUT = 3600
+SEARCH_PAGE_SIZE = 50
+# Bumped whenever systems, data sets, values, or references change so
+# that cached search results are never served stale
+CATALOG_VERSION_KEY = "materials-catalog-version"
+RESULT_CACHE_KEY = "materials-result-cache"
+RESULT_CACHE_TIMEOUT = 24 * 3600
+RESULT_CACHE_HITS_KEY = "materials-result-cache-hits"
+RESULT_CACHE_MISSES_KEY = "materials-result-cache-misses"
+# Search terms whose text is matched without regard to case
+CASELESS_SEARCH_TERMS = (
+    "doi",
+    "formula",
+    "physical_property",
+    "organic",
+    "inorganic",
+    "author",
+)
+
+# Name, title, and lookup from System of each search facet
+FACETS = (
+    ("primary_property", "Property", "published__primary_property__name"),
+    ("is_experimental", "Type", "published__is_experimental"),
+    ("sample_type", "Sample type", "published__sample_type"),
+    ("crystal_system", "Crystal system", "published__subsets__crystal_system"),
+    ("space_group", "Space group", "published__space_group"),
+    ("dimensionality", "Dimensionality", "dimensionality"),
+    ("organic", "Organic component", "organic"),
+    ("inorganic", "Inorganic component", "inorganic"),
+)
+FACET_LABELS = {
+    "is_experimental": {True: "experimental", False: "computational"},
+    "sample_type": dict(models.Dataset.SAMPLE_TYPES),
+    "crystal_system": dict(models.Subset.CRYSTAL_SYSTEMS),
+    "dimensionality": dict(models.System.DIMENSIONALITIES),
+}
+
+# Properties whose numerical values are not meaningful for range
+# searches (e.g., atomic coordinates)
+UNRANGED_PROPERTIES = ("atomic structure", "band structure")
+# Fields of a data set that value_ranges depends on besides the values
+RANGE_FIELDS = ("primary_property", "secondary_property", "is_experimental")
+
+# Relative weights of formula, group, iupac, compound_name, and tags
+# when ranking full-text matches (SQLite only).
+FULLTEXT_WEIGHTS = (10.0, 5.0, 2.0, 10.0, 1.0)
+# Maximum number of full-text matches returned by a formula/name search
+FULLTEXT_LIMIT = 200
+
+ELEMENT_PATTERN = r"[A-Z][a-z]?"
+COMPARISONS = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    ">": operator.gt,
+    "<": operator.lt,
+    "==": lambda a, b: abs(a - b) < 1e-6,
+    "=": lambda a, b: abs(a - b) < 1e-6,
+}
+COMPARISON_PATTERN = "|".join(re.escape(op) for op in COMPARISONS)
+
+
+class CompositionQuery:
+    """Element constraints parsed from a composition search string.
+
+    The search string is a list of terms separated by spaces or
+    commas. Each term is one of
+
+      Pb          the element must be present
+      -Sn, !Sn    the element must be absent
+      I>=3        the amount of the element must satisfy the comparison
+      I/Pb>=3     the ratio of two amounts must satisfy the comparison
+
+    Supported comparisons are >=, <=, >, <, and =.
+
+    """
+
+    def __init__(self):
+        self.include = set()
+        self.exclude = set()
+        # Each constraint is (numerator, denominator or None, op, value)
+        self.constraints = []
+
+    @classmethod
+    def parse(cls, text):
+        query = cls()
+        for term in re.split(r"[\s,]+", text.strip()):
+            if not term:
+                continue
+            m = re.fullmatch(f"[-!]({ELEMENT_PATTERN})", term)
+            if m:
+                query.exclude.add(m.group(1))
+                continue
+            m = re.fullmatch(
+                f"({ELEMENT_PATTERN})(?:/({ELEMENT_PATTERN}))?"
+                f"(?:({COMPARISON_PATTERN})(\\d+(?:\\.\\d*)?|\\.\\d+))?",
+                term,
+            )
+            if not m:
+                raise ValueError(f'Could not understand "{term}".')
+            numerator, denominator, op, value = m.groups()
+            if denominator and not op:
+                raise ValueError(f'Ratio "{term}" needs a comparison, e.g. >=1.')
+            query.include.add(numerator)
+            if denominator:
+                query.include.add(denominator)
+            if op:
+                query.constraints.append((numerator, denominator, op, float(value)))
+        if not query.include:
+            raise ValueError("Specify at least one element that must be present.")
+        if query.include & query.exclude:
+            raise ValueError(
+                "An element cannot be both required and excluded: "
+                + ", ".join(sorted(query.include & query.exclude))
+            )
+        return query
+
+    def elements(self):
+        return self.include | self.exclude
+
+
+class CompositionIndex:
+    """Element to stoichiometry posting lists.
+
+    For each element the index holds a mapping of the stoichiometries
+    containing it to the amount of that element. Posting lists are
+    loaded on demand, one indexed query for all elements that are not
+    yet cached, and dropped whenever the composition version changes
+    (see signals.py). Multi-element queries are then answered by set
+    intersection in memory.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._postings = {}
+        self._systems = {}
+
+    def postings(self, elements):
+        """Return posting lists of the elements and the system lookup.
+
+        The second return value maps stoichiometry primary keys to
+        system primary keys.
+
+        """
+        with self._lock:
+            version = utils.get_version(COMPOSITION_VERSION_KEY)
+            if version != self._version:
+                self._postings = {}
+                self._systems = {}
+                self._version = version
+            missing = [x for x in elements if x not in self._postings]
+            if missing:
+                for element in missing:
+                    self._postings[element] = {}
+                rows = models.Stoichiometry_Elements.objects.filter(
+                    element__in=missing, system_stoichiometry__isnull=False
+                ).values_list(
+                    "element",
+                    "system_stoichiometry_id",
+                    "system_stoichiometry__system_id",
+                    "float_value",
+                )
+                for element, stoichiometry_pk, system_pk, amount in rows:
+                    posting = self._postings[element]
+                    amount += posting.get(stoichiometry_pk, 0)
+                    posting[stoichiometry_pk] = amount
+                    self._systems[stoichiometry_pk] = system_pk
+            return {x: self._postings[x] for x in elements}, self._systems
+
+    def find(self, query):
+        """Return the primary keys of all systems matching the query."""
+        postings, systems = self.postings(query.elements())
+        included = sorted(query.include, key=lambda x: len(postings[x]))
+        candidates = set(postings[included[0]])
+        for element in included[1:]:
+            candidates.intersection_update(postings[element])
+        for element in query.exclude:
+            candidates.difference_update(postings[element])
+        for numerator, denominator, op, value in query.constraints:
+            compare = COMPARISONS[op]
+            numerators = postings[numerator]
+            if denominator:
+                denominators = postings[denominator]
+                candidates = {
+                    x
+                    for x in candidates
+                    if denominators[x]
+                    and compare(numerators[x] / denominators[x], value)
+                }
+            else:
+                candidates = {x for x in candidates if compare(numerators[x], value)}
+        return {systems[x] for x in candidates}
+
+
+composition_index = CompositionIndex()
+
+
+class SimilarityIndex:
+    """Element fraction vectors of all systems for similarity searches.
+
+    Row i of the matrix holds the fraction of each element (one column
+    per element) in the formal stoichiometry of system pks[i]. Systems
+    with several stoichiometries are represented by the first one. The
+    matrix is loaded with a single query and, like AutocompleteIndex,
+    updated in place for changes made by the current process while
+    other processes reload it when the version changes.
+
+    """
+
+    METRICS = ("cosine", "l1")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._columns = {}
+        self._pks = numpy.empty(0, dtype=int)
+        self._rows = {}
+        self._matrix = numpy.empty((0, 0))
+        self._norms = numpy.empty(0)
+
+    @staticmethod
+    def _stoichiometries(system_pks=None):
+        """Return {system pk: {element: amount}}."""
+        rows = models.Stoichiometry_Elements.objects.filter(
+            system_stoichiometry__isnull=False
+        )
+        if system_pks is not None:
+            rows = rows.filter(system_stoichiometry__system__in=system_pks)
+        first = {}
+        compositions = {}
+        for system_pk, stoichiometry_pk, element, amount in rows.values_list(
+            "system_stoichiometry__system_id",
+            "system_stoichiometry_id",
+            "element",
+            "float_value",
+        ).order_by("system_stoichiometry_id"):
+            if first.setdefault(system_pk, stoichiometry_pk) != stoichiometry_pk:
+                continue
+            composition = compositions.setdefault(system_pk, {})
+            composition[element] = composition.get(element, 0) + amount
+        return compositions
+
+    def _vector(self, composition):
+        total = sum(composition.values())
+        vector = numpy.zeros(len(self._columns))
+        if total > 0:
+            for element, amount in composition.items():
+                vector[self._columns[element]] = amount / total
+        return vector
+
+    def _rebuild(self):
+        compositions = {
+            pk: composition
+            for pk, composition in self._stoichiometries().items()
+            if sum(composition.values()) > 0
+        }
+        elements = sorted({x for c in compositions.values() for x in c})
+        self._columns = {element: j for j, element in enumerate(elements)}
+        self._pks = numpy.array(sorted(compositions), dtype=int)
+        self._rows = {pk: i for i, pk in enumerate(self._pks.tolist())}
+        self._matrix = numpy.zeros((len(self._pks), len(self._columns)))
+        for pk, i in self._rows.items():
+            self._matrix[i] = self._vector(compositions[pk])
+        self._norms = numpy.linalg.norm(self._matrix, axis=1)
+
+    def _ensure_current(self):
+        version = utils.get_version(SIMILARITY_VERSION_KEY)
+        if version != self._version:
+            self._rebuild()
+            self._version = version
+
+    def update(self, system_pks):
+        """Reload the vectors of the given systems."""
+        compositions = self._stoichiometries(system_pks)
+        with self._lock:
+            current = self._version == utils.get_version(SIMILARITY_VERSION_KEY)
+            version = utils.increment_version(SIMILARITY_VERSION_KEY)
+            if not current:
+                return
+            for pk in system_pks:
+                composition = compositions.get(pk, {})
+                if sum(composition.values()) <= 0:
+                    i = self._rows.pop(pk, None)
+                    if i is not None:
+                        self._pks = numpy.delete(self._pks, i)
+                        self._matrix = numpy.delete(self._matrix, i, axis=0)
+                        self._norms = numpy.delete(self._norms, i)
+                        self._rows = {x: j for j, x in enumerate(self._pks.tolist())}
+                    continue
+                new_elements = sorted(set(composition) - set(self._columns))
+                if new_elements:
+                    for element in new_elements:
+                        self._columns[element] = len(self._columns)
+                    self._matrix = numpy.hstack(
+                        (self._matrix, numpy.zeros((len(self._pks), len(new_elements))))
+                    )
+                vector = self._vector(composition)
+                if pk not in self._rows:
+                    self._rows[pk] = len(self._pks)
+                    self._pks = numpy.append(self._pks, pk)
+                    self._matrix = numpy.vstack((self._matrix, vector))
+                    self._norms = numpy.append(self._norms, 0)
+                i = self._rows[pk]
+                self._matrix[i] = vector
+                self._norms[i] = numpy.linalg.norm(vector)
+            self._version = version
+
+    def similar(self, pk, limit=10, metric="cosine"):
+        """Return up to limit (system pk, distance) pairs, closest first.
+
+        The distance is 1 - cosine similarity or the L1 distance of the
+        element fractions (0 to 2). The system itself is not included.
+        Return an empty list if the system has no stoichiometry.
+
+        """
+        if metric not in self.METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        with self._lock:
+            self._ensure_current()
+            i = self._rows.get(pk)
+            if i is None:
+                return []
+            vector = self._matrix[i]
+            if metric == "cosine":
+                distances = 1 - self._matrix @ vector / (self._norms * self._norms[i])
+            else:
+                distances = numpy.abs(self._matrix - vector).sum(axis=1)
+            distances[i] = numpy.inf
+            limit = min(limit, len(distances) - 1)
+            if limit <= 0:
+                return []
+            nearest = numpy.argpartition(distances, limit - 1)[:limit]
+            nearest = nearest[numpy.argsort(distances[nearest], kind="stable")]
+            return [
+                (int(self._pks[j]), float(distances[j])) for j in nearest.tolist()
+            ]
+
+
+similarity_index = SimilarityIndex()
+
+
+def trigrams(text):
+    """Return the set of trigrams of text.
+
+    As in PostgreSQL's pg_trgm, text is lowercased and split into
+    words, and each word is padded with two spaces in front and one at
+    the end so that word beginnings weigh more.
+
+    """
+    grams = set()
+    for word in re.findall(r"[^\W_]+", text.lower()):
+        word = f"  {word} "
+        grams.update(word[i : i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """Trigram postings of system names for typo tolerant searches.
+
+    Each compound name, alternate name, and IUPAC name of a system is
+    broken into trigrams. A query only visits the postings of its own
+    trigrams and ranks names by their trigram similarity (shared
+    trigrams over all distinct trigrams of both). Updates work as in
+    AutocompleteIndex. In addition, a rebuilt index is stored in the
+    cache under its version so that other processes can load it from
+    there instead of rebuilding it, provided they share the cache
+    backend (see CACHE_BACKEND). Updates are not stored, which would
+    mean writing the whole index on every save of a system, so the
+    first process to notice an update rebuilds and stores the index.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        # System pk -> list of (name, number of trigrams)
+        self._names = {}
+        # Trigram -> set of (system pk, position in the list of names)
+        self._postings = {}
+
+    @staticmethod
+    def names(compound_name, group, iupac):
+        """Return the searchable names of a system."""
+        names = [compound_name, iupac] + group.replace(",", " ").split()
+        return list(dict.fromkeys(x for x in names if x))
+
+    def _add(self, pk, names):
+        entries = []
+        for i, name in enumerate(names):
+            grams = trigrams(name)
+            entries.append((name, len(grams)))
+            for gram in grams:
+                self._postings.setdefault(gram, set()).add((pk, i))
+        self._names[pk] = entries
+
+    def _discard(self, pk):
+        for i, (name, _) in enumerate(self._names.pop(pk, [])):
+            for gram in trigrams(name):
+                postings = self._postings[gram]
+                postings.discard((pk, i))
+                if not postings:
+                    del self._postings[gram]
+
+    def _rebuild(self):
+        self._names = {}
+        self._postings = {}
+        for pk, *fields in models.System.objects.values_list(
+            "pk", "compound_name", "group", "iupac"
+        ):
+            self._add(pk, self.names(*fields))
+
+    def _ensure_current(self):
+        version = utils.get_version(TRIGRAM_VERSION_KEY)
+        if version == self._version:
+            return
+        snapshot = cache.get(TRIGRAM_INDEX_KEY)
+        if snapshot and snapshot[0] == version:
+            _, self._names, self._postings = snapshot
+        else:
+            self._rebuild()
+            cache.set(TRIGRAM_INDEX_KEY, (version, self._names, self._postings), None)
+        self._version = version
+
+    def update(self, systems):
+        """Apply changes to systems.
+
+        systems maps primary keys to lists of names as returned by
+        names(), or to None for deleted systems.
+
+        """
+        with self._lock:
+            current = self._version == utils.get_version(TRIGRAM_VERSION_KEY)
+            version = utils.increment_version(TRIGRAM_VERSION_KEY)
+            if not current:
+                return
+            for pk, names in systems.items():
+                self._discard(pk)
+                if names is not None:
+                    self._add(pk, names)
+            self._version = version
+
+    def find(self, text, limit=20, threshold=0.3):
+        """Return up to limit (system pk, similarity) pairs, best first.
+
+        The similarity of a system is that of its best matching name.
+        Systems below the threshold are left out.
+
+        """
+        query = trigrams(text)
+        if not query:
+            return []
+        with self._lock:
+            self._ensure_current()
+            shared = defaultdict(int)
+            for gram in query:
+                for posting in self._postings.get(gram, ()):
+                    shared[posting] += 1
+            best = {}
+            for (pk, i), count in shared.items():
+                similarity = count / (len(query) + self._names[pk][i][1] - count)
+                if similarity >= threshold and similarity > best.get(pk, 0):
+                    best[pk] = similarity
+        return sorted(best.items(), key=lambda x: (-x[1], x[0]))[:limit]
+
+
+trigram_index = TrigramIndex()
+
+
+class AutocompleteIndex:
+    """Prefix index for suggestions on the search page.
+
+    Every entry (a system, data set, author, or physical property) is
+    reachable from the start of each word of its searchable text.
+    Systems and data sets can also be found by their ID. The keys are
+    held in one sorted list so that all completions of a prefix form a
+    contiguous slice found by bisection.
+
+    Saves and deletions update the index of the current process in
+    place once the transaction commits (see signals.py) and bump the
+    version so that other processes rebuild theirs on next use.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        # Sorted (key, kind, pk) tuples
+        self._keys = []
+        # (kind, pk) -> (suggestion, keys)
+        self._entries = {}
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.lower().split())
+
+    @classmethod
+    def words(cls, text):
+        """Return text and every suffix of it starting at a word."""
+        text = cls.normalize(text)
+        return {text[m.start() :] for m in re.finditer(r"\w+", text)}
+
+    @staticmethod
+    def system_entry(pk, compound_name, iupac):
+        suggestion = {
+            "type": "system",
+            "pk": pk,
+            "label": compound_name,
+            "url": reverse("materials:system", kwargs={"pk": pk}),
+        }
+        return suggestion, [compound_name, iupac]
+
+    @staticmethod
+    def dataset_entry(pk, compound_name, property_name):
+        suggestion = {
+            "type": "dataset",
+            "pk": pk,
+            "label": f"{pk} - {compound_name}, {property_name}",
+            "url": reverse("materials:dataset", kwargs={"pk": pk}),
+        }
+        return suggestion, []
+
+    @staticmethod
+    def author_entry(pk, first_name, last_name):
+        suggestion = {
+            "type": "author",
+            "pk": pk,
+            "label": f"{last_name}, {first_name}",
+            "search_term": "author",
+            "search_text": last_name,
+        }
+        return suggestion, [first_name, last_name]
+
+    @staticmethod
+    def property_entry(pk, name):
+        suggestion = {
+            "type": "property",
+            "pk": pk,
+            "label": name,
+            "search_term": "physical_property",
+            "search_text": name,
+        }
+        return suggestion, [name]
+
+    @classmethod
+    def keys(cls, suggestion, texts):
+        keys = set()
+        if suggestion["type"] in ("system", "dataset"):
+            keys.add(str(suggestion["pk"]))
+        for text in texts:
+            if text:
+                keys |= cls.words(text)
+        return keys
+
+    def _add(self, suggestion, texts):
+        kind, pk = suggestion["type"], suggestion["pk"]
+        keys = self.keys(suggestion, texts)
+        for key in keys:
+            bisect.insort(self._keys, (key, kind, pk))
+        self._entries[kind, pk] = (suggestion, keys)
+
+    def _discard(self, kind, pk):
+        entry = self._entries.pop((kind, pk), None)
+        if entry:
+            for key in entry[1]:
+                i = bisect.bisect_left(self._keys, (key, kind, pk))
+                del self._keys[i]
+
+    def _rebuild(self):
+        self._keys = []
+        self._entries = {}
+        entries = []
+        for row in models.System.objects.values_list("pk", "compound_name", "iupac"):
+            entries.append(self.system_entry(*row))
+        for row in models.Dataset.objects.values_list(
+            "pk", "system__compound_name", "primary_property__name"
+        ):
+            entries.append(self.dataset_entry(*row))
+        for row in models.Author.objects.values_list("pk", "first_name", "last_name"):
+            entries.append(self.author_entry(*row))
+        for row in models.Property.objects.values_list("pk", "name"):
+            entries.append(self.property_entry(*row))
+        for suggestion, texts in entries:
+            kind, pk = suggestion["type"], suggestion["pk"]
+            keys = self.keys(suggestion, texts)
+            self._entries[kind, pk] = (suggestion, keys)
+            self._keys.extend((key, kind, pk) for key in keys)
+        self._keys.sort()
+
+    def update(self, discard=(), add=()):
+        """Apply a change to the index and publish a new version.
+
+        discard is a list of (kind, pk) pairs, add a list of entries as
+        returned by the *_entry methods. Entries in add replace
+        existing entries of the same kind and primary key.
+
+        """
+        with self._lock:
+            current = self._version == utils.get_version(AUTOCOMPLETE_VERSION_KEY)
+            version = utils.increment_version(AUTOCOMPLETE_VERSION_KEY)
+            if not current:
+                return
+            for kind, pk in discard:
+                self._discard(kind, pk)
+            for suggestion, texts in add:
+                self._discard(suggestion["type"], suggestion["pk"])
+                self._add(suggestion, texts)
+            self._version = version
+
+    def suggest(self, prefix, limit=10):
+        """Return up to limit suggestions for the prefix."""
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            version = utils.get_version(AUTOCOMPLETE_VERSION_KEY)
+            if version != self._version:
+                self._rebuild()
+                self._version = version
+            suggestions = []
+            seen = set()
+            i = bisect.bisect_left(self._keys, (prefix,))
+            while i < len(self._keys) and len(suggestions) < limit:
+                key, kind, pk = self._keys[i]
+                if not key.startswith(prefix):
+                    break
+                if (kind, pk) not in seen:
+                    seen.add((kind, pk))
+                    suggestions.append(self._entries[kind, pk][0])
+                i += 1
+            return suggestions
+
+
+autocomplete_index = AutocompleteIndex()
+
+
+def searchable_formula(formula):
+    """Return the formula followed by its parts starting at each element.
+
+    The full-text index only matches the beginnings of words, so this
+    lets "Pb" find CsPbI3 through the word PbI3.
+
+    """
+    words = re.findall(r"\w+", formula)
+    parts = [
+        word[match.start() :]
+        for word in words
+        for match in re.finditer(ELEMENT_PATTERN, word)
+        if match.start() > 0
+    ]
+    return " ".join([formula] + list(dict.fromkeys(parts)))
+
+
+def update_search_document(system):
+    """Write the searchable text of a system to the full-text table."""
+    models.SystemSearchDocument.objects.update_or_create(
+        system=system,
+        defaults={
+            "formula": searchable_formula(system.formula),
+            "group": system.group,
+            "iupac": system.iupac,
+            "compound_name": system.compound_name,
+            "tags": " ".join(system.tags.values_list("tag", flat=True)),
+        },
+    )
+
+
+def search_documents(systems):
+    """Return the full-text rows of a queryset of systems unsaved."""
+    return [
+        models.SystemSearchDocument(
+            system=system,
+            formula=searchable_formula(system.formula),
+            group=system.group,
+            iupac=system.iupac,
+            compound_name=system.compound_name,
+            tags=" ".join(tag.tag for tag in system.tags.all()),
+        )
+        for system in systems.prefetch_related("tags")
+    ]
+
+
+def update_search_documents(systems):
+    """Same as update_search_document for a queryset of systems."""
+    documents = search_documents(systems)
+    with transaction.atomic():
+        models.SystemSearchDocument.objects.filter(
+            system__in=[x.system_id for x in documents]
+        ).delete()
+        models.SystemSearchDocument.objects.bulk_create(documents)
+
+
+def fulltext_search(text):
+    """Return primary keys of systems matching text, best match first.
+
+    Every word of text must match the beginning of a word in the
+    formula, alternate names, IUPAC name, compound name, or tags. At
+    most FULLTEXT_LIMIT matches are returned. Return None if the
+    database provides no full-text index.
+
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return []
+    if connection.vendor == "sqlite":
+        match = " ".join(f'"{word}"*' for word in words)
+        weights = ", ".join(str(x) for x in FULLTEXT_WEIGHTS)
+        sql = (
+            "SELECT rowid FROM materials_systemsearchdocument_fts "
+            "WHERE materials_systemsearchdocument_fts MATCH %s "
+            f"ORDER BY bm25(materials_systemsearchdocument_fts, {weights}) "
+            "LIMIT %s"
+        )
+        params = [match, FULLTEXT_LIMIT]
+    elif connection.vendor == "mysql":
+        match = " ".join(f"+{word}*" for word in words)
+        against = (
+            "MATCH(formula, `group`, iupac, compound_name, tags) "
+            "AGAINST (%s IN BOOLEAN MODE)"
+        )
+        sql = (
+            "SELECT system_id FROM materials_systemsearchdocument "
+            f"WHERE {against} ORDER BY {against} DESC LIMIT %s"
+        )
+        params = [match, match, FULLTEXT_LIMIT]
+    else:
+        return None
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+    except DatabaseError:
+        return None
+
+
+def in_given_order(queryset, pks):
+    """Restrict queryset to pks and keep the order of the list."""
+    if not pks:
+        return queryset.none()
+    rank = Case(
+        *[When(pk=pk, then=Value(i)) for i, pk in enumerate(pks)],
+        output_field=IntegerField(),
+    )
+    return queryset.filter(pk__in=pks).annotate(rank=rank).order_by("rank")
+
+
+def find_systems_by_text(text, queryset):
+    """Return systems of queryset matching text.
+
+    Results are ranked by the full-text index. If the index is not
+    available or finds nothing, which may happen when text is a
+    fragment from the middle of a formula that does not start at an
+    element, fall back to substring matching while keeping the ordering
+    of queryset. If that fails too, return names similar to text ranked
+    by trigram similarity.
+
+    """
+    pks = fulltext_search(text)
+    if pks:
+        return in_given_order(queryset, pks)
+    systems = queryset.filter(
+        Q(formula__icontains=text)
+        | Q(group__icontains=text)
+        | Q(iupac__icontains=text)
+        | Q(compound_name__icontains=text)
+    )
+    if systems.exists():
+        return systems
+    # Possibly misspelled
+    return in_given_order(queryset, [pk for pk, _ in trigram_index.find(text)])
+
+
+def value_ranges(dataset):
+    """Return the rows of the range search index for a data set unsaved."""
+    values = {models.NumericalValue.PRIMARY: [], models.NumericalValue.SECONDARY: []}
+    if dataset.primary_property.name not in UNRANGED_PROPERTIES:
+        for qualifier, value in models.NumericalValue.objects.filter(
+            datapoint__subset__dataset=dataset
+        ).values_list("qualifier", "value"):
+            values[qualifier].append(value)
+        values[models.NumericalValue.PRIMARY].extend(
+            models.PhaseTransition.objects.filter(subset__dataset=dataset).values_list(
+                "value", flat=True
+            )
+        )
+    properties = {
+        models.NumericalValue.PRIMARY: dataset.primary_property_id,
+        models.NumericalValue.SECONDARY: dataset.secondary_property_id,
+    }
+    ranges = []
+    for qualifier, qualifier_values in values.items():
+        if not qualifier_values or not properties[qualifier]:
+            continue
+        ranges.append(
+            models.DatasetValueRange(
+                dataset=dataset,
+                physical_property_id=properties[qualifier],
+                qualifier=qualifier,
+                minimum=min(qualifier_values),
+                maximum=max(qualifier_values),
+                representative=statistics.median(qualifier_values),
+                count=len(qualifier_values),
+                is_experimental=dataset.is_experimental,
+            )
+        )
+    return ranges
+
+
+def update_value_ranges(dataset):
+    """Rebuild the rows of the range search index for a data set."""
+    ranges = value_ranges(dataset)
+    with transaction.atomic():
+        models.DatasetValueRange.objects.filter(dataset=dataset).delete()
+        models.DatasetValueRange.objects.bulk_create(ranges)
+        utils.bump_version(CATALOG_VERSION_KEY)
+
+
+def find_datasets_in_range(
+    properties, minimum=None, maximum=None, is_experimental=None
+):
+    """Return primary keys of data sets with a value in the given range.
+
+    properties is a queryset or list of Property instances. Either
+    bound may be None. Only data sets whose value range covers the
+    whole search window without having a value at either end need to
+    be checked against the individual values.
+
+    """
+    ranges = models.DatasetValueRange.objects.filter(physical_property__in=properties)
+    if minimum is not None:
+        ranges = ranges.filter(maximum__gte=minimum)
+    if maximum is not None:
+        ranges = ranges.filter(minimum__lte=maximum)
+    if is_experimental is not None:
+        ranges = ranges.filter(is_experimental=is_experimental)
+    found = set()
+    uncertain = defaultdict(list)
+    for dataset_pk, qualifier, low, high, count in ranges.values_list(
+        "dataset_id", "qualifier", "minimum", "maximum", "count"
+    ):
+        if (
+            count > 1
+            and minimum is not None
+            and maximum is not None
+            and low < minimum
+            and high > maximum
+        ):
+            uncertain[qualifier].append(dataset_pk)
+        else:
+            found.add(dataset_pk)
+    for qualifier, dataset_pks in uncertain.items():
+        found.update(
+            models.NumericalValue.objects.filter(
+                datapoint__subset__dataset__in=dataset_pks,
+                qualifier=qualifier,
+                value__range=(minimum, maximum),
+            ).values_list("datapoint__subset__dataset_id", flat=True)
+        )
+        if qualifier == models.NumericalValue.PRIMARY:
+            found.update(
+                models.PhaseTransition.objects.filter(
+                    subset__dataset__in=dataset_pks, value__range=(minimum, maximum)
+                ).values_list("subset__dataset_id", flat=True)
+            )
+    return found
+
+
+class FacetedResults:
+    """Systems found by a search along with their facet values.
+
+    For each value of each facet (see FACETS) the set of systems having
+    that value is computed with a single grouped query over the
+    results. The sets are cached under a random token so that facet
+    selections can narrow the results, and the counts be recomputed,
+    without running the search again. Facets of data sets apply to
+    systems having at least one published data set with the given
+    value, so that the same results may be shared by all users.
+
+    """
+
+    def __init__(self, pks, postings, token=None):
+        self.pks = pks
+        # Facet name -> value -> (label, set of system primary keys)
+        self.postings = postings
+        self.token = token or uuid.uuid4().hex
+
+    @classmethod
+    def build(cls, pks):
+        pks = list(dict.fromkeys(pks))
+        postings = {name: {} for name, _, _ in FACETS}
+        rows = (
+            models.System.objects.filter(pk__in=pks)
+            .annotate(
+                published=FilteredRelation(
+                    "dataset", condition=Q(dataset__visible=True)
+                )
+            )
+            .values_list("pk", *[lookup for _, _, lookup in FACETS])
+            .distinct()
+        )
+        for pk, *values in rows:
+            for (name, _, _), value in zip(FACETS, values):
+                if value is None or value == "":
+                    continue
+                key = str(value)
+                if key not in postings[name]:
+                    label = FACET_LABELS.get(name, {}).get(value, value)
+                    postings[name][key] = (str(label), set())
+                postings[name][key][1].add(pk)
+        return cls(pks, postings)
+
+    @classmethod
+    def load(cls, token):
+        """Return cached results or None if they have expired."""
+        data = cache.get(f"{SEARCH_RESULTS_KEY}-{token}")
+        return cls(*data, token=token) if data else None
+
+    def save(self):
+        cache.set(
+            f"{SEARCH_RESULTS_KEY}-{self.token}",
+            (self.pks, self.postings),
+            SEARCH_RESULTS_TIMEOUT,
+        )
+
+    @staticmethod
+    def selected(facets):
+        """Parse facet selections of the form "name:value"."""
+        selected = {}
+        for facet in facets:
+            name, _, value = facet.partition(":")
+            selected.setdefault(name, set()).add(value)
+        return selected
+
+    def narrow(self, selected):
+        """Return primary keys of systems matching the selected values.
+
+        selected maps facet names to sets of values. Values of the same
+        facet are combined with OR, different facets with AND. The
+        order of the original results is kept.
+
+        """
+        return [self.pks[i] for i in self.narrow_positions(selected)]
+
+    def narrow_positions(self, selected):
+        """Same as narrow but return the positions in the original results.
+
+        These increase along the narrowed results and serve as the
+        ordering key of keyset_page.
+
+        """
+        matching = None
+        for name, keys in selected.items():
+            facet = self.postings.get(name, {})
+            union = set().union(*(facet[key][1] for key in keys if key in facet))
+            matching = union if matching is None else matching & union
+        if matching is None:
+            return list(range(len(self.pks)))
+        return [i for i, pk in enumerate(self.pks) if pk in matching]
+
+    def facets(self, pks, selected):
+        """Return facet values and their counts among the given systems.
+
+        The return value is a list of (name, title, values) where each
+        of values is (value, label, count, checked).
+
+        """
+        pks = set(pks)
+        facets = []
+        for name, title, _ in FACETS:
+            values = []
+            for key, (label, postings) in self.postings[name].items():
+                count = len(pks & postings)
+                checked = key in selected.get(name, ())
+                if count or checked:
+                    values.append((key, label, count, checked))
+            if values:
+                values.sort(key=lambda x: (-x[2], x[1]))
+                facets.append((name, title, values))
+        return facets
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def keyset_page(pks, keys, cursor=None, size=SEARCH_PAGE_SIZE):
+    """Return one page of search results and the cursors around it.
+
+    pks is the list of results in their final order and keys their
+    ordering keys, which increase along the list (see
+    FacetedResults.narrow_positions). A cursor is an opaque string
+    holding the key after which the next page starts or up to which the
+    previous page goes, and the page is found by bisection. Pages thus
+    do not shift when results are filtered out by facets, including the
+    result the cursor was taken from. Return the page and the cursors
+    of the previous and next pages, which are None on the first and
+    last pages.
+
+    """
+    start = 0
+    if cursor:
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if "after" in position:
+                start = bisect.bisect_right(keys, position["after"])
+            else:
+                start = max(bisect.bisect_right(keys, position["until"]) - size, 0)
+        except (ValueError, TypeError, KeyError):
+            raise ValueError("Invalid cursor. Please start from the first page.")
+    page = pks[start : start + size]
+    previous_cursor = next_cursor = None
+    if start > 0:
+        previous_cursor = encode_cursor({"until": keys[min(start, len(keys)) - 1]})
+    if start + size < len(pks):
+        next_cursor = encode_cursor({"after": keys[start + size - 1]})
+    return page, previous_cursor, next_cursor
+
+
+def result_cache_key(search_term, data):
+    """Return the cache key of a search in the current catalog version.
+
+    data are the cleaned data of the search form. Searches that differ
+    only in whitespace, or in case where case does not matter, share
+    the same key.
+
+    """
+    text = " ".join((data.get("search_text") or "").split())
+    if search_term in CASELESS_SEARCH_TERMS:
+        text = text.casefold()
+    parts = [search_term, text]
+    if search_term in ("band_gap", "property_range"):
+        physical_property = data.get("physical_property")
+        parts += [
+            data.get("minimum"),
+            data.get("maximum"),
+            data.get("is_experimental") or "",
+            physical_property.pk if physical_property else None,
+        ]
+    digest = hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+    version = utils.get_version(CATALOG_VERSION_KEY)
+    return f"{RESULT_CACHE_KEY}-{version}-{digest}"
+
+
+def _count(key):
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+def cached_results(key):
+    """Return the primary keys of cached search results or None."""
+    pks = cache.get(key)
+    _count(RESULT_CACHE_MISSES_KEY if pks is None else RESULT_CACHE_HITS_KEY)
+    return pks
+
+
+def cache_results(key, pks):
+    """Store the ordered primary keys found by a search."""
+    cache.set(key, list(pks), RESULT_CACHE_TIMEOUT)
+
+
+def result_cache_stats():
+    """Return the number of hits and misses of the search result cache."""
+    hits = cache.get(RESULT_CACHE_HITS_KEY, 0)
+    misses = cache.get(RESULT_CACHE_MISSES_KEY, 0)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / (hits + misses) if hits + misses else None,
+        "catalog_version": utils.get_version(CATALOG_VERSION_KEY),
+    }
+
+
+def normalize_name(name):
+    """Return name in lowercase without accents and punctuation."""
+    name = unicodedata.normalize("NFKD", name.casefold())
+    name = "".join(x for x in name if not unicodedata.combining(x))
+    return " ".join(re.findall(r"[^\W_]+", name))
+
+
+def name_initials(first_name):
+    """Return the initials of the first names, e.g., "jm" for Jean-Marc."""
+    return "".join(x[0] for x in normalize_name(first_name).split())
+
+
+def author_index(datasets=(), authors=()):
+    """Return the author index rows of the given data sets and authors unsaved."""
+    rows = []
+    for dataset in datasets:
+        for author in dataset.reference.authors.all():
+            rows.append((author, dataset))
+    for author in authors:
+        for dataset in models.Dataset.objects.filter(reference__authors=author):
+            rows.append((author, dataset))
+    return [
+        models.DatasetAuthorIndex(
+            author=author,
+            dataset=dataset,
+            system_id=dataset.system_id,
+            last_name=normalize_name(author.last_name)[:100],
+            initials=name_initials(author.first_name)[:20],
+        )
+        for author, dataset in dict.fromkeys(rows)
+    ]
+
+
+def update_author_index(datasets=(), authors=()):
+    """Rebuild the author index rows of the given data sets and authors."""
+    rows = author_index(datasets, authors)
+    with transaction.atomic():
+        models.DatasetAuthorIndex.objects.filter(
+            Q(dataset__in=[x.pk for x in datasets])
+            | Q(author__in=[x.pk for x in authors])
+        ).delete()
+        models.DatasetAuthorIndex.objects.bulk_create(rows)
+
+
+def find_by_author(text):
+    """Return the author index rows matching text.
+
+    text is either "Lastname, F." (the initials are optional and may be
+    just a prefix of the full list of initials) or a list of names of
+    which any may be the beginning of a last name. Accents, case, and
+    punctuation are ignored.
+
+    """
+    if "," in text:
+        last_name, _, first_names = text.partition(",")
+        query = Q(last_name=normalize_name(last_name))
+        initials = name_initials(first_names)
+        if initials:
+            query &= Q(initials__startswith=initials)
+    else:
+        keywords = normalize_name(text).split()
+        if not keywords:
+            return models.DatasetAuthorIndex.objects.none()
+        query = reduce(operator.or_, (Q(last_name__startswith=x) for x in keywords))
+    return models.DatasetAuthorIndex.objects.filter(query)
+
+
+# Symbols of the lattice constants as stored by submit_data
+LATTICE_SYMBOLS = {
+    "a": "a",
+    "b": "b",
+    "c": "c",
+    "α": "alpha",
+    "β": "beta",
+    "γ": "gamma",
+}
+LATTICE_PARAMETERS = ("a", "b", "c", "alpha", "beta", "gamma", "volume")
+
+
+def lattice_volume(a, b, c, alpha, beta, gamma):
+    """Return the volume of the unit cell (angles in degrees)."""
+    cosines = [math.cos(math.radians(x)) for x in (alpha, beta, gamma)]
+    product = cosines[0] * cosines[1] * cosines[2]
+    return a * b * c * math.sqrt(max(0, 1 - sum(x**2 for x in cosines) + 2 * product))
+
+
+def lattices(subsets):
+    """Return the lattice rows of the given subsets unsaved.
+
+    subsets is a list or queryset of subsets. Subsets without the full
+    set of lattice constants, i.e., anything but atomic structures,
+    are skipped.
+
+    """
+    rows = (
+        models.NumericalValue.objects.filter(
+            datapoint__subset__in=subsets,
+            datapoint__symbols__counter=0,
+            datapoint__symbols__value__in=LATTICE_SYMBOLS,
+        )
+        .values_list(
+            "datapoint__subset_id",
+            "datapoint__subset__dataset_id",
+            "datapoint__symbols__value",
+            "value",
+        )
+        .order_by("datapoint_id")
+    )
+    constants = {}
+    datasets = {}
+    for subset_pk, dataset_pk, symbol, value in rows:
+        # Case insensitive collations also return, e.g., element B
+        if symbol in LATTICE_SYMBOLS:
+            constants.setdefault(subset_pk, {}).setdefault(
+                LATTICE_SYMBOLS[symbol], value
+            )
+            datasets[subset_pk] = dataset_pk
+    return [
+        models.SubsetLattice(
+            subset_id=pk, dataset_id=datasets[pk], volume=lattice_volume(**x), **x
+        )
+        for pk, x in constants.items()
+        if len(x) == len(LATTICE_SYMBOLS)
+    ]
+
+
+def update_lattices(subsets):
+    """Create or replace the lattice rows of the given subsets.
+
+    See lattices. Return the number of rows written.
+
+    """
+    rows = lattices(subsets)
+    with transaction.atomic():
+        models.SubsetLattice.objects.filter(subset__in=subsets).delete()
+        models.SubsetLattice.objects.bulk_create(rows)
+        utils.bump_version(CATALOG_VERSION_KEY)
+    return len(rows)
+
+
+class LatticeQuery:
+    """Tolerance constraints on lattice parameters.
+
+    Each constraint is written as
+
+      a=8.9±0.1   a must be within 8.8 and 9.0
+      c=12.6±2%   c must be within 2% of 12.6
+      gamma=90    the default tolerance of 1% applies
+
+    Parameters are a, b, c, alpha (α), beta (β), gamma (γ), and volume
+    (V). Instead of ± one may write +- or ~. Several constraints are
+    separated by spaces or commas.
+
+    """
+
+    DEFAULT_TOLERANCE = "1%"
+    ALIASES = {"α": "alpha", "β": "beta", "γ": "gamma", "v": "volume"}
+    NUMBER = r"\d+(?:\.\d*)?|\.\d+"
+
+    def __init__(self):
+        # Parameter -> (lower bound, upper bound)
+        self.ranges = {}
+
+    @classmethod
+    def parse(cls, text):
+        query = cls()
+        text = re.sub(r"\s*(=|±|\+-|~)\s*", r"\1", text.strip())
+        for term in re.split(r"[\s,]+", text):
+            if term:
+                name, _, value = term.partition("=")
+                query.add(name, value)
+        if not query.ranges:
+            raise ValueError("Specify at least one lattice parameter, e.g. a=8.9±0.1.")
+        return query
+
+    @classmethod
+    def from_params(cls, params):
+        """Build the query from request parameters such as a=8.9~0.1."""
+        query = cls()
+        for name, value in params.items():
+            if name.lower() in LATTICE_PARAMETERS or name.lower() in cls.ALIASES:
+                query.add(name, value)
+        return query
+
+    def add(self, name, text):
+        parameter = self.ALIASES.get(name.lower(), name.lower())
+        m = re.fullmatch(
+            f"({self.NUMBER})(?:(?:±|\\+-|~)({self.NUMBER})(%)?)?", text.strip()
+        )
+        if parameter not in LATTICE_PARAMETERS or not m:
+            raise ValueError(f'Could not understand "{name}={text}".')
+        value, tolerance, percent = m.groups()
+        if tolerance is None:
+            tolerance, percent = self.DEFAULT_TOLERANCE[:-1], "%"
+        value, tolerance = float(value), float(tolerance)
+        if percent:
+            tolerance *= value / 100
+        self.ranges[parameter] = (value - tolerance, value + tolerance)
+
+    def filter(self, queryset):
+        """Restrict a SubsetLattice queryset to matching rows."""
+        return queryset.filter(
+            **{f"{name}__range": bounds for name, bounds in self.ranges.items()}
+        )
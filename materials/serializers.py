@@ -2,6 +2,7 @@
 from rest_framework import serializers
 
 from . import models
+from . import packing
 
 
 class BaseSerializer(serializers.ModelSerializer):
@@ -132,8 +133,15 @@ class FixedValueSerializer(BaseSerializer):
 
 
 class SubsetSerializer(BaseSerializer):
+    """Subset with its data points.
+
+    The values of packed subsets are taken from the arrays in
+    context["packed_values"] if given (see DatasetViewSet).
+
+    """
+
     crystal_system = serializers.CharField(source="get_crystal_system_display")
-    datapoints = DatapointSerializer(many=True)
+    datapoints = serializers.SerializerMethodField()
     fixed_values = FixedValueSerializer(many=True)
 
     class Meta:
@@ -147,6 +155,25 @@ class SubsetSerializer(BaseSerializer):
             "datapoints",
         )
 
+    def get_datapoints(self, subset):
+        arrays = self.context.get("packed_values", {}).get(subset.pk)
+        if arrays is None:
+            return DatapointSerializer(subset.datapoints.all(), many=True).data
+        axes = packing.format_arrays(arrays)
+        primary, secondary = (x for _, x in models.NumericalValue.QUALIFIER_TYPES)
+        x_first = arrays.get("x-first")
+        datapoints = []
+        for i, value in enumerate(axes.get("y", [])):
+            values = [{"qualifier": primary, "formatted": value}]
+            if "x" in axes:
+                # In the order of the rows, as the unpacked subsets
+                values.insert(
+                    0 if x_first is not None and x_first[i] else 1,
+                    {"qualifier": secondary, "formatted": axes["x"][i]},
+                )
+            datapoints.append({"values": values})
+        return datapoints
+
 
 class DatasetSerializer(BaseSerializer):
     sample_type = serializers.CharField(source="get_sample_type_display")
@@ -180,6 +207,25 @@ class DatasetSerializer(BaseSerializer):
         )
 
 
+class LatticeSerializer(serializers.ModelSerializer):
+    system = serializers.IntegerField(source="dataset.system_id")
+
+    class Meta:
+        model = models.SubsetLattice
+        fields = (
+            "subset",
+            "dataset",
+            "system",
+            "a",
+            "b",
+            "c",
+            "alpha",
+            "beta",
+            "gamma",
+            "volume",
+        )
+
+
 class DatasetSerializerInfo(serializers.ModelSerializer):
     sample_type = serializers.CharField(source="get_sample_type_display")
 
@@ -203,7 +249,20 @@ class DatasetSerializerInfo(serializers.ModelSerializer):
 
 
 class DatasetSerializerSummary(serializers.ModelSerializer):
+    """Data sets with the facts of DatasetSummary.
+
+    Use with Dataset.objects.with_summary() to read those from one row
+    per data set.
+
+    """
+
     sample_type = serializers.CharField(source="get_sample_type_display")
+    num_subsets = serializers.IntegerField(source="count_subsets")
+    num_datapoints = serializers.IntegerField(source="count_datapoints")
+    geometry_file = serializers.CharField(source="get_geometry_file_location")
+    fixed_temperatures = serializers.CharField(source="get_all_fixed_temperatures")
+    verified = serializers.BooleanField(source="is_verified")
+    representative_value = serializers.FloatField(source="get_representative_value")
 
     class Meta:
         model = models.Dataset
@@ -219,6 +278,12 @@ class DatasetSerializerSummary(serializers.ModelSerializer):
             "is_experimental",
             # "dimensionality",
             "sample_type",
+            "num_subsets",
+            "num_datapoints",
+            "geometry_file",
+            "fixed_temperatures",
+            "verified",
+            "representative_value",
         )
 
 
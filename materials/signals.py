@@ -1,14 +1,22 @@
 # This file is covered by the BSD license. See LICENSE in the root directory.
 from django.dispatch import receiver
+from django.db import transaction
 from django.db.models.signals import m2m_changed
 
 from . import models
 
+from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_save
 from .models import System, System_Stoichiometry, Stoichiometry_Elements
 from fractions import Fraction
 from decimal import Decimal, ROUND_HALF_UP
 import re
+from . import derived
+from . import search
+from .utils import bump_dataset_versions
+from .utils import bump_version
 from .utils import parse_formula
 
 
@@ -52,6 +60,44 @@ def create_stoichiometry_entries(sender, instance, created, **kwargs):
             )
 
 
+@receiver(post_save, sender=System)
+def update_system_search_document(sender, instance, **kwargs):
+    search.update_search_document(instance)
+
+
+@receiver(m2m_changed, sender=System.tags.through)
+def update_tagged_search_documents(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    """Keep the tags column of the full-text table up to date."""
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        search.update_search_document(instance)
+    elif pk_set:
+        for system in System.objects.filter(pk__in=pk_set):
+            search.update_search_document(system)
+
+
+@receiver(post_save, sender=models.Tag)
+def update_tag_search_documents(sender, instance, **kwargs):
+    for system in instance.system_set.all():
+        search.update_search_document(system)
+
+
+@receiver(pre_delete, sender=models.Tag)
+def remember_tagged_systems(sender, instance, **kwargs):
+    instance._tagged_system_pks = list(
+        instance.system_set.values_list("pk", flat=True)
+    )
+
+
+@receiver(post_delete, sender=models.Tag)
+def update_untagged_search_documents(sender, instance, **kwargs):
+    for system in System.objects.filter(pk__in=instance._tagged_system_pks):
+        search.update_search_document(system)
+
+
 @receiver(m2m_changed, sender=models.Dataset.linked_to.through)
 def interconnect_all_links(sender, **kwargs):
     """Make linking of data sets transitive.
@@ -71,3 +117,480 @@ def interconnect_all_links(sender, **kwargs):
                 dataset_j = all_datasets[j]
                 if dataset_j not in dataset_i.linked_to.all():
                     dataset_i.linked_to.add(dataset_j)
+
+
+@receiver(post_save, sender=System_Stoichiometry)
+@receiver(post_delete, sender=System_Stoichiometry)
+@receiver(post_save, sender=Stoichiometry_Elements)
+@receiver(post_delete, sender=Stoichiometry_Elements)
+def invalidate_composition_index(sender, **kwargs):
+    """Drop cached element posting lists in all worker processes."""
+    bump_version(search.COMPOSITION_VERSION_KEY)
+
+
+@receiver(pre_save, sender=models.Dataset)
+def remember_range_fields(sender, instance, raw, **kwargs):
+    if not raw and instance.pk is not None:
+        instance._range_fields = (
+            models.Dataset.objects.filter(pk=instance.pk)
+            .values_list(*search.RANGE_FIELDS)
+            .first()
+        )
+
+
+@receiver(post_save, sender=models.Dataset)
+def update_dataset_value_ranges(
+    sender, instance, created, raw, update_fields, **kwargs
+):
+    """Keep the range search index in sync with edits to a data set.
+
+    Only edits of the properties or the type of the data set change
+    the index. New data are indexed by submit_data once all values are
+    inserted.
+
+    """
+    if raw or created:
+        return
+    if update_fields is not None and not set(update_fields) & set(
+        search.RANGE_FIELDS
+    ):
+        return
+    fields = tuple(instance.serializable_value(x) for x in search.RANGE_FIELDS)
+    if fields != getattr(instance, "_range_fields", None):
+        search.update_value_ranges(instance)
+
+
+@receiver(pre_save, sender=models.Subset)
+def remember_subset_dataset(sender, instance, raw, **kwargs):
+    if not raw and instance.pk is not None:
+        instance._dataset_pk = (
+            models.Subset.objects.filter(pk=instance.pk)
+            .values_list("dataset", flat=True)
+            .first()
+        )
+
+
+@receiver(post_save, sender=models.Subset)
+def update_subset_value_ranges(sender, instance, created, raw, **kwargs):
+    """A subset may have been moved to another data set, e.g., in the admin.
+
+    New subsets have no values yet.
+
+    """
+    if not raw and not created:
+        derived.update_ranges_on_commit(
+            {instance.dataset_id, getattr(instance, "_dataset_pk", None)} - {None}
+        )
+
+
+@receiver(post_delete, sender=models.Subset)
+def discard_subset_value_ranges(sender, instance, **kwargs):
+    derived.update_ranges_on_commit([instance.dataset_id])
+
+
+@receiver(post_save, sender=models.Datapoint)
+@receiver(post_save, sender=models.NumericalValue)
+@receiver(post_save, sender=models.PhaseTransition)
+@receiver(post_delete, sender=models.PhaseTransition)
+def update_value_ranges_of_part(sender, instance, raw=False, **kwargs):
+    """Rebuild the ranges after edits of single values, e.g., in the admin.
+
+    Values inserted with bulk_create are indexed by submit_data.
+    Deleted data points and numerical values are handled by
+    DatapointQuerySet.delete and NumericalValueQuerySet.delete.
+
+    """
+    if raw:
+        return
+    if sender is models.NumericalValue:
+        subsets = models.Subset.objects.filter(datapoints=instance.datapoint_id)
+    else:
+        # The subset may already be gone if this is part of a cascade
+        subsets = models.Subset.objects.filter(pk=instance.subset_id)
+    derived.update_ranges_on_commit(subsets.values_list("dataset", flat=True))
+
+
+@receiver(post_save, sender=System)
+def update_system_suggestions(sender, instance, raw, **kwargs):
+    if raw:
+        return
+
+    def update():
+        index = search.autocomplete_index
+        entries = [
+            index.system_entry(instance.pk, instance.compound_name, instance.iupac)
+        ]
+        for pk, property_name in instance.dataset.values_list(
+            "pk", "primary_property__name"
+        ):
+            entries.append(
+                index.dataset_entry(pk, instance.compound_name, property_name)
+            )
+        index.update(add=entries)
+
+    transaction.on_commit(update)
+
+
+@receiver(post_save, sender=models.Dataset)
+def update_dataset_suggestions(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    entry = search.autocomplete_index.dataset_entry(
+        instance.pk, instance.system.compound_name, instance.primary_property.name
+    )
+    transaction.on_commit(lambda: search.autocomplete_index.update(add=[entry]))
+
+
+@receiver(post_save, sender=models.Author)
+def update_author_suggestions(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    entry = search.autocomplete_index.author_entry(
+        instance.pk, instance.first_name, instance.last_name
+    )
+    transaction.on_commit(lambda: search.autocomplete_index.update(add=[entry]))
+
+
+@receiver(post_save, sender=models.Property)
+def update_property_suggestions(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    entry = search.autocomplete_index.property_entry(instance.pk, instance.name)
+    transaction.on_commit(lambda: search.autocomplete_index.update(add=[entry]))
+
+
+@receiver(post_delete, sender=System)
+@receiver(post_delete, sender=models.Dataset)
+@receiver(post_delete, sender=models.Author)
+@receiver(post_delete, sender=models.Property)
+def discard_suggestions(sender, instance, **kwargs):
+    kind = {
+        System: "system",
+        models.Dataset: "dataset",
+        models.Author: "author",
+        models.Property: "property",
+    }[sender]
+    pk = instance.pk
+    transaction.on_commit(
+        lambda: search.autocomplete_index.update(discard=[(kind, pk)])
+    )
+
+
+@receiver(post_save, sender=Stoichiometry_Elements)
+@receiver(post_delete, sender=Stoichiometry_Elements)
+@receiver(post_delete, sender=System_Stoichiometry)
+def update_similarity_index(sender, instance, **kwargs):
+    if kwargs.get("raw"):
+        return
+    if sender is System_Stoichiometry:
+        system_pk = instance.system_id
+    else:
+        system_pk = (
+            System_Stoichiometry.objects.filter(pk=instance.system_stoichiometry_id)
+            .values_list("system_id", flat=True)
+            .first()
+        )
+    if system_pk is not None:
+        transaction.on_commit(lambda: search.similarity_index.update([system_pk]))
+
+
+@receiver(post_save, sender=System)
+def update_trigram_index(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    names = search.trigram_index.names(
+        instance.compound_name, instance.group, instance.iupac
+    )
+    pk = instance.pk
+    transaction.on_commit(lambda: search.trigram_index.update({pk: names}))
+
+
+@receiver(post_delete, sender=System)
+def discard_from_trigram_index(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: search.trigram_index.update({pk: None}))
+
+
+@receiver(post_save, sender=models.Dataset)
+def update_dataset_author_index(sender, instance, raw, **kwargs):
+    if not raw:
+        search.update_author_index(datasets=[instance])
+
+
+@receiver(post_save, sender=models.Author)
+def update_author_author_index(sender, instance, raw, **kwargs):
+    if not raw:
+        search.update_author_index(authors=[instance])
+
+
+@receiver(m2m_changed, sender=models.Author.references.through)
+def update_reference_author_index(sender, instance, action, reverse, **kwargs):
+    """Reindex when authors are attached to or removed from references."""
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if reverse:
+        search.update_author_index(datasets=instance.datasets.all())
+    else:
+        search.update_author_index(authors=[instance])
+
+
+@receiver(post_save, sender=System)
+@receiver(post_delete, sender=System)
+@receiver(post_save, sender=models.Dataset)
+@receiver(post_delete, sender=models.Dataset)
+@receiver(post_save, sender=models.Subset)
+@receiver(post_delete, sender=models.Subset)
+@receiver(post_save, sender=models.Reference)
+@receiver(post_delete, sender=models.Reference)
+@receiver(post_save, sender=models.Author)
+@receiver(post_delete, sender=models.Author)
+@receiver(post_save, sender=models.Tag)
+@receiver(post_delete, sender=models.Tag)
+@receiver(post_save, sender=models.Property)
+@receiver(post_delete, sender=models.Property)
+@receiver(post_save, sender=models.Unit)
+@receiver(post_delete, sender=models.Unit)
+@receiver(post_save, sender=System_Stoichiometry)
+@receiver(post_delete, sender=System_Stoichiometry)
+@receiver(post_save, sender=Stoichiometry_Elements)
+@receiver(post_delete, sender=Stoichiometry_Elements)
+@receiver(m2m_changed, sender=System.tags.through)
+@receiver(m2m_changed, sender=models.Author.references.through)
+def invalidate_search_results(sender, **kwargs):
+    """Make all processes search again instead of using cached results.
+
+    Edits of values are covered by their data set or subset, which are
+    saved or deleted along with them, and by update_value_ranges.
+
+    """
+    bump_version(search.CATALOG_VERSION_KEY)
+
+
+@receiver(post_save, sender=models.Dataset)
+@receiver(post_delete, sender=models.Dataset)
+def invalidate_dataset_cards(sender, instance, **kwargs):
+    """Rerender the data set and those that show its property.
+
+    Cards show the number of entries for the same system and property
+    and the properties of linked data sets.
+
+    """
+    pks = [instance.pk]
+    pks += models.Dataset.objects.filter(
+        system=instance.system_id, primary_property=instance.primary_property_id
+    ).values_list("pk", flat=True)
+    pks += models.Dataset.objects.filter(linked_to=instance.pk).values_list(
+        "pk", flat=True
+    )
+    bump_dataset_versions(pks)
+
+
+@receiver(m2m_changed, sender=models.Dataset.linked_to.through)
+@receiver(m2m_changed, sender=models.Dataset.verified_by.through)
+def invalidate_linked_dataset_cards(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if sender is models.Dataset.linked_to.through:
+        pks = {instance.pk, *(pk_set or ())}
+        if action == "pre_clear":
+            pks.update(instance.linked_to.values_list("pk", flat=True))
+    elif reverse:
+        # instance is a user who verified the data sets in pk_set
+        pks = pk_set or instance.dataset_set.values_list("pk", flat=True)
+    else:
+        pks = [instance.pk]
+    bump_dataset_versions(pks)
+
+
+@receiver(post_save, sender=models.Subset)
+@receiver(post_delete, sender=models.Subset)
+@receiver(post_save, sender=models.SynthesisMethod)
+@receiver(post_delete, sender=models.SynthesisMethod)
+@receiver(post_save, sender=models.ExperimentalDetails)
+@receiver(post_delete, sender=models.ExperimentalDetails)
+@receiver(post_save, sender=models.ComputationalDetails)
+@receiver(post_delete, sender=models.ComputationalDetails)
+@receiver(post_save, sender=models.AdditionalFile)
+@receiver(post_delete, sender=models.AdditionalFile)
+@receiver(post_save, sender=models.InputDataFile)
+@receiver(post_delete, sender=models.InputDataFile)
+def invalidate_dataset_card(sender, instance, **kwargs):
+    bump_dataset_versions([instance.dataset_id])
+
+
+@receiver(post_save, sender=models.NumericalValueFixed)
+@receiver(post_delete, sender=models.NumericalValueFixed)
+@receiver(post_save, sender=models.PhaseTransition)
+@receiver(post_delete, sender=models.PhaseTransition)
+def invalidate_subset_card(sender, instance, **kwargs):
+    # The subset may already be gone if this is part of a cascade
+    bump_dataset_versions(
+        models.Subset.objects.filter(pk=instance.subset_id).values_list(
+            "dataset", flat=True
+        )
+    )
+
+
+@receiver(post_save, sender=models.NumericalValue)
+@receiver(post_save, sender=models.Symbol)
+def invalidate_datapoint_card(sender, instance, **kwargs):
+    """Rerender after edits of single values, e.g., in the admin.
+
+    Deletions are covered by the subset or data set that is deleted.
+
+    """
+    bump_dataset_versions(
+        models.Subset.objects.filter(datapoints=instance.datapoint_id).values_list(
+            "dataset", flat=True
+        )
+    )
+
+
+@receiver(post_save, sender=models.Error)
+@receiver(post_save, sender=models.UpperBound)
+def invalidate_error_card(sender, instance, **kwargs):
+    bump_dataset_versions(
+        models.Subset.objects.filter(
+            datapoints__values=instance.numerical_value_id
+        ).values_list("dataset", flat=True)
+    )
+
+
+@receiver(post_save, sender=models.Comment)
+@receiver(post_delete, sender=models.Comment)
+@receiver(post_save, sender=models.ExternalRepository)
+@receiver(post_delete, sender=models.ExternalRepository)
+def invalidate_details_card(sender, instance, **kwargs):
+    pks = []
+    for model, field in (
+        (models.SynthesisMethod, "synthesis_method_id"),
+        (models.ExperimentalDetails, "experimental_details_id"),
+        (models.ComputationalDetails, "computational_details_id"),
+    ):
+        pk = getattr(instance, field, None)
+        if pk is not None:
+            pks += model.objects.filter(pk=pk).values_list("dataset", flat=True)
+    bump_dataset_versions(pks)
+
+
+@receiver(post_save, sender=System)
+def invalidate_system_cards(sender, instance, **kwargs):
+    bump_dataset_versions(instance.dataset.values_list("pk", flat=True))
+
+
+@receiver(post_save, sender=models.Reference)
+def invalidate_reference_cards(sender, instance, **kwargs):
+    bump_dataset_versions(instance.datasets.values_list("pk", flat=True))
+
+
+@receiver(post_save, sender=models.Author)
+def invalidate_author_cards(sender, instance, **kwargs):
+    bump_dataset_versions(
+        models.Dataset.objects.filter(reference__authors=instance).values_list(
+            "pk", flat=True
+        )
+    )
+
+
+@receiver(m2m_changed, sender=models.Author.references.through)
+def invalidate_authorship_cards(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if reverse:
+        # instance is the reference
+        datasets = instance.datasets.all()
+    else:
+        references = pk_set or instance.references.values_list("pk", flat=True)
+        datasets = models.Dataset.objects.filter(reference__in=list(references))
+    bump_dataset_versions(datasets.values_list("pk", flat=True))
+
+
+@receiver(post_save, sender=models.Datapoint)
+@receiver(post_save, sender=models.NumericalValue)
+@receiver(post_save, sender=models.Error)
+@receiver(post_save, sender=models.UpperBound)
+def discard_packed_values(sender, instance, **kwargs):
+    """Read the subset from the rows again after edits of single values.
+
+    Values inserted with bulk_create are packed by submit_data. There
+    are no receivers of post_delete for these tables, which would run
+    for every row and keep Django from fast-deleting them. Deleted
+    subsets take their packed values with them, and deleting data
+    points is handled by DatapointQuerySet.delete.
+
+    """
+    if sender is models.Datapoint:
+        subsets = models.PackedSubset.objects.filter(subset=instance.subset_id)
+    elif sender is models.NumericalValue:
+        subsets = models.PackedSubset.objects.filter(
+            subset__datapoints=instance.datapoint_id
+        )
+    else:
+        subsets = models.PackedSubset.objects.filter(
+            subset__datapoints__values=instance.numerical_value_id
+        )
+    subsets.delete()
+
+
+@receiver(post_delete, sender=models.PackedSubset)
+def delete_packed_file(sender, instance, **kwargs):
+    """Remove the file once the deletion of the row is committed.
+
+    If the transaction is rolled back instead, the row still needs it.
+
+    """
+    if instance.data_file:
+        storage, name = instance.data_file.storage, instance.data_file.name
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+@receiver(post_save, sender=models.Dataset)
+def update_dataset_summary(sender, instance, raw, **kwargs):
+    """Runs after update_dataset_value_ranges, whose ranges are summarized."""
+    if not raw:
+        derived.update_summaries([instance.pk])
+
+
+@receiver(post_save, sender=models.Subset)
+@receiver(post_save, sender=models.AdditionalFile)
+def update_summary_of_part(sender, instance, raw, **kwargs):
+    if not raw:
+        derived.update_summaries([instance.dataset_id])
+
+
+@receiver(post_delete, sender=models.Subset)
+@receiver(post_delete, sender=models.AdditionalFile)
+def discard_summary_of_part(sender, instance, **kwargs):
+    derived.update_summaries_on_commit([instance.dataset_id])
+
+
+@receiver(post_save, sender=models.Datapoint)
+@receiver(post_save, sender=models.NumericalValueFixed)
+def update_summary_of_subset(sender, instance, raw, **kwargs):
+    if not raw:
+        derived.update_summaries(
+            models.Subset.objects.filter(pk=instance.subset_id).values_list(
+                "dataset", flat=True
+            )
+        )
+
+
+@receiver(m2m_changed, sender=models.Dataset.verified_by.through)
+def update_verified_summaries(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        derived.update_summaries([instance.pk])
+    elif pk_set:
+        derived.update_summaries(pk_set)
+    else:
+        # A user's verifications were cleared, which may be any data set
+        derived.update_summaries_on_commit(
+            models.DatasetSummary.objects.filter(verified=True).values_list(
+                "dataset", flat=True
+            )
+        )
@@ -0,0 +1,37 @@
+'use strict';
+
+// Fetch numerical data in the binary representation (see
+// utils.pack_arrays). The promise resolves to the JSON header, with
+// "arrays" replaced by the typed arrays keyed by their names. Typed
+// arrays use the byte order of the platform, which is little-endian
+// on all platforms that browsers run on.
+const typed_arrays = {
+  float64: Float64Array,
+  float32: Float32Array,
+  uint8: Uint8Array,
+};
+
+function unpack_arrays(buffer) {
+  const header_length = new DataView(buffer).getUint32(0, true);
+  const header = JSON.parse(
+    new TextDecoder().decode(new Uint8Array(buffer, 4, header_length)));
+  const arrays = {};
+  let offset = 4 + header_length;
+  for (let array of header['arrays']) {
+    const type = typed_arrays[array['dtype']];
+    arrays[array['name']] = new type(buffer, offset, array['length']);
+    offset += Math.ceil(array['length'] * type.BYTES_PER_ELEMENT / 8) * 8;
+  }
+  header['arrays'] = arrays;
+  return header;
+}
+
+function get_arrays(url, params) {
+  return axios
+    .get(url, {
+      params: params,
+      responseType: 'arraybuffer',
+      headers: {'Accept': 'application/octet-stream'},
+    })
+    .then(response => unpack_arrays(response['data']));
+}
@@ -1,11 +1,15 @@
 'use strict';
 
-for (let element of document.getElementsByClassName('delete-button')) {
-  element.addEventListener('click', function() {
-    if (confirm(
-      'Are you sure you want to remove this data set from the ' +
-      'database?')) {
-      window.open(this.getAttribute('data-reverse-url'), '_top');
-    }
-  });
+function add_delete_buttons(root) {
+  for (let element of root.getElementsByClassName('delete-button')) {
+    element.addEventListener('click', function() {
+      if (confirm(
+        'Are you sure you want to remove this data set from the ' +
+        'database?')) {
+        window.open(this.getAttribute('data-reverse-url'), '_top');
+      }
+    });
+  }
 }
+
+add_delete_buttons(document);
@@ -1,24 +1,57 @@
 'use strict';
 
-for (let table_body of
-  document.querySelectorAll('tbody[class="tabulated-data"]')) {
-  const subset_pk = table_body.id.split('-')[1];
-  axios
-    .get('/materials/get-subset-values/' + subset_pk)
+// Same as NumericalValue.formatted in the materials app. name is the
+// name of the array of values, e.g., "12-y" for the y-values of
+// subset 12.
+function format_value(response, name, i) {
+  const arrays = response['arrays'];
+  const format_number = value =>
+    Number.isInteger(value) ? value.toFixed(1) : String(value);
+  let text = response['value-types'][arrays[name + '-type'][i]] +
+             format_number(arrays[name][i]);
+  const error = arrays[name + '-error'];
+  if (error && !isNaN(error[i])) {
+    text += ' (±' + format_number(error[i]) + ')';
+  }
+  const upper = arrays[name + '-upper'];
+  if (upper && !isNaN(upper[i])) {
+    text += '...' + format_number(upper[i]);
+  }
+  return text;
+}
+
+// Fill in all tables of values below root with a single request
+function fetch_subset_values(root) {
+  const table_bodies = {};
+  for (let table_body of
+    root.querySelectorAll('tbody[class="tabulated-data"]')) {
+    table_bodies[table_body.id.split('-')[1]] = table_body;
+  }
+  const subset_pks = Object.keys(table_bodies);
+  if (subset_pks.length === 0) {
+    return;
+  }
+  get_arrays('/materials/get-subset-values',
+             {subsets: subset_pks.join(',')})
     .then(response => {
-      let data = response['data'];
-      const table = document.createElement('table');
-      for (let value of data) {
-        let tr = document.createElement('tr');
-        let td = document.createElement('td');
-        if ('x' in value) {
-          td.innerHTML = value['x'];
+      const arrays = response['arrays'];
+      for (let subset_pk of response['subsets']) {
+        const table_body = table_bodies[subset_pk];
+        const num_rows = (arrays[subset_pk + '-y'] || []).length;
+        for (let i = 0; i < num_rows; i++) {
+          let tr = document.createElement('tr');
+          let td = document.createElement('td');
+          if (subset_pk + '-x' in arrays) {
+            td.innerHTML = format_value(response, subset_pk + '-x', i);
+            tr.append(td);
+          }
+          td = document.createElement('td');
+          td.innerHTML = format_value(response, subset_pk + '-y', i);
           tr.append(td);
+          table_body.append(tr);
         }
-        td = document.createElement('td');
-        td.innerHTML = value['y'];
-        tr.append(td);
-        table_body.append(tr);
       }
     });
 }
+
+fetch_subset_values(document);
@@ -0,0 +1,30 @@
+'use strict';
+
+// Fetch the bodies of data set cards (class="lazy-card") when they are
+// scrolled into view and set up their charts, tables, and buttons.
+function load_card(element) {
+  axios
+    .get(element.dataset.url)
+    .then(response => {
+      element.innerHTML = response['data'];
+      plot_charts(element);
+      fetch_subset_values(element);
+      add_expand_hide_buttons(element);
+      add_atomic_coordinates_buttons(element);
+      add_verify_buttons(element);
+      element.dispatchEvent(new CustomEvent('card-loaded', {bubbles: true}));
+    });
+}
+
+const card_observer = new IntersectionObserver((entries, observer) => {
+  for (let entry of entries) {
+    if (entry.isIntersecting) {
+      observer.unobserve(entry.target);
+      load_card(entry.target);
+    }
+  }
+}, {rootMargin: '200px'});
+
+for (let element of document.getElementsByClassName('lazy-card')) {
+  card_observer.observe(element);
+}
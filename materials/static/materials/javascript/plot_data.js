@@ -44,16 +44,30 @@ function plot_data(element, data, x_property, x_unit, y_property, y_unit) {
   });
 }
 
-for (let element of document.getElementsByTagName('canvas')) {
-  const plot_id = element.id;
-  const plot_pk = plot_id.split('_')[1];
-  axios
-    .get('/materials/data-for-chart/' + plot_pk)
-    .then(response => {
-      plot_data(plot_id, response['data']['data'],
-                response['data']['secondary-property'],
-                response['data']['secondary-unit'],
-                response['data']['primary-property'],
-                response['data']['primary-unit']);
-    });
+// Longer curves are downsampled by the server
+const max_chart_points = 2000;
+
+function plot_charts(root) {
+  for (let element of root.getElementsByTagName('canvas')) {
+    const plot_id = element.id;
+    const plot_pk = plot_id.split('_')[1];
+    get_arrays('/materials/data-for-chart/' + plot_pk,
+               {max_points: max_chart_points})
+      .then(response => {
+        const arrays = response['arrays'];
+        for (let i = 0; i < response['data'].length; i++) {
+          const x = arrays['x-' + i];
+          const y = arrays['y-' + i];
+          response['data'][i]['values'] =
+            Array.from(x, (x_value, j) => ({x: x_value, y: y[j]}));
+        }
+        plot_data(plot_id, response['data'],
+                  response['secondary-property'],
+                  response['secondary-unit'],
+                  response['primary-property'],
+                  response['primary-unit']);
+      });
+  }
 }
+
+plot_charts(document);
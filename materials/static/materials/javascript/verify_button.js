@@ -1,9 +1,13 @@
 'use strict';
 
-for (let element of document.getElementsByClassName('verify-button')) {
-  element.addEventListener('click', function() {
-    if (confirm('Have you verified the correctness of the data?')) {
-      window.open(this.getAttribute('data-reverse-url'), '_top');
-    }
-  });
+function add_verify_buttons(root) {
+  for (let element of root.getElementsByClassName('verify-button')) {
+    element.addEventListener('click', function() {
+      if (confirm('Have you verified the correctness of the data?')) {
+        window.open(this.getAttribute('data-reverse-url'), '_top');
+      }
+    });
+  }
 }
+
+add_verify_buttons(document);
@@ -3,15 +3,32 @@ from selenium import webdriver
 from selenium.common.exceptions import NoAlertPresentException
 from selenium.webdriver.common.keys import Keys
 from time import sleep
+import io
+import json
+import numpy
 import os
 import shutil
+import tempfile
+from unittest import mock
 
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models.signals import post_delete
 from django.shortcuts import reverse
 from django.test import LiveServerTestCase
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
+from . import derived
 from . import models
+from . import packing
+from . import search
+from . import utils
+from .apps import check_shared_cache
 from accounts.tests import USERNAME
 from accounts.tests import PASSWORD
 
@@ -41,6 +58,10 @@ class ModelsTestCase(TestCase):
         "datasets.json",
     ]
 
+    def setUp(self):
+        # Rendered data set cards may be from rolled back tests
+        cache.clear()
+
     @classmethod
     def setUpTestData(cls):
         """Start with three data sets of different property"""
@@ -115,6 +136,1110 @@ class ModelsTestCase(TestCase):
         response = self.client.get(redirect.url)
         self.assertContains(response, "Verified")
 
+    def test_dataset_pages_queries(self):
+        """Query counts must not grow with the number of data sets."""
+        user = User.objects.get(pk=1)
+        atomic_structure = models.Dataset.objects.get(primary_property__pk=3)
+        subset = atomic_structure.subsets.create(created_by=user, crystal_system=3)
+        for symbol, value in zip("abcαβγ", (8.9, 8.9, 12.6, 90, 90, 90)):
+            datapoint = subset.datapoints.create(created_by=user)
+            datapoint.symbols.create(created_by=user, value=symbol)
+            datapoint.values.create(created_by=user, value=value)
+
+        def add_dataset(name):
+            dataset = models.Dataset.objects.get(pk=1)
+            dataset.pk = None
+            dataset.primary_property = models.Property.objects.create(
+                name=name, created_by=user
+            )
+            dataset.save()
+            dataset.linked_to.add(atomic_structure)
+            dataset.verified_by.add(user)
+            dataset.synthesis.create(created_by=user, system=dataset.system)
+            for _ in range(2):
+                subset = dataset.subsets.create(created_by=user, crystal_system=3)
+                subset.fixed_values.create(
+                    created_by=user,
+                    physical_property=models.Property.objects.get(pk=2),
+                    unit=models.Unit.objects.get(pk=3),
+                    value=1.0,
+                )
+                subset.datapoints.create(created_by=user).values.create(
+                    created_by=user, value=1.0
+                )
+
+        def count_queries(url):
+            # Render all data set cards again
+            utils.bump_dataset_versions(
+                models.Dataset.objects.values_list("pk", flat=True)
+            )
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        urls = [
+            reverse("materials:system", kwargs={"pk": 1}),
+            reverse("materials:reference", kwargs={"pk": 1}),
+            reverse("materials:linked_data", kwargs={"pk": atomic_structure.pk}),
+            reverse(
+                "materials:property_all_entries",
+                kwargs={"system_pk": 1, "prop_pk": 3},
+            ),
+            reverse("materials:dataset", kwargs={"pk": atomic_structure.pk}),
+        ]
+        add_dataset("first property")
+        # The first request also builds in-process search indexes
+        count_queries(urls[0])
+        counts = [count_queries(url) for url in urls]
+        add_dataset("second property")
+        add_dataset("third property")
+        self.assertEqual([count_queries(url) for url in urls], counts)
+        response = self.client.get(urls[0])
+        self.assertContains(response, "<td>8.9 eV</td>")
+
+    def test_dataset_card_cache(self):
+        user = User.objects.get(pk=1)
+        dataset = models.Dataset.objects.get(pk=1)
+        subset = dataset.subsets.create(created_by=user, crystal_system=3)
+        value = subset.fixed_values.create(
+            created_by=user,
+            physical_property=models.Property.objects.get(pk=2),
+            unit=models.Unit.objects.get(pk=3),
+            value=1.5,
+        )
+        url = reverse("materials:system", kwargs={"pk": 1})
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get(url), "pressure = 1.5 GPa")
+        misses = len(queries)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get(url), "pressure = 1.5 GPa")
+        self.assertLess(len(queries), misses)
+        value.value = 2.5
+        value.save()
+        self.assertContains(self.client.get(url), "pressure = 2.5 GPa")
+        # Cards are shared, but the parts that depend on the user are not
+        self.assertContains(self.client.get(url), "You must be logged in")
+        self.client.force_login(user)
+        response = self.client.get(url)
+        self.assertContains(response, "pressure = 2.5 GPa")
+        self.assertNotContains(response, "You must be logged in")
+        self.assertContains(response, "Unpublish")
+
+    def test_hidden_datasets(self):
+        owner = User.objects.get(pk=1)
+        dataset = models.Dataset.objects.get(pk=1)
+        dataset.visible = False
+        dataset.save()
+        self.assertFalse(
+            models.Dataset.objects.visible_to(AnonymousUser()).filter(pk=1)
+        )
+        self.assertEqual(
+            list(models.Dataset.objects.visible_to(owner).filter(pk=1)), [dataset]
+        )
+        self.assertFalse(
+            models.Dataset.objects.visible_to(User.objects.get(pk=2)).filter(pk=1)
+        )
+        url = reverse("materials:system", kwargs={"pk": 1})
+        self.assertNotContains(self.client.get(url), "Band gap")
+        response = self.client.get("/materials/datasets/")
+        self.assertNotIn(1, [x["pk"] for x in response.json()["results"]])
+        chart_url = reverse("materials:data_for_chart", kwargs={"pk": 1})
+        self.assertEqual(self.client.get(chart_url).status_code, 404)
+        self.client.force_login(owner)
+        self.assertContains(self.client.get(url), "Band gap")
+        response = self.client.get("/materials/datasets/")
+        self.assertIn(1, [x["pk"] for x in response.json()["results"]])
+
+    def test_bulk_counts(self):
+        user = User.objects.get(pk=1)
+        dataset = models.Dataset.objects.get(pk=1)
+        dataset.pk = None
+        dataset.save()
+        published = models.Dataset.objects.get(pk=1).num_all_entries()
+        # Unpublished data sets are not counted, whoever views the card
+        models.Dataset.objects.filter(pk=dataset.pk).update(visible=False)
+        self.assertEqual(
+            models.Dataset.objects.get(pk=1).num_all_entries(), published - 1
+        )
+        datasets = list(models.Dataset.objects.order_by("pk"))
+        with self.assertNumQueries(1):
+            models.count_all_entries(datasets)
+        self.assertEqual(datasets[0].num_all_entries(), published - 1)
+        for dataset in datasets:
+            self.assertEqual(
+                dataset.all_entries,
+                models.Dataset.objects.filter(
+                    system=dataset.system,
+                    primary_property=dataset.primary_property,
+                    visible=True,
+                ).count(),
+            )
+        small = dataset.subsets.create(created_by=user, crystal_system=3)
+        large = dataset.subsets.create(created_by=user, crystal_system=3)
+        for _ in range(7):
+            large.datapoints.create(created_by=user)
+        subsets = list(dataset.subsets.with_num_datapoints().order_by("pk"))
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [str(x) for x in subsets],
+                [f"ID: {small.pk} (0 data points)", f"ID: {large.pk} (7 data points)"],
+            )
+        self.assertFalse(small.first_with_atomic_coordinates())
+        with self.assertNumQueries(1):
+            self.assertTrue(large.first_with_atomic_coordinates())
+
+    def test_data_for_chart(self):
+        user = User.objects.get(pk=1)
+        dataset = models.Dataset.objects.get(pk=1)
+        dataset.secondary_property = models.Property.objects.get(pk=2)
+        dataset.save()
+        curves = []
+        for label in ("first", "second"):
+            subset = dataset.subsets.create(
+                created_by=user, crystal_system=3, label=label
+            )
+            subset.fixed_values.create(
+                created_by=user,
+                physical_property=models.Property.objects.get(pk=4),
+                unit=models.Unit.objects.get(pk=4),
+                value=300,
+            )
+            curve = [(x, x ** 2 if label == "first" else -x) for x in range(50)]
+            for x, y in curve:
+                datapoint = subset.datapoints.create(created_by=user)
+                datapoint.values.create(
+                    created_by=user, value=x, qualifier=models.NumericalValue.SECONDARY
+                )
+                datapoint.values.create(created_by=user, value=y)
+            curves.append(curve)
+        url = reverse("materials:data_for_chart", kwargs={"pk": 1})
+        with self.assertNumQueries(4):
+            data = self.client.get(url).json()
+        self.assertEqual(data["secondary-property"], "pressure")
+        labels = [
+            "first: phase transition temperature = 300.0 K (tetragonal)",
+            "second: phase transition temperature = 300.0 K (tetragonal)",
+        ]
+        self.assertEqual([x["subset-label"] for x in data["data"]], labels)
+        for subset, curve in zip(data["data"], curves):
+            self.assertEqual([(x["x"], x["y"]) for x in subset["values"]], curve)
+        data = self.client.get(url, {"max_points": 10}).json()
+        for subset, curve in zip(data["data"], curves):
+            points = [(x["x"], x["y"]) for x in subset["values"]]
+            self.assertEqual(len(points), 10)
+            self.assertEqual(points[0], curve[0])
+            self.assertEqual(points[-1], curve[-1])
+            self.assertTrue(set(points) <= set(curve))
+        response = self.client.get(
+            url, {"dtype": "float32"}, HTTP_ACCEPT="application/octet-stream"
+        )
+        self.assertEqual(response["Content-Type"], "application/octet-stream")
+        binary = utils.unpack_arrays(response.content)
+        self.assertEqual(binary["data"], [{"subset-label": x} for x in labels])
+        for i_subset, curve in enumerate(curves):
+            x = binary["arrays"][f"x-{i_subset}"]
+            y = binary["arrays"][f"y-{i_subset}"]
+            self.assertEqual(x.dtype, numpy.float32)
+            self.assertEqual(list(zip(x, y)), curve)
+        self.assertNotEqual(response["ETag"], self.client.get(url)["ETag"])
+
+    def test_subset_values(self):
+        user = User.objects.get(pk=1)
+        subset = models.Dataset.objects.get(pk=1).subsets.create(
+            created_by=user, crystal_system=3
+        )
+        for x, y in ((1.0, 2.5), (2.0, 3.5)):
+            datapoint = subset.datapoints.create(created_by=user)
+            datapoint.values.create(
+                created_by=user, value=x, qualifier=models.NumericalValue.SECONDARY
+            )
+            value = datapoint.values.create(
+                created_by=user, value=y, value_type=models.NumericalValue.APPROXIMATE
+            )
+        models.Error.objects.create(created_by=user, numerical_value=value, value=0.1)
+        url = reverse("materials:get_subset_values", kwargs={"pk": subset.pk})
+        self.assertEqual(
+            self.client.get(url).json(),
+            [{"y": "≈2.5", "x": "1.0"}, {"y": "≈3.5 (±0.1)", "x": "2.0"}],
+        )
+        response = self.client.get(url, HTTP_ACCEPT="application/octet-stream")
+        binary = utils.unpack_arrays(response.content)
+        self.assertEqual(binary["value-types"], ["", "≈", ">", "<"])
+        arrays = binary["arrays"]
+        self.assertEqual(list(arrays["x"]), [1.0, 2.0])
+        self.assertEqual(list(arrays["y"]), [2.5, 3.5])
+        self.assertEqual(list(arrays["y-type"]), [1, 1])
+        self.assertTrue(numpy.isnan(arrays["y-error"][0]))
+        self.assertEqual(arrays["y-error"][1], 0.1)
+        self.assertNotIn("x-error", arrays)
+        self.assertNotIn("y-upper", arrays)
+        other = models.Dataset.objects.get(pk=2).subsets.create(
+            created_by=user, crystal_system=3
+        )
+        other.datapoints.create(created_by=user).values.create(
+            created_by=user, value=7.0
+        )
+        url = reverse("materials:get_subsets_values")
+        subsets = f"{subset.pk},{other.pk},{other.pk + 1}"
+        # One query for the ETag, one for packed values, and one for the rest
+        with self.assertNumQueries(3):
+            data = self.client.get(url, {"subsets": subsets}).json()
+        self.assertEqual(
+            data,
+            {
+                str(subset.pk): [
+                    {"y": "≈2.5", "x": "1.0"},
+                    {"y": "≈3.5 (±0.1)", "x": "2.0"},
+                ],
+                str(other.pk): [{"y": "7.0"}],
+            },
+        )
+        response = self.client.get(
+            url, {"subsets": subsets}, HTTP_ACCEPT="application/octet-stream"
+        )
+        binary = utils.unpack_arrays(response.content)
+        self.assertEqual(binary["subsets"], [subset.pk, other.pk])
+        self.assertEqual(list(binary["arrays"][f"{subset.pk}-x"]), [1.0, 2.0])
+        self.assertEqual(list(binary["arrays"][f"{other.pk}-y"]), [7.0])
+        self.assertNotIn(f"{other.pk}-x", binary["arrays"])
+        self.assertEqual(self.client.get(url, {"subsets": "1,a"}).status_code, 400)
+
+    def test_packed_values(self):
+        user = User.objects.get(pk=1)
+        dataset = models.Dataset.objects.get(pk=1)
+        dataset.secondary_property = models.Property.objects.get(pk=2)
+        dataset.save()
+        subset = dataset.subsets.create(created_by=user, crystal_system=3)
+        for x, y in ((1.0, 2.5), (2.0, 3.5), (3.0, 1.5)):
+            datapoint = subset.datapoints.create(created_by=user)
+            values = [
+                models.NumericalValue(
+                    created_by=user,
+                    datapoint=datapoint,
+                    value=x,
+                    qualifier=models.NumericalValue.SECONDARY,
+                ),
+                models.NumericalValue(
+                    created_by=user,
+                    datapoint=datapoint,
+                    value=y,
+                    value_type=models.NumericalValue.LOWER_BOUND,
+                ),
+            ]
+            # The API lists the values of a data point in the order of the rows
+            if x == 2.0:
+                values.reverse()
+            for x_or_y in values:
+                x_or_y.save()
+            value = values[-1]
+        models.Error.objects.create(created_by=user, numerical_value=value, value=0.5)
+        models.UpperBound.objects.create(
+            created_by=user, numerical_value=value, value=1.75
+        )
+        # Two primary values in one data point cannot be packed
+        other = dataset.subsets.create(created_by=user, crystal_system=3)
+        datapoint = other.datapoints.create(created_by=user)
+        for y in (4.0, 5.0):
+            datapoint.values.create(created_by=user, value=y)
+        urls = [
+            reverse("materials:get_subset_values", kwargs={"pk": subset.pk}),
+            reverse("materials:data_for_chart", kwargs={"pk": dataset.pk}),
+            reverse("materials:dataset-detail", kwargs={"pk": dataset.pk}),
+        ]
+        from_rows = [self.client.get(url).json() for url in urls]
+        self.assertEqual(from_rows[0][2], {"y": ">1.5 (±0.5)...1.75", "x": "3.0"})
+        datapoints = from_rows[2]["subsets"][0]["datapoints"]
+        self.assertEqual(
+            [[x["qualifier"] for x in datapoint["values"]] for datapoint in datapoints],
+            [
+                ["secondary", "primary"],
+                ["primary", "secondary"],
+                ["secondary", "primary"],
+            ],
+        )
+        self.assertEqual(packing.pack_subsets([subset.pk, other.pk]), 1)
+        self.assertEqual(models.PackedSubset.objects.get().subset, subset)
+        cache.clear()
+        self.assertEqual([self.client.get(url).json() for url in urls], from_rows)
+        # The ETag and the packed values
+        with self.assertNumQueries(2):
+            self.client.get(urls[0], HTTP_IF_NONE_MATCH="")
+        value.value = 1.25
+        value.save()
+        self.assertFalse(models.PackedSubset.objects.exists())
+        self.assertEqual(packing.pack_subsets([subset.pk]), 1)
+        models.Datapoint.objects.filter(pk=datapoint.pk).delete()
+        subset.datapoints.last().delete()
+        self.assertFalse(models.PackedSubset.objects.exists())
+        # Values are deleted in bulk when their subset is deleted
+        for model in models.NumericalValue, models.Error, models.UpperBound:
+            self.assertFalse(post_delete.has_listeners(model))
+
+    def test_rebuild_derived(self):
+        user = User.objects.get(pk=1)
+        subset = models.Dataset.objects.get(pk=1).subsets.create(
+            created_by=user, crystal_system=3
+        )
+        value = subset.datapoints.create(created_by=user).values.create(
+            created_by=user, value=2.5
+        )
+        out = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command("rebuild_derived", "--verify", stdout=out)
+        self.assertIn(f"Subset {subset.pk} is not packed", out.getvalue())
+        self.assertIn("Value ranges of data set 1 differ", out.getvalue())
+        # Fixtures are loaded without signals
+        self.assertIn("Author index of data set 1 differs", out.getvalue())
+        lone = models.System.objects.create(compound_name="PbI2", formula="PbI2")
+        models.SystemSearchDocument.objects.filter(system=lone).update(tags="x")
+        with self.assertRaises(CommandError):
+            call_command("rebuild_derived", "--verify", "--kind=documents", stdout=out)
+        self.assertIn(f"Search document of system {lone.pk} differs", out.getvalue())
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, "checkpoint.json")
+            call_command(
+                "rebuild_derived",
+                "--chunk-size=1",
+                f"--checkpoint={checkpoint}",
+                stdout=io.StringIO(),
+            )
+            self.assertFalse(os.path.exists(checkpoint))
+            call_command("rebuild_derived", "--verify", stdout=io.StringIO())
+            self.assertEqual(lone.search_document.tags, "")
+            value.value = 3.5
+            value.save()
+            # An interrupted check of the first two data sets continues
+            # with the third one
+            state = {"kinds": ["packed"], "verify": True, "done": [1, 2]}
+            with open(checkpoint, "w") as f:
+                json.dump({**state, "mismatches": []}, f)
+            args = ["rebuild_derived", "--verify", "--kind=packed"]
+            with self.assertRaises(CommandError):
+                call_command(*args, "--kind=ranges", f"--checkpoint={checkpoint}")
+            call_command(*args, f"--checkpoint={checkpoint}", stdout=io.StringIO())
+            with self.assertRaises(CommandError):
+                call_command(*args, stdout=io.StringIO())
+            # Differences found before the interruption are still reported
+            with open(checkpoint, "w") as f:
+                json.dump({**state, "mismatches": ["Subset 1 is not packed"]}, f)
+            out = io.StringIO()
+            with self.assertRaisesRegex(CommandError, "Found 1 differences"):
+                call_command(*args, f"--checkpoint={checkpoint}", stdout=out)
+            self.assertIn("Subset 1 is not packed", out.getvalue())
+            # Those found after it are recorded for the next run
+            with open(checkpoint, "w") as f:
+                json.dump({**state, "done": [], "mismatches": []}, f)
+            with mock.patch.object(derived, "process", side_effect=[["x"], KeyError]):
+                with self.assertRaises(KeyError):
+                    call_command(
+                        *args,
+                        "--chunk-size=1",
+                        f"--checkpoint={checkpoint}",
+                        stdout=io.StringIO(),
+                    )
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f)["mismatches"], ["x"])
+
+    def test_packed_file(self):
+        user = User.objects.get(pk=1)
+        dataset = models.Dataset.objects.get(pk=1)
+        dataset.secondary_property = models.Property.objects.get(pk=2)
+        dataset.save()
+        subset = dataset.subsets.create(created_by=user, crystal_system=3)
+        for x in range(10):
+            datapoint = subset.datapoints.create(created_by=user)
+            datapoint.values.create(
+                created_by=user, value=x, qualifier=models.NumericalValue.SECONDARY
+            )
+            value = datapoint.values.create(created_by=user, value=x / 2)
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        with self.settings(MEDIA_ROOT=media_root.name), mock.patch.object(
+            packing, "FILE_THRESHOLD", 5
+        ):
+            packing.pack_subsets([subset.pk])
+            packed = models.PackedSubset.objects.get()
+            self.assertIsNone(packed.data)
+            path = packed.data_file.path
+            self.assertEqual(
+                path,
+                os.path.join(
+                    media_root.name,
+                    "data_files",
+                    "dataset_1",
+                    f"subset_{subset.pk}.npy",
+                ),
+            )
+            arrays = packing.packed_arrays([subset.pk])[subset.pk]
+            self.assertIsInstance(arrays["y"], numpy.memmap)
+            self.assertEqual(arrays["x"].tolist(), list(range(10)))
+            url = reverse("materials:get_subset_values", kwargs={"pk": subset.pk})
+            self.assertEqual(
+                self.client.get(url, {"offset": 8}).json(),
+                [{"y": "4.0", "x": "8.0"}, {"y": "4.5", "x": "9.0"}],
+            )
+            response = self.client.get(
+                url, {"offset": 2, "limit": 3}, HTTP_ACCEPT="application/octet-stream"
+            )
+            binary = utils.unpack_arrays(response.content)
+            self.assertEqual(binary["num-datapoints"], 10)
+            self.assertEqual(binary["arrays"]["y"].tolist(), [1.0, 1.5, 2.0])
+            self.assertEqual(self.client.get(url, {"limit": -1}).status_code, 400)
+            url = reverse("materials:data_for_chart", kwargs={"pk": 1})
+            data = self.client.get(url, {"x_min": 3, "x_max": 4.5}).json()
+            self.assertEqual(
+                data["data"][-1]["values"],
+                [{"y": 1.5, "x": 3.0}, {"y": 2.0, "x": 4.0}],
+            )
+            # The file is kept until the deletion of the row is committed
+            with mock.patch("django.db.transaction.on_commit") as on_commit:
+                value.save()
+            self.assertFalse(models.PackedSubset.objects.exists())
+            self.assertTrue(os.path.exists(path))
+            for call in on_commit.call_args_list:
+                call.args[0]()
+            self.assertFalse(os.path.exists(path))
+
+    def test_dataset_summary(self):
+        user = User.objects.get(pk=1)
+        dataset = models.Dataset.objects.get(pk=1)
+        subset = dataset.subsets.create(created_by=user, crystal_system=3)
+        for value in (1.0, 2.0):
+            subset.datapoints.create(created_by=user).values.create(
+                created_by=user, value=value
+            )
+        subset.fixed_values.create(
+            created_by=user,
+            physical_property=models.Property.objects.create(
+                created_by=user, name="temperature"
+            ),
+            unit=models.Unit.objects.get(pk=4),
+            value=300,
+        )
+        dataset.files.create(
+            created_by=user, dataset_file="uploads/dataset_1/geometry.in"
+        )
+        dataset.verified_by.add(user)
+        expected = {
+            "num_subsets": dataset.subsets.count(),
+            "num_datapoints": dataset.count_datapoints(),
+            "geometry_file": "/media/uploads/dataset_1/geometry.in",
+            "fixed_temperatures": "(T = 300.0 K)",
+            "verified": True,
+            "representative_value": None,
+        }
+        summary = models.DatasetSummary.objects.get(dataset=dataset)
+        self.assertEqual(summary.num_datapoints, expected["num_datapoints"])
+        self.assertEqual(summary.fixed_temperatures, "(T = 300.0 K)")
+        url = reverse("materials:dataset-summary")
+        with self.assertNumQueries(3):
+            results = self.client.get(url, {"system": 1}).json()["results"]
+        self.assertEqual({k: results[-1][k] for k in expected}, expected)
+        # Without summaries the same facts are computed from the rows
+        subset.datapoints.first().delete()
+        expected["num_datapoints"] -= 1
+        self.assertFalse(models.DatasetSummary.objects.filter(dataset=1).exists())
+        results = self.client.get(url, {"system": 1}).json()["results"]
+        self.assertEqual({k: results[-1][k] for k in expected}, expected)
+        derived.update_summaries([1])
+        with self.assertNumQueries(3):
+            results = self.client.get(url, {"system": 1}).json()["results"]
+        self.assertEqual({k: results[-1][k] for k in expected}, expected)
+        # Deleting a subset does not touch each data point on its own
+        queries = []
+        for size in (1, 20):
+            subset = dataset.subsets.create(created_by=user, crystal_system=3)
+            models.Datapoint.objects.bulk_create(
+                [models.Datapoint(created_by=user, subset=subset)] * size
+            )
+            with CaptureQueriesContext(connection) as context:
+                with mock.patch("django.db.transaction.on_commit") as on_commit:
+                    subset.delete()
+            queries.append((len(context), on_commit.call_count))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_atomic_coordinates(self):
+        user = User.objects.get(pk=1)
+        subset = models.Dataset.objects.get(pk=3).subsets.create(
+            created_by=user, crystal_system=3
+        )
+        for symbol, value in zip("abcαβγ", (8.9, 8.9, 12.6, 90, 90, 90)):
+            datapoint = subset.datapoints.create(created_by=user)
+            datapoint.symbols.create(created_by=user, value=symbol)
+            datapoint.values.create(created_by=user, value=value)
+        for vector in ((8.9, 0, 0), (0, 8.9, 0), (0, 0, 12.6)):
+            datapoint = subset.datapoints.create(created_by=user)
+            for counter, value in enumerate(vector):
+                datapoint.values.create(created_by=user, value=value, counter=counter)
+        atoms = [("Pb", 0.0, 0.0, 0.5 * i) for i in range(3)]
+        atoms.append(("I", 0.25, 0.5, 0.75))
+        for element, *coordinates in atoms:
+            datapoint = subset.datapoints.create(created_by=user)
+            datapoint.symbols.create(created_by=user, value="atom_frac")
+            datapoint.symbols.create(created_by=user, value=element, counter=1)
+            for counter, value in enumerate(coordinates):
+                value = datapoint.values.create(
+                    created_by=user, value=value, counter=counter
+                )
+        models.Error.objects.create(created_by=user, numerical_value=value, value=0.01)
+        url = reverse("materials:get_atomic_coordinates", kwargs={"pk": subset.pk})
+        # The data set for the ETag, visibility of the subset, and the two
+        # queries for the coordinates
+        with self.assertNumQueries(4):
+            data = self.client.get(url).json()
+        self.assertEqual(
+            data,
+            {
+                "vectors": [
+                    ["8.9", "0", "0"],
+                    ["0", "8.9", "0"],
+                    ["0", "0", "12.6"],
+                ],
+                "num-atoms": 4,
+                "coord-type": "atom_frac",
+                "coordinates": [
+                    ["Pb", "0", "0", "0"],
+                    ["Pb", "0", "0", "0.5"],
+                    ["Pb", "0", "0", "1"],
+                    ["I", "0.25", "0.5", "0.75 (±0.01)"],
+                ],
+            },
+        )
+        data = self.client.get(url, {"offset": 1, "limit": 2}).json()
+        self.assertEqual(data["vectors"][2], ["0", "0", "12.6"])
+        self.assertEqual(data["num-atoms"], 4)
+        self.assertEqual(
+            data["coordinates"], [["Pb", "0", "0", "0.5"], ["Pb", "0", "0", "1"]]
+        )
+        data = self.client.get(url, {"offset": 10}).json()
+        self.assertEqual(data["coordinates"], [])
+        self.assertEqual(len(data["vectors"]), 3)
+        response = self.client.get(url, {"limit": -1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_progressive_system_page(self):
+        url = reverse("materials:system", kwargs={"pk": 1})
+        card_url = reverse("materials:dataset_card", kwargs={"pk": 1})
+        response = self.client.get(url)
+        self.assertNotContains(response, "lazy-card")
+        self.assertContains(response, "Data set ID: 1")
+        response = self.client.get(url, {"progressive": 1})
+        self.assertContains(response, "Band gap")
+        self.assertContains(response, f'data-url="{card_url}"')
+        self.assertNotContains(response, "Data set ID: 1")
+        response = self.client.get(card_url)
+        self.assertContains(response, "Data set ID: 1")
+        self.assertContains(response, f'name="return-path" value="{url}"')
+        dataset = models.Dataset.objects.get(pk=1)
+        dataset.visible = False
+        dataset.save()
+        self.assertEqual(self.client.get(card_url).status_code, 404)
+
+    def test_conditional_get(self):
+        user = User.objects.get(pk=1)
+        subset = models.Dataset.objects.get(pk=1).subsets.create(
+            created_by=user, crystal_system=3
+        )
+        subset.datapoints.create(created_by=user).values.create(
+            created_by=user, value=1.0
+        )
+        urls = [
+            reverse("materials:system", kwargs={"pk": 1}),
+            reverse("materials:dataset", kwargs={"pk": 1}),
+            reverse("materials:get_subset_values", kwargs={"pk": subset.pk}),
+            "/materials/datasets/",
+            "/materials/datasets/1/",
+        ]
+        etags = {}
+        for url in urls:
+            response = self.client.get(url)
+            etags[url] = response["ETag"]
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 304)
+        dataset = models.Dataset.objects.get(pk=1)
+        dataset.caption = "New caption"
+        dataset.save()
+        for url in urls:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response["ETag"], etags[url])
+        # Users see different pages
+        url = urls[0]
+        etag = self.client.get(url)["ETag"]
+        self.client.force_login(user)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class SearchTestCase(TestCase):
+    fixtures = [
+        "users.json",
+        "properties.json",
+        "units.json",
+        "references.json",
+        "authors.json",
+        "systems.json",
+        "datasets.json",
+    ]
+
+    def setUp(self):
+        # Cached search indexes may hold rows from rolled back tests
+        cache.clear()
+
+    def search(self, search_term, search_text="", **kwargs):
+        return self.client.post(
+            reverse("materials:search"),
+            {"search_term": search_term, "search_text": search_text, **kwargs},
+        )
+
+    def test_composition_query(self):
+        # The fixture system (CH3NH3)PbCl3 has C1 H6 N1 Pb1 Cl3
+        def find(text):
+            query = search.CompositionQuery.parse(text)
+            return search.composition_index.find(query)
+
+        self.assertEqual(find("Pb Cl"), {1})
+        self.assertEqual(find("Pb, Cl -Sn Cl/Pb>=3"), {1})
+        self.assertEqual(find("Cl/Pb>3"), set())
+        self.assertEqual(find("Pb I"), set())
+        self.assertEqual(find("Pb !N"), set())
+        self.assertEqual(find("H=6"), {1})
+        with self.assertRaises(ValueError):
+            search.CompositionQuery.parse("-Sn")
+        with self.assertRaises(ValueError):
+            search.CompositionQuery.parse("Pb/I")
+        # The index must notice new systems
+        models.System.objects.create(compound_name="MAPbI3", formula="CH3NH3PbI3")
+        self.assertEqual(len(find("Pb")), 2)
+        response = self.search("composition", "Pb I/Pb>=3")
+        self.assertContains(response, "MAPbI3")
+        self.assertNotContains(response, "MAPbCl3")
+        self.assertContains(self.search("composition", "Pb/"), "Could not understand")
+
+    def test_fulltext_search(self):
+        system = models.System.objects.get(pk=1)
+        tag = models.Tag.objects.create(tag="photovoltaic")
+        system.tags.add(tag)
+
+        def find(text):
+            return list(search.find_systems_by_text(text, models.System.objects.all()))
+
+        self.assertEqual(find("photovolt"), [system])
+        # Parts of a formula starting at an element are indexed
+        self.assertEqual(find("NH3)Pb"), [system])
+        with mock.patch.object(search, "fulltext_search", return_value=[]):
+            # Other fragments fall back to substring matching
+            self.assertEqual(find("bCl"), [system])
+        self.assertEqual(find("nonexistent"), [])
+        # An element in the middle of a formula is found by the index
+        lead_iodide = models.System.objects.create(compound_name="PbI2", formula="PbI2")
+        cesium = models.System.objects.create(compound_name="CsPbI3", formula="CsPbI3")
+        self.assertEqual(set(find("Pb")), {system, lead_iodide, cesium})
+        self.assertEqual(find("PbI3"), [cesium])
+        response = self.search("formula", "Pb")
+        self.assertContains(response, "CsPbI3")
+        with mock.patch.object(search, "FULLTEXT_LIMIT", 2):
+            self.assertEqual(len(find("Pb")), 2)
+        tag.delete()
+        self.assertEqual(find("photovolt"), [])
+        response = self.client.get("/materials/systems/", {"q": system.formula})
+        self.assertEqual(response.json()["count"], 1)
+
+    def test_property_range(self):
+        dataset = models.Dataset.objects.get(pk=1)
+        user = dataset.created_by
+        subset = dataset.subsets.create(created_by=user, crystal_system=0)
+        for value in (1.5, 3.0):
+            datapoint = subset.datapoints.create(created_by=user)
+            datapoint.values.create(created_by=user, value=value)
+        search.update_value_ranges(dataset)
+        value_range = dataset.value_ranges.get()
+        self.assertEqual((value_range.minimum, value_range.maximum), (1.5, 3.0))
+        self.assertEqual(value_range.representative, 2.25)
+        band_gap = [dataset.primary_property]
+
+        def find(*args, **kwargs):
+            return search.find_datasets_in_range(band_gap, *args, **kwargs)
+
+        self.assertEqual(find(1.0, 2.0), {1})
+        self.assertEqual(find(maximum=1.0), set())
+        self.assertEqual(find(minimum=2.9), {1})
+        # The range straddles the search window but no value is inside
+        self.assertEqual(find(2.0, 2.5), set())
+        self.assertEqual(find(1.0, 2.0, is_experimental=False), set())
+        # Editing the data set updates the index
+        dataset.is_experimental = False
+        dataset.save()
+        self.assertEqual(find(1.0, 2.0, is_experimental=False), {1})
+        # Other edits leave it alone
+        with mock.patch.object(search, "update_value_ranges") as update:
+            dataset.caption = "Band gap"
+            dataset.save()
+            dataset.save(update_fields=["visible"])
+        update.assert_not_called()
+        # Edits and deletions of values rebuild the index on commit
+        with mock.patch("django.db.transaction.on_commit", lambda f: f()):
+            value = models.NumericalValue.objects.get(value=3.0)
+            value.value = 2.5
+            value.save()
+            self.assertEqual(dataset.value_ranges.get().maximum, 2.5)
+            value.delete()
+            self.assertEqual(dataset.value_ranges.get().count, 1)
+            subset.datapoints.create(created_by=user).values.create(
+                created_by=user, value=4.0
+            )
+            models.NumericalValue.objects.filter(value=1.5).delete()
+            self.assertEqual(dataset.value_ranges.get().minimum, 4.0)
+            subset.datapoints.all().delete()
+            self.assertFalse(dataset.value_ranges.exists())
+            other = dataset.subsets.create(created_by=user, crystal_system=0)
+            other.datapoints.create(created_by=user).values.create(
+                created_by=user, value=5.0
+            )
+            self.assertEqual(dataset.value_ranges.get().maximum, 5.0)
+            other.delete()
+            self.assertFalse(dataset.value_ranges.exists())
+        subset.datapoints.create(created_by=user).values.create(
+            created_by=user, value=3.0
+        )
+        search.update_value_ranges(dataset)
+        response = self.search(
+            "property_range", physical_property=1, minimum=2.9, is_experimental="any"
+        )
+        self.assertContains(response, "MAPbCl3")
+        response = self.search("property_range", physical_property=1)
+        self.assertContains(response, "Specify a minimum value")
+
+    def test_invalid_search_term(self):
+        response = self.search("password", "x")
+        self.assertContains(response, "Invalid search term.", status_code=400)
+        response = self.client.get(
+            reverse("materials:search"), {"search_term": "x", "format": "json"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Invalid search term."})
+
+    def test_autocomplete(self):
+        def suggest(q):
+            response = self.client.get(reverse("materials:autocomplete"), {"q": q})
+            return [(x["type"], x["pk"]) for x in response.json()["results"]]
+
+        response = self.client.get(reverse("materials:search"))
+        self.assertNotContains(response, "MAPbCl3")
+        self.assertEqual(suggest("mapb"), [("system", 1)])
+        self.assertEqual(suggest("LAST"), [("author", 1)])
+        self.assertEqual(set(suggest("1")), {("system", 1), ("dataset", 1)})
+        self.assertEqual(suggest("gap"), [("property", 1)])
+        self.assertEqual(suggest(""), [])
+        # Incremental updates of the current process
+        index = search.autocomplete_index
+        index.update(add=[index.author_entry(1, "First", "Renamed")])
+        self.assertEqual(suggest("last"), [])
+        self.assertEqual(suggest("renamed"), [("author", 1)])
+        index.update(discard=[("author", 1)])
+        self.assertEqual(suggest("renamed"), [])
+
+    def test_facets(self):
+        models.System.objects.create(
+            compound_name="MASnI3",
+            formula="CH3NH3SnI3",
+            organic="CH3NH3",
+            inorganic="SnI3",
+        )
+        response = self.search("organic", "CH3NH3")
+        facets = {name: values for name, _, values in response.context["facets"]}
+        self.assertEqual(facets["organic"], [("CH3NH3", "CH3NH3", 2, False)])
+        self.assertEqual(
+            sorted(facets["inorganic"]),
+            [("PbCl3", "PbCl3", 1, False), ("SnI3", "SnI3", 1, False)],
+        )
+        self.assertEqual(
+            facets["primary_property"], [("band gap", "band gap", 1, False)]
+        )
+        # Unpublished data sets do not show up in the facets
+        dataset = models.Dataset.objects.get(pk=1)
+        dataset.pk = None
+        dataset.visible = False
+        dataset.primary_property = models.Property.objects.create(
+            name="exciton energy", created_by=dataset.created_by
+        )
+        dataset.save()
+        response = self.search("organic", "CH3NH3")
+        facets = {name: values for name, _, values in response.context["facets"]}
+        self.assertEqual(
+            facets["primary_property"], [("band gap", "band gap", 1, False)]
+        )
+        self.assertEqual(len(facets["organic"]), 1)
+        token = response.context["results_token"]
+        # Narrowing uses the stored results, so new systems do not show up
+        models.System.objects.create(
+            compound_name="MAGeI3", formula="CH3NH3GeI3", organic="CH3NH3"
+        )
+        response = self.client.post(
+            reverse("materials:search"),
+            {"results": token, "facet": ["inorganic:SnI3", "inorganic:GeI3"]},
+        )
+        systems = response.context["systems"]
+        self.assertEqual([x.compound_name for x in systems], ["MASnI3"])
+        response = self.client.post(
+            reverse("materials:search"), {"results": "expired", "facet": []}
+        )
+        self.assertContains(response, "expired")
+
+    def test_result_pages(self):
+        for i in range(4):
+            models.System.objects.create(
+                compound_name=f"MA{i}",
+                formula=f"CH3NH3Sn{i}",
+                organic="CH3NH3",
+                inorganic=f"Sn{i}",
+            )
+        response = self.client.get(
+            reverse("materials:search"),
+            {
+                "search_term": "organic",
+                "search_text": "CH3NH3",
+                "page_size": 2,
+                "format": "json",
+            },
+        )
+        data = response.json()
+        self.assertEqual(data["count"], 5)
+        pks = [x["pk"] for x in data["results"]]
+        while data["next"]:
+            data = self.client.get(
+                reverse("materials:search"),
+                {
+                    "results": data["results_token"],
+                    "cursor": data["next"],
+                    "page_size": 2,
+                    "format": "json",
+                },
+            ).json()
+            pks += [x["pk"] for x in data["results"]]
+        self.assertEqual(len(pks), 5)
+        self.assertEqual(len(set(pks)), 5)
+        previous = self.client.get(
+            reverse("materials:search"),
+            {
+                "results": data["results_token"],
+                "cursor": data["previous"],
+                "page_size": 2,
+                "format": "json",
+            },
+        ).json()
+        self.assertEqual([x["pk"] for x in previous["results"]], pks[2:4])
+        # The next page starts after the cursor's result even if that
+        # result is filtered out
+        first = self.client.get(
+            reverse("materials:search"),
+            {
+                "search_term": "organic",
+                "search_text": "CH3NH3",
+                "page_size": 2,
+                "format": "json",
+            },
+        ).json()
+        self.assertIsNone(first["previous"])
+        inorganic = models.System.objects.get(pk=pks[1]).inorganic
+        response = self.client.get(
+            reverse("materials:search"),
+            {
+                "results": first["results_token"],
+                "cursor": first["next"],
+                "facet": [
+                    f"inorganic:{x.inorganic}"
+                    for x in models.System.objects.filter(pk__in=pks)
+                    if x.inorganic != inorganic
+                ],
+                "format": "json",
+            },
+        )
+        self.assertNotIn(pks[1], [x["pk"] for x in response.json()["results"]])
+        self.assertIn(pks[2], [x["pk"] for x in response.json()["results"]])
+        response = self.client.get(
+            reverse("materials:search"),
+            {"results": data["results_token"], "cursor": "xyz", "format": "json"},
+        )
+        self.assertEqual(response.status_code, 400)
+        # Exports stream all results in the same order
+        query = {"results": data["results_token"], "facet": "organic:CH3NH3"}
+        response = self.client.get(reverse("materials:search_export"), query)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(",")[0], "pk")
+        self.assertEqual([int(x.split(",")[0]) for x in lines[1:]], pks)
+        response = self.client.get(
+            reverse("materials:search_export"), {**query, "format": "ndjson"}
+        )
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(x)["pk"] for x in lines], pks)
+        response = self.client.get(
+            reverse("materials:search_export"), {"results": "expired"}
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_result_cache(self):
+        def stats():
+            return self.client.get(reverse("materials:search_cache_stats")).json()
+
+        user = User.objects.get(pk=1)
+        user.is_staff = True
+        user.save()
+        self.client.force_login(user)
+        response = self.search("organic", "CH3NH3")
+        self.assertEqual(len(response.context["systems"]), 1)
+        self.assertEqual((stats()["hits"], stats()["misses"]), (0, 1))
+        # Whitespace and case do not matter for the same search
+        response = self.search("organic", " ch3nh3 ")
+        self.assertEqual(len(response.context["systems"]), 1)
+        self.assertEqual((stats()["hits"], stats()["misses"]), (1, 1))
+        # Any change to the catalog invalidates cached results
+        models.System.objects.create(
+            compound_name="MASnI3", formula="CH3NH3SnI3", organic="CH3NH3"
+        )
+        response = self.search("organic", "CH3NH3")
+        self.assertEqual(len(response.context["systems"]), 2)
+        self.assertEqual((stats()["hits"], stats()["misses"]), (1, 2))
+        self.assertEqual(stats()["hit_ratio"], 1 / 3)
+        self.client.logout()
+        response = self.client.get(reverse("materials:search_cache_stats"))
+        self.assertEqual(response.status_code, 302)
+
+    def test_shared_cache_check(self):
+        def warnings(backend, debug=False):
+            caches = {"default": {"BACKEND": backend}}
+            with self.settings(CACHES=caches, DEBUG=debug):
+                return [x.id for x in check_shared_cache(None)]
+
+        self.assertEqual(warnings(settings.CACHES["default"]["BACKEND"]), [])
+        locmem = "django.core.cache.backends.locmem.LocMemCache"
+        self.assertEqual(warnings(locmem), ["materials.W001"])
+        self.assertEqual(warnings(locmem, debug=True), [])
+
+    def test_similar_systems(self):
+        # Fixture system: (CH3NH3)PbCl3
+        bromide = models.System.objects.create(
+            compound_name="MAPbBr3", formula="(CH3NH3)PbBr3"
+        )
+        iodide = models.System.objects.create(
+            compound_name="MAPbI3", formula="(CH3NH3)PbI3"
+        )
+        chloride = models.System.objects.create(
+            compound_name="MAPbCl2", formula="(CH3NH3)PbCl2"
+        )
+        index = search.similarity_index
+        similar = index.similar(1, limit=2)
+        self.assertEqual(similar[0][0], chloride.pk)
+        self.assertEqual(len(similar), 2)
+        self.assertEqual(index.similar(1, metric="l1")[0][0], chloride.pk)
+        # The halides differ by the same amount in the L1 metric
+        distances = dict(index.similar(1, metric="l1"))
+        self.assertAlmostEqual(distances[bromide.pk], distances[iodide.pk])
+        # Incremental update: MAPbBr3 becomes pure Pb
+        models.Stoichiometry_Elements.objects.filter(
+            system_stoichiometry__system=bromide
+        ).exclude(element="Pb").delete()
+        index.update([bromide.pk])
+        distances = dict(index.similar(bromide.pk, metric="l1"))
+        self.assertAlmostEqual(distances[1], 2 - 2 / 12)
+        response = self.client.get("/materials/systems/1/similar/", {"limit": 1})
+        self.assertEqual(response.json()[0]["compound_name"], "MAPbCl2")
+        response = self.client.get("/materials/systems/1/similar/", {"metric": "x"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse("materials:system", kwargs={"pk": 1}))
+        self.assertContains(response, "Similar Systems")
+
+    def test_trigram_search(self):
+        pea = models.System.objects.create(
+            compound_name="(PEA)2PbI4",
+            formula="(C6H5C2H4NH3)2PbI4",
+            group="phenethylammonium lead iodide, PEPI",
+        )
+        self.assertEqual(search.trigrams("ab"), {"  a", " ab", "ab "})
+        index = search.trigram_index
+        self.assertEqual(index.find("phenethylamonium")[0][0], pea.pk)
+        self.assertEqual(index.find("qqqqq"), [])
+        response = self.search("formula", "phenethylamonium")
+        self.assertContains(response, "(PEA)2PbI4")
+        # Incremental updates
+        index.update({pea.pk: index.names("PEA2PbI4", "", "")})
+        self.assertEqual(index.find("phenethylamonium"), [])
+        # After an update the next process rebuilds the index and stores it
+        with self.assertNumQueries(1):
+            self.assertEqual(search.TrigramIndex().find("PEA2PbI4")[0][0], pea.pk)
+        # for the others to load
+        with self.assertNumQueries(0):
+            self.assertEqual(search.TrigramIndex().find("PEA2PbI4")[0][0], pea.pk)
+        index.update({pea.pk: None})
+        self.assertEqual(index.find("PEA2PbI4"), [])
+
+    def test_author_search(self):
+        name = search.normalize_name("Lüdenscheidt-O'Neill")
+        self.assertEqual(name, "ludenscheidt o neill")
+        self.assertEqual(search.name_initials("Jean-Marc"), "jm")
+        # Fixtures are loaded without signals
+        search.update_author_index(datasets=models.Dataset.objects.all())
+        reference = models.Reference.objects.get(pk=1)
+        author = models.Author.objects.create(
+            first_name="Jean-Marc", last_name="Müller"
+        )
+        author.references.add(reference)
+
+        def find(text):
+            return set(search.find_by_author(text).values_list("system", flat=True))
+
+        self.assertEqual(find("Last"), {1})
+        self.assertEqual(find("muller"), {1})
+        self.assertEqual(find("Muller, J."), {1})
+        self.assertEqual(find("MÜLLER, J. M."), {1})
+        self.assertEqual(find("Müller, K."), set())
+        self.assertEqual(find("Mu, J."), set())
+        self.assertContains(self.search("author", "Müller, J.-M."), "MAPbCl3")
+        # Moving the data set to another system updates the index
+        system = models.System.objects.create(compound_name="MAPbI3", formula="")
+        dataset = models.Dataset.objects.get(pk=1)
+        dataset.system = system
+        dataset.save()
+        self.assertEqual(find("Muller"), {system.pk})
+
+    def test_lattice_search(self):
+        dataset = models.Dataset.objects.get(pk=1)
+        dataset.pk = None
+        dataset.primary_property_id = 3  # Atomic structure
+        dataset.save()
+        user = dataset.created_by
+        subset = dataset.subsets.create(created_by=user, crystal_system=3)
+        for symbol, value in zip("abcαβγ", (8.9, 8.9, 12.6, 90, 90, 90)):
+            datapoint = subset.datapoints.create(created_by=user)
+            datapoint.symbols.create(created_by=user, value=symbol)
+            datapoint.values.create(created_by=user, value=value)
+        datapoint = subset.datapoints.create(created_by=user)
+        datapoint.symbols.create(created_by=user, value="atom")
+        datapoint.symbols.create(created_by=user, value="C", counter=1)
+        for i, value in enumerate((0.1, 0.2, 0.3)):
+            datapoint.values.create(created_by=user, value=value, counter=i)
+        call_command("rebuild_derived", "--kind=lattices", stdout=io.StringIO())
+        lattice = models.SubsetLattice.objects.get()
+        self.assertEqual((lattice.a, lattice.c, lattice.gamma), (8.9, 12.6, 90))
+        self.assertAlmostEqual(lattice.volume, 8.9 * 8.9 * 12.6)
+
+        def find(text):
+            query = search.LatticeQuery.parse(text)
+            return query.filter(models.SubsetLattice.objects.all()).count()
+
+        self.assertEqual(find("a=8.95±0.1 c = 12.4 +- 2%"), 1)
+        self.assertEqual(find("a=8.7~0.1"), 0)
+        self.assertEqual(find("γ=90.5"), 1)
+        self.assertEqual(find("V=1000±10%"), 1)
+        with self.assertRaises(ValueError):
+            search.LatticeQuery.parse("d=1")
+        self.assertContains(self.search("lattice", "a=8.9"), "MAPbCl3")
+        response = self.client.get("/materials/lattices/", {"c": "12.6~0.1"})
+        self.assertEqual(response.json()["results"][0]["system"], 1)
+        response = self.client.get("/materials/lattices/", {"c": "x"})
+        self.assertEqual(response.status_code, 400)
+
 
 class SeleniumTestCase(LiveServerTestCase):
     fixtures = [
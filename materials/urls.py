@@ -11,12 +11,17 @@ router.register('systems', views.SystemViewSet)
 router.register('properties', views.PropertyViewSet)
 router.register('units', views.UnitViewSet)
 router.register('datasets', views.DatasetViewSet)
+router.register('lattices', views.LatticeViewSet)
 
 app_name = 'materials'
 urlpatterns = [
     path('system/<int:pk>/', views.SystemView.as_view(), name='system-view'),
     path('', include(router.urls)),
     path('search', views.SearchFormView.as_view(), name='search'),
+    path('search/export', views.search_export, name='search_export'),
+    path('search/cache-stats', views.search_cache_stats,
+         name='search_cache_stats'),
+    path('autocomplete', views.autocomplete, name='autocomplete'),
     path('<int:pk>', views.SystemView.as_view(), name='system'),
     path('dataset/<int:pk>', views.DatasetView.as_view(), name='dataset'),
     path('dataset/compare/<int:pk1>&<int:pk2>', views.CompareView.as_view(), name='dataset'),
@@ -28,6 +33,7 @@ urlpatterns = [
          views.delete_dataset, name='delete_dataset'),
     path('dataset/<int:pk>/verify/<str:view_name>',
          views.verify_dataset, name='verify_dataset'),
+    path('dataset/<int:pk>/card', views.dataset_card, name='dataset_card'),
     path('add-data', views.AddDataView.as_view(), name='add_data'),
     path('import-data', views.ImportDataView.as_view(), name='import_data'),
     path('submit-data', views.submit_data, name='submit_data'),
@@ -42,6 +48,8 @@ urlpatterns = [
          name='get_atomic_coordinates'),
     path('get-subset-values/<int:pk>', views.get_subset_values,
          name='get_subset_values'),
+    path('get-subset-values', views.get_subsets_values,
+         name='get_subsets_values'),
     path('get-jsmol-input/<int:pk>', views.get_jsmol_input,
          name='get_jsmol_input'),
     path('report-issue', views.report_issue, name='report_issue'),
@@ -1,11 +1,17 @@
 # This file is covered by the BSD license. See LICENSE in the root directory.
 """Helper functions for this project."""
 import io
+import json
 import matplotlib
 import numpy
 import re
+import struct
+import time
 
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import transaction
+from django.db.models import Q
 
 from . import models
 from .models import System_Stoichiometry, Stoichiometry_Elements
@@ -15,6 +21,157 @@ matplotlib.use("Agg")  # noqa
 from matplotlib import pyplot
 
 
+def get_version(key):
+    """Return the current value of a version counter.
+
+    Version counters are kept in the default cache so that all worker
+    processes see the same value. A missing counter is initialized
+    from the clock so that clearing the cache never brings back a
+    version number that was already handed out.
+
+    """
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns()
+        cache.add(key, version, None)
+        version = cache.get(key, version)
+    return version
+
+
+def bump_version(key):
+    """Increment a version counter, invalidating whatever depends on it.
+
+    The counter is incremented right away, so that the current
+    transaction sees its own changes, and again once the transaction
+    commits, so that other processes cannot keep what they read in
+    the meantime.
+
+    """
+
+    increment_version(key)
+    transaction.on_commit(lambda: increment_version(key))
+
+
+def get_versions(keys):
+    """Return the current values of several version counters at once."""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            versions[key] = get_version(key)
+    return versions
+
+
+# Incremented along with the version of any data set
+DATASETS_VERSION_KEY = "materials-datasets-version"
+
+
+def dataset_version_key(pk):
+    """Return the key of the version counter of a data set's card."""
+    return f"materials-dataset-version-{pk}"
+
+
+def bump_dataset_versions(pks):
+    """Make the cached cards of the given data sets render again."""
+    pks = set(pks)
+    for pk in pks:
+        bump_version(dataset_version_key(pk))
+    if pks:
+        bump_version(DATASETS_VERSION_KEY)
+
+
+def increment_version(key):
+    """Increment a version counter and return the new value."""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = time.time_ns()
+        cache.set(key, version, None)
+        return version
+
+
+def downsample_lttb(x, y, max_points):
+    """Return the indices of the points of a curve to keep when plotting.
+
+    Uses the Largest-Triangle-Three-Buckets algorithm, which preserves
+    the visual shape of the curve. The first and last points are always
+    kept. The others are split into max_points - 2 buckets and from each
+    bucket the point is kept that forms the largest triangle with the
+    previously kept point and the average of the next bucket.
+
+    """
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return numpy.arange(n)
+    edges = numpy.linspace(1, n - 1, max_points - 1).astype(int)
+    edges = numpy.append(edges, n)
+    indices = numpy.empty(max_points, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i_bucket in range(max_points - 2):
+        start, end = edges[i_bucket], edges[i_bucket + 1]
+        next_start, next_end = end, edges[i_bucket + 2]
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        areas = numpy.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(numpy.argmax(areas))
+        indices[i_bucket + 1] = a
+    return indices
+
+
+def pack_arrays(header, arrays):
+    """Serialize a JSON header and NumPy arrays into one buffer.
+
+    This is the binary representation of large numerical payloads (see
+    views.accepts_binary and binary_arrays.js). The buffer holds the
+    length of the header as a little-endian uint32, the header as UTF-8
+    JSON, and the arrays as little-endian data, one after another. The
+    header and each array are padded to multiples of 8 bytes so that
+    the arrays can be viewed as typed arrays in JavaScript without
+    copying. The name, dtype, and length of each array are added to the
+    header under "arrays".
+
+    """
+    header = dict(header, arrays=[])
+    chunks = []
+    for name, array in arrays.items():
+        array = numpy.asarray(array)
+        array = array.astype(array.dtype.newbyteorder("<"), copy=False)
+        header["arrays"].append(
+            {"name": name, "dtype": array.dtype.name, "length": len(array)}
+        )
+        data = array.tobytes()
+        chunks.append(data + bytes(-len(data) % 8))
+    header = json.dumps(header).encode()
+    header += b" " * (-(4 + len(header)) % 8)
+    return struct.pack("<I", len(header)) + header + b"".join(chunks)
+
+
+def unpack_arrays(content):
+    """Inverse of pack_arrays.
+
+    The arrays are read-only views of content, which can be bytes or a
+    memoryview such as the value of a BinaryField.
+
+    """
+    content = memoryview(content)
+    (header_length,) = struct.unpack_from("<I", content)
+    header = json.loads(bytes(content[4 : 4 + header_length]))
+    arrays = {}
+    offset = 4 + header_length
+    for array in header["arrays"]:
+        dtype = numpy.dtype(array["dtype"]).newbyteorder("<")
+        arrays[array["name"]] = numpy.frombuffer(
+            content, dtype, array["length"], offset
+        )
+        offset += -(-array["length"] * dtype.itemsize // 8) * 8
+    header["arrays"] = arrays
+    return header
+
+
 def parse_formula(formula):
     # Remove chiral prefixes (S-, R-, (R/S)-)
     formula = re.sub(r"(\(R/S\)-|\b[SR]-)", "", formula)
@@ -97,61 +254,57 @@ def parse_formula(formula):
     return stack[0]
 
 
-def atomic_coordinates_as_json(pk):
+def atomic_coordinates_as_json(pk, offset=0, limit=None):
     """Get atomic coordinates from the atomic structure list.
 
     The first six entries of the "atomic structure" property are the
-    lattice constants and angles. These need to be skipped when
-    fetching for the lattice vectors and atomic coordinates.
+    lattice constants and angles, which have one symbol each. They are
+    followed by the lattice vectors, which have no symbols, and the
+    atoms, which have the coordinate type and the element as symbols.
+    Atoms are returned starting from offset, at most limit of them.
 
     """
-    subset = models.Subset.objects.get(pk=pk)
-    vectors = (
-        models.NumericalValue.objects.filter(datapoint__subset=subset)
-        .filter(datapoint__symbols__isnull=True)
-        .order_by("datapoint_id", "counter")
-    )
-    data = {
-        "vectors": [
-            [x.formatted(".10g") for x in vectors[:3]],
-            [x.formatted(".10g") for x in vectors[3:6]],
-            [x.formatted(".10g") for x in vectors[6:9]],
-        ]
-    }
-    # Here counter=1 filters out the first six entries
-    symbols = (
-        models.Symbol.objects.filter(datapoint__subset=subset)
-        .filter(counter=1)
-        .order_by("datapoint_id")
-        .values_list("value", flat=True)
-    )
-    coords = (
-        models.NumericalValue.objects.filter(datapoint__subset=subset)
-        .filter(datapoint__symbols__counter=1)
-        .select_related("error")
-        .order_by("counter", "datapoint_id")
-    )
-    tmp = (
-        models.Symbol.objects.filter(datapoint__subset=subset)
-        .annotate(num=models.models.Count("datapoint__symbols"))
-        .filter(num=2)
-        .first()
-    )
-    if tmp:
-        data["coord-type"] = tmp.value
-    data["coordinates"] = []
-    N = int(len(coords) / 3)
-    for symbol, coord_x, coord_y, coord_z in zip(
-        symbols, coords[:N], coords[N : 2 * N], coords[2 * N : 3 * N]
+    # One row per symbol of each data point, or a row of Nones for data
+    # points without symbols
+    symbols = {}
+    for datapoint, value in (
+        models.Datapoint.objects.filter(subset=pk)
+        .order_by("pk", "symbols__counter")
+        .values_list("pk", "symbols__value")
     ):
-        data["coordinates"].append(
-            (
-                symbol,
-                coord_x.formatted(".9g"),
-                coord_y.formatted(".9g"),
-                coord_z.formatted(".9g"),
-            )
+        symbols.setdefault(datapoint, []).append(value)
+    vector_datapoints = {x for x, values in symbols.items() if values == [None]}
+    atoms = [(x, values) for x, values in symbols.items() if len(values) == 2]
+    page = atoms[offset : None if limit is None else offset + limit]
+    query = Q(datapoint__in=vector_datapoints)
+    if page:
+        query |= Q(
+            datapoint__subset=pk,
+            datapoint__gte=page[0][0],
+            datapoint__lte=page[-1][0],
         )
+    on_page = {x for x, _ in page}
+    vectors, coordinates = [], []
+    for value in (
+        models.NumericalValue.objects.filter(query)
+        .select_related("error", "upperbound")
+        .order_by("datapoint", "counter")
+    ):
+        if value.datapoint_id in on_page:
+            coordinates.append(value.formatted(".9g"))
+        elif value.datapoint_id in vector_datapoints:
+            vectors.append(value.formatted(".10g"))
+    # Three values per lattice vector and atom
+    data = {
+        "vectors": numpy.array(vectors, dtype=object).reshape(-1, 3).tolist(),
+        "num-atoms": len(atoms),
+    }
+    if atoms:
+        data["coord-type"] = atoms[0][1][0]
+    coordinates = numpy.array(coordinates, dtype=object).reshape(-1, 3)
+    data["coordinates"] = [
+        (element, *xyz) for (_, (_, element)), xyz in zip(page, coordinates.tolist())
+    ]
     return data
 
 
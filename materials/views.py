@@ -1,39 +1,82 @@
 # This file is covered by the BSD license. See LICENSE in the root directory.
+import csv
+import hashlib
 import io
+import itertools
 import json
 import logging
-import operator
 import os
 import re
 import zipfile
-from functools import reduce
 
 import django_filters.rest_framework
+import numpy
 import requests
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile, UploadedFile
 from django.core.mail import send_mail
 from django.db import transaction
-from django.db.models import BooleanField, Case, Q, Value, When
+from django.db.models import BooleanField, Case, Prefetch, Q, Value, When
 from django.db.models.fields import TextField
-from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseForbidden,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404, redirect, render, reverse
+from django.template.loader import render_to_string
+from django.utils.cache import (
+    get_conditional_response,
+    patch_vary_headers,
+    quote_etag,
+)
+from django.utils.decorators import method_decorator
 from django.utils.html import escape
+from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
 from django.views import generic
+from django.views.decorators.http import condition
 from rest_framework import filters, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 
-from . import forms, models, permissions, qresp, serializers, utils
+from . import (
+    derived,
+    forms,
+    models,
+    packing,
+    permissions,
+    qresp,
+    search,
+    serializers,
+    utils,
+)
 from .models import System_Stoichiometry, Stoichiometry_Elements
 
 logger = logging.getLogger(__name__)
 
+DATASET_CARD_KEY = "materials-dataset-card"
+DATASET_CARD_TIMEOUT = 7 * 24 * 3600
+BINARY_CONTENT_TYPE = "application/octet-stream"
+# Card options of the representative data sets on the system page
+SYSTEM_CARD_OPTIONS = {
+    "with_reference": True,
+    "with_all_entries": True,
+    "skip_atomic_structure": True,
+    "with_jsmol": True,
+}
+# Above this many representative data sets the system page only shows
+# the card headers and fetches each card body when scrolled into view
+PROGRESSIVE_SYSTEM_PAGE_THRESHOLD = 8
+
 
 def dataset_author_check(view):
     """Test whether the logged on user is the creator of the data set."""
@@ -84,6 +127,102 @@ class StaffStatusMixin(LoginRequiredMixin):
         return super().dispatch(request, *args, **kwargs)
 
 
+def attach_dataset_cards(datasets, **options):
+    """Set card_body of each data set to its rendered card contents.
+
+    Rendered cards are cached by data set, version, and options, so
+    only data sets that changed since they were last shown are fetched
+    in full and rendered. The options are passed on to
+    dataset_card_body.html.
+
+    """
+    datasets = list(datasets)
+    versions = utils.get_versions([utils.dataset_version_key(x.pk) for x in datasets])
+    suffix = "-".join(f"{name}={int(value)}" for name, value in sorted(options.items()))
+    keys = {}
+    for dataset in datasets:
+        version = versions[utils.dataset_version_key(dataset.pk)]
+        keys[dataset.pk] = f"{DATASET_CARD_KEY}-{dataset.pk}-{version}-{suffix}"
+    cards = cache.get_many(keys.values())
+    missing = [pk for pk, key in keys.items() if key not in cards]
+    if missing:
+        rendered = {}
+        fetched = models.Dataset.objects.filter(pk__in=missing).for_display()
+        if options.get("with_all_entries"):
+            models.count_all_entries(fetched)
+        for dataset in fetched:
+            rendered[keys[dataset.pk]] = render_to_string(
+                "materials/dataset_card_body.html", {"dataset": dataset, **options}
+            )
+        cache.set_many(rendered, DATASET_CARD_TIMEOUT)
+        cards.update(rendered)
+    for dataset in datasets:
+        dataset.card_body = mark_safe(cards.get(keys[dataset.pk], ""))
+
+
+def content_etag(user, *versions):
+    """Return an ETag for content rendered for user from the given versions.
+
+    The versions are the values of the version counters (see
+    utils.get_version) of everything that the content depends on.
+
+    """
+    parts = (user.pk, user.is_staff, user.is_superuser, *versions)
+    return hashlib.sha1(":".join(map(str, parts)).encode()).hexdigest()
+
+
+def datasets_etag(request, *pks):
+    """ETag of a page or payload that shows the given data sets."""
+    keys = [search.CATALOG_VERSION_KEY] + [utils.dataset_version_key(x) for x in pks]
+    versions = utils.get_versions(keys)
+    return content_etag(request.user, *(versions[key] for key in keys))
+
+
+def system_etag(request, pk):
+    """ETag of the system page, which shows all data sets of the system."""
+    pks = models.Dataset.objects.filter(system=pk).order_by("pk")
+    return datasets_etag(request, *pks.values_list("pk", flat=True))
+
+
+def dataset_etag(request, pk):
+    return datasets_etag(request, pk)
+
+
+def compare_etag(request, pk1, pk2):
+    return datasets_etag(request, pk1, pk2)
+
+
+def subset_etag(request, pk):
+    dataset_pk = (
+        models.Subset.objects.filter(pk=pk).values_list("dataset", flat=True).first()
+    )
+    if dataset_pk is None:
+        return None
+    return datasets_etag(request, dataset_pk)
+
+
+def accepts_binary(request):
+    """Whether the client asked for the binary representation of arrays.
+
+    See utils.pack_arrays.
+
+    """
+    return BINARY_CONTENT_TYPE in request.META.get("HTTP_ACCEPT", "")
+
+
+def negotiated_etag(etag_func):
+    """Tell the JSON and binary representations apart in ETags."""
+
+    def wrap(request, *args, **kwargs):
+        etag = etag_func(request, *args, **kwargs)
+        if etag is not None and accepts_binary(request):
+            etag += "-binary"
+        return etag
+
+    return wrap
+
+
+@method_decorator(condition(etag_func=system_etag), name="get")
 class SystemView(generic.ListView):
     template_name = "materials/system.html"
     context_object_name = "dataset_list"
@@ -91,6 +230,8 @@ class SystemView(generic.ListView):
     def get_queryset(self, **kwargs):
         return (
             models.Dataset.objects.filter(system__pk=self.kwargs["pk"])
+            .visible_to(self.request.user)
+            .for_listing()
             .annotate(
                 is_atomic_structure=Case(
                     When(primary_property__name="atomic structure", then=Value(True)),
@@ -103,22 +244,36 @@ class SystemView(generic.ListView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        system = models.System.objects.get(pk=self.kwargs["pk"])
+        system = get_object_or_404(
+            models.System.objects.prefetch_related(
+                "system_stoichiometry_set__stoichiometry_elements_set",
+                "derived_to_from",
+            ),
+            pk=self.kwargs["pk"],
+        )
 
         # Fetch the elements and stoichiometry
-        stoichiometry_entries = models.System_Stoichiometry.objects.filter(
-            system=system
-        )
         element_dict = {}
-        for entry in stoichiometry_entries:
-            elements = models.Stoichiometry_Elements.objects.filter(
-                system_stoichiometry=entry
-            )
+        for entry in system.system_stoichiometry_set.all():
             element_dict[entry.stoichiometry] = {
-                element.element: element.float_value for element in elements
+                element.element: element.float_value
+                for element in entry.stoichiometry_elements_set.all()
             }
 
+        context["system"] = system
         context["element_dict"] = element_dict
+        representative = [x for x in context["dataset_list"] if x.representative]
+        progressive = self.request.GET.get("progressive")
+        if progressive is None:
+            progressive = len(representative) > PROGRESSIVE_SYSTEM_PAGE_THRESHOLD
+        else:
+            progressive = progressive == "1"
+        context["progressive"] = progressive
+        if not progressive:
+            attach_dataset_cards(representative, **SYSTEM_CARD_OPTIONS)
+        similar = search.similarity_index.similar(system.pk, limit=5)
+        systems = models.System.objects.in_bulk([pk for pk, _ in similar])
+        context["similar_systems"] = [systems[pk] for pk, _ in similar if pk in systems]
         return context
 
 
@@ -128,15 +283,31 @@ class PropertyAllEntriesView(generic.ListView):
     template_name = "materials/property_all_entries.html"
 
     def get_queryset(self, **kwargs):
-        return models.Dataset.objects.filter(
-            system__pk=self.kwargs["system_pk"]
-        ).filter(primary_property__pk=self.kwargs["prop_pk"])
+        # Evaluated here so that the template can show the first data
+        # set in the header without fetching it separately
+        datasets = list(
+            models.Dataset.objects.filter(system__pk=self.kwargs["system_pk"])
+            .filter(primary_property__pk=self.kwargs["prop_pk"])
+            .visible_to(self.request.user)
+            .for_listing()
+        )
+        attach_dataset_cards(datasets, with_reference=True, with_jsmol=True)
+        return datasets
 
 
 class ReferenceDetailView(generic.DetailView):
-    model = models.Reference
+    queryset = models.Reference.objects.prefetch_related("authors")
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["datasets"] = self.object.datasets.visible_to(
+            self.request.user
+        ).for_listing()
+        attach_dataset_cards(context["datasets"], with_all_entries=True)
+        return context
 
 
+@method_decorator(condition(etag_func=dataset_etag), name="get")
 class DatasetView(generic.ListView):
     """Display information about a single data set.
 
@@ -149,9 +320,16 @@ class DatasetView(generic.ListView):
     template_name = "materials/property_all_entries.html"
 
     def get_queryset(self, **kwargs):
-        return models.Dataset.objects.filter(pk=self.kwargs["pk"])
+        datasets = list(
+            models.Dataset.objects.filter(pk=self.kwargs["pk"])
+            .visible_to(self.request.user)
+            .for_listing()
+        )
+        attach_dataset_cards(datasets, with_reference=True, with_jsmol=True)
+        return datasets
 
 
+@method_decorator(condition(etag_func=compare_etag), name="get")
 class CompareView(generic.ListView):
     """Display information about two datasets side by side.
 
@@ -164,9 +342,15 @@ class CompareView(generic.ListView):
     template_name = "materials/property_all_entries.html"
 
     def get_queryset(self, **kwargs):
-        return models.Dataset.objects.filter(
-            pk__in=[self.kwargs["pk1"], self.kwargs["pk2"]]
+        datasets = list(
+            models.Dataset.objects.filter(
+                pk__in=[self.kwargs["pk1"], self.kwargs["pk2"]]
+            )
+            .visible_to(self.request.user)
+            .for_listing()
         )
+        attach_dataset_cards(datasets, with_reference=True, with_jsmol=True)
+        return datasets
 
 
 class LinkedDataView(generic.ListView):
@@ -175,161 +359,268 @@ class LinkedDataView(generic.ListView):
     template_name = "materials/linked_data.html"
 
     def get_queryset(self, **kwargs):
-        dataset = models.Dataset.objects.get(pk=self.kwargs["pk"])
-        datasets = dataset.linked_to.all()
-        return list(datasets) + [dataset]
+        pk = self.kwargs["pk"]
+        # The data set itself comes after the ones linked to it
+        return (
+            models.Dataset.objects.filter(
+                Q(pk=pk)
+                | Q(pk__in=models.Dataset.objects.filter(linked_to=pk).values("pk"))
+            )
+            .visible_to(self.request.user)
+            .for_listing()
+            .order_by(Case(When(pk=pk, then=Value(1)), default=Value(0)), "pk")
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        attach_dataset_cards(
+            context["object_list"], with_reference=True, with_all_entries=True
+        )
+        return context
 
 
 class SearchFormView(generic.TemplateView):
     """Search for system page"""
 
     template_name = "materials/search.html"
+    # Properties covered by the band gap search
+    band_gap_properties = [
+        "band gap (fundamental)",
+        "band gap (optical, diffuse reflectance)",
+        "band gap (optical, transmission)",
+        "band gap (optical, theory)",
+        "band gap (optical, integrating sphere)",
+        "band gap (band edge difference)",
+        "Band gap (fundamental, calculated) (DFT-HSE06+SOC)",
+    ]
     search_terms = [
         ["formula", "Formula"],
+        ["composition", "Composition"],
         ["physical_property", "Physical property"],
         ["organic", "Organic Component"],
         ["inorganic", "Inorganic Component"],
         ["author", "Author"],
         ["band_gap", "Band gap"],
+        ["property_range", "Property range"],
+        ["lattice", "Lattice parameters"],
         ["doi", "DOI"],
     ]
 
     def get(self, request):
-        material_ids = models.System.objects.all().values_list("pk", "compound_name")
-        dataset_ids = (
-            models.Dataset.objects.all()
-            .values_list("pk", "system__compound_name", "primary_property__name")
-            .order_by("pk")
-        )
+        if "search_term" in request.GET or "results" in request.GET:
+            return self.results(request, request.GET)
         return render(
             request,
             self.template_name,
             {
                 "search_terms": self.search_terms,
-                "material_ids": material_ids,
-                "dataset_ids": dataset_ids,
+                "range_properties": models.Property.objects.filter(
+                    pk__in=models.DatasetValueRange.objects.values(
+                        "physical_property"
+                    )
+                ).order_by("name"),
             },
         )
 
     def post(self, request):
-        template_name = "materials/search_results.html"
-        form = forms.SearchForm(request.POST)
-        physical_properties = []
-        systems_info = []
-        systems = []
-
-        # Define the allowed band gap property names
-        allowed_band_gap_properties = [
-            "band gap (fundamental)",
-            "band gap (optical, diffuse reflectance)",
-            "band gap (optical, transmission)",
-            "band gap (optical, theory)",
-            "band gap (optical, integrating sphere)",
-            "band gap (band edge difference)",
-            "Band gap (fundamental, calculated) (DFT-HSE06+SOC)",
-        ]
+        return self.results(request, request.POST)
 
-        # Initialize search_term early with a default value
-        search_term = "formula"
+    def find(self, search_term, data):
+        """Return the systems found by a search and an error message.
 
-        if form.is_valid():
-            search_text = form.cleaned_data.get("search_text", "")
-            band_gap_min = form.cleaned_data.get("band_gap_min")
-            band_gap_max = form.cleaned_data.get("band_gap_max")
-            search_term = request.POST.get("search_term", "formula")
-            is_experimental = form.cleaned_data.get(
-                "is_experimental"
-            )  # Get the is_experimental value
-
-            # If DOI search
-            if search_term == "doi":
-                systems = models.System.objects.filter(
-                    dataset__reference__doi_isbn__icontains=search_text
-                ).distinct()
+        data are the cleaned data of the search form.
 
-            # If band gap search
-            elif (
-                search_term == "band_gap"
-                and band_gap_min is not None
-                and band_gap_max is not None
-            ):
-                band_gap_filters = Q(value__gte=band_gap_min) & Q(
-                    value__lte=band_gap_max
+        """
+        search_text = data.get("search_text", "")
+        systems = models.System.objects.none()
+        error = ""
+
+        # If DOI search
+        if search_term == "doi":
+            systems = models.System.objects.filter(
+                dataset__reference__doi_isbn__icontains=search_text
+            ).distinct()
+
+        # If band gap or any other property range search
+        elif search_term in ("band_gap", "property_range"):
+            minimum = data["minimum"]
+            maximum = data["maximum"]
+            is_experimental = {"True": True, "False": False}.get(
+                data["is_experimental"]
+            )
+            if search_term == "band_gap":
+                properties = models.Property.objects.filter(
+                    name__in=self.band_gap_properties
                 )
-
-                # Handle "Experimental/Theoretical/Any" filter
-                if is_experimental == "True":
-                    band_gap_filters &= Q(
-                        datapoint__subset__dataset__is_experimental=True
-                    )
-                elif is_experimental == "False":
-                    band_gap_filters &= Q(
-                        datapoint__subset__dataset__is_experimental=False
+            elif data["physical_property"]:
+                properties = [data["physical_property"]]
+            else:
+                properties = None
+                error = "Select a physical property."
+            if minimum is None and maximum is None:
+                error = "Specify a minimum value, a maximum value, or both."
+            elif properties is not None:
+                systems = models.System.objects.filter(
+                    dataset__pk__in=search.find_datasets_in_range(
+                        properties, minimum, maximum, is_experimental
                     )
-                # For "Any", we skip the filter (no need to add a condition here)
-
-                # Filter numerical values based on the band gap range and allowed properties
-                numerical_values = models.NumericalValue.objects.filter(
-                    band_gap_filters,
-                    datapoint__subset__dataset__primary_property__name__in=allowed_band_gap_properties,
                 ).distinct()
 
-                # Now, get the related datapoints from these numerical values
-                datapoints_with_band_gap = models.Datapoint.objects.filter(
-                    values__in=numerical_values
-                )
-
-                # Then, filter datasets based on these datapoints
-                datasets_with_band_gap = models.Dataset.objects.filter(
-                    subsets__datapoints__in=datapoints_with_band_gap
-                ).distinct()
-
-                # Finally, filter systems based on those datasets
+        elif search_term == "formula":
+            systems = search.find_systems_by_text(
+                search_text, models.System.objects.order_by("formula")
+            )
+        elif search_term == "composition":
+            try:
+                query = search.CompositionQuery.parse(search_text)
+            except ValueError as e:
+                error = str(e)
+            else:
                 systems = models.System.objects.filter(
-                    dataset__in=datasets_with_band_gap
-                ).distinct()
-
-            elif search_term == "formula":
+                    pk__in=search.composition_index.find(query)
+                ).order_by("formula")
+        elif search_term == "lattice":
+            try:
+                query = search.LatticeQuery.parse(search_text)
+            except ValueError as e:
+                error = str(e)
+            else:
+                lattices = query.filter(models.SubsetLattice.objects.all())
                 systems = models.System.objects.filter(
-                    Q(formula__icontains=search_text)
-                    | Q(group__icontains=search_text)
-                    | Q(iupac__icontains=search_text)
-                    | Q(compound_name__icontains=search_text)
+                    pk__in=lattices.values("dataset__system")
                 ).order_by("formula")
-            elif search_term == "physical_property":
+        elif search_term == "physical_property":
+            systems = models.System.objects.filter(
+                dataset__primary_property__name__icontains=search_text
+            )
+        elif search_term == "organic":
+            systems = models.System.objects.filter(
+                organic__icontains=search_text
+            ).order_by("organic")
+        elif search_term == "inorganic":
+            systems = models.System.objects.filter(
+                inorganic__icontains=search_text
+            ).order_by("inorganic")
+        elif search_term == "author":
+            systems = models.System.objects.filter(
+                pk__in=search.find_by_author(search_text).values("system")
+            )
+        else:
+            raise KeyError("Invalid search term.")
+        return systems, error
+
+    def results(self, request, data):
+        """Return one page of search results.
+
+        Either run a new search or, if data contains the token of
+        earlier results, narrow those down by the selected facets. The
+        page is returned as JSON if format=json is given and as an HTML
+        fragment otherwise.
+
+        """
+        template_name = "materials/search_results.html"
+        form = forms.SearchForm(data)
+        physical_properties = []
+        systems_info = []
+        systems = models.System.objects.none()
+        pks = []
+        error = ""
+        status = 200
+
+        # Initialize search_term early with a default value
+        search_term = "formula"
+
+        # Facets of earlier results are narrowed without searching again
+        results = None
+        if data.get("results"):
+            results = search.FacetedResults.load(data["results"])
+            if results is None:
+                error = "These search results have expired. Please search again."
+        elif data.get("search_term", "formula") not in dict(self.search_terms):
+            error = "Invalid search term."
+            status = 400
+        elif form.is_valid():
+            search_term = data.get("search_term", "formula")
+            if search_term == "physical_property":
                 physical_properties = models.Property.objects.filter(
-                    name__icontains=search_text
+                    name__icontains=form.cleaned_data.get("search_text", "")
                 ).values_list("name", flat=True)
-                systems = models.System.objects.filter(
-                    dataset__primary_property__name__icontains=search_text
+            cache_key = search.result_cache_key(search_term, form.cleaned_data)
+            pks = search.cached_results(cache_key)
+            if pks is None:
+                systems, error = self.find(search_term, form.cleaned_data)
+                if not error:
+                    # Break ties so that the order of results is stable
+                    ordering = [*systems.query.order_by, "pk"]
+                    pks = systems.order_by(*ordering).values_list("pk", flat=True)
+                    pks = list(dict.fromkeys(pks))
+                    search.cache_results(cache_key, pks)
+        facets = []
+        total = 0
+        previous_cursor = next_cursor = None
+        export_query = ""
+        if not error:
+            if results is None:
+                results = search.FacetedResults.build(pks)
+                results.save()
+            facet_values = data.getlist("facet")
+            selected = search.FacetedResults.selected(facet_values)
+            positions = results.narrow_positions(selected)
+            pks = [results.pks[i] for i in positions]
+            facets = results.facets(pks, selected)
+            total = len(pks)
+            try:
+                page_size = int(data.get("page_size", search.SEARCH_PAGE_SIZE))
+            except ValueError:
+                page_size = search.SEARCH_PAGE_SIZE
+            page_size = min(max(page_size, 1), 500)
+            try:
+                page, previous_cursor, next_cursor = search.keyset_page(
+                    pks, positions, data.get("cursor"), page_size
                 )
-            elif search_term == "organic":
-                systems = models.System.objects.filter(
-                    organic__icontains=search_text
-                ).order_by("organic")
-            elif search_term == "inorganic":
-                systems = models.System.objects.filter(
-                    inorganic__icontains=search_text
-                ).order_by("inorganic")
-            elif search_term == "author":
-                keywords = search_text.split()
-                query = reduce(
-                    operator.or_,
-                    (
-                        Q(dataset__reference__authors__last_name__icontains=x)
-                        for x in keywords
+            except ValueError as e:
+                error = str(e)
+                page = []
+            systems = search.in_given_order(models.System.objects.all(), page)
+            export_query = urlencode(
+                [("results", results.token)] + [("facet", x) for x in facet_values]
+            )
+        if data.get("format") == "json":
+            if error:
+                return JsonResponse({"error": error}, status=400)
+            return JsonResponse(
+                {
+                    "count": total,
+                    "previous": previous_cursor,
+                    "next": next_cursor,
+                    "results_token": results.token,
+                    "results": list(
+                        systems.values(
+                            "pk",
+                            "compound_name",
+                            "formula",
+                            "group",
+                            "iupac",
+                            "organic",
+                            "inorganic",
+                        )
                     ),
-                )
-                systems = models.System.objects.filter(query).distinct()
-            else:
-                raise KeyError("Invalid search term.")
+                }
+            )
         args = {
             "systems": systems,
+            "total": total,
+            "previous_cursor": previous_cursor,
+            "next_cursor": next_cursor,
+            "export_query": export_query,
+            "facets": facets,
+            "results_token": results.token if results else "",
             "search_term": search_term,
             "systems_info": systems_info,
             "physical_properties": physical_properties,
+            "error": error,
         }
-        return render(request, template_name, args)
+        return render(request, template_name, args, status=status)
 
 
 class AddDataView(StaffStatusMixin, generic.TemplateView):
@@ -460,7 +751,39 @@ class SmallResultsSetPagination(PageNumberPagination):
     max_page_size = 100000
 
 
-class ReferenceViewSet(viewsets.ModelViewSet):
+class ConditionalGetMixin:
+    """Answer list and detail requests with 304 if nothing has changed.
+
+    The ETag is derived from the version of the catalog and of all data
+    sets, so any change invalidates all responses.
+
+    """
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
+
+    def conditional_response(self, view, request, *args, **kwargs):
+        keys = [search.CATALOG_VERSION_KEY, utils.DATASETS_VERSION_KEY]
+        versions = utils.get_versions(keys)
+        etag = quote_etag(
+            content_etag(
+                request.user,
+                request.accepted_renderer.format,
+                *(versions[key] for key in keys),
+            )
+        )
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                response["ETag"] = etag
+        return response
+
+
+class ReferenceViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = models.Reference.objects.all().order_by("-pk")
     serializer_class = serializers.ReferenceSerializer
     permission_classes = (permissions.IsStaffOrReadOnly,)
@@ -500,14 +823,74 @@ class ReferenceViewSet(viewsets.ModelViewSet):
                 author.references.add(reference)
 
 
-class SystemViewSet(viewsets.ModelViewSet):
+class SystemViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = models.System.objects.all().order_by("-pk")
     serializer_class = serializers.SystemSerializer
     permission_classes = (permissions.IsStaffOrReadOnly,)
     pagination_class = LargeResultsSetPagination
 
+    def get_queryset(self):
+        """Optionally filter by ?q=<text> using the full-text index."""
+        queryset = super().get_queryset()
+        text = self.request.query_params.get("q")
+        if text:
+            queryset = search.find_systems_by_text(text, queryset)
+        return queryset
+
+    @action(detail=True)
+    def similar(self, request, pk):
+        """Systems of the most similar composition.
+
+        Optional parameters are limit (default 10) and metric ("cosine"
+        or "l1").
+
+        """
+        try:
+            limit = min(int(request.query_params.get("limit", 10)), 100)
+        except ValueError:
+            limit = 10
+        metric = request.query_params.get("metric", "cosine")
+        if metric not in search.SimilarityIndex.METRICS:
+            return Response({"detail": f"Unknown metric: {metric}"}, status=400)
+        similar = search.similarity_index.similar(self.get_object().pk, limit, metric)
+        systems = models.System.objects.in_bulk([x for x, _ in similar])
+        return Response(
+            [
+                {
+                    "pk": x,
+                    "compound_name": systems[x].compound_name,
+                    "formula": systems[x].formula,
+                    "distance": distance,
+                }
+                for x, distance in similar
+                if x in systems
+            ]
+        )
+
+
+class LatticeViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
+    """Lattice parameters of atomic structures.
+
+    Filter by tolerances such as ?a=8.9~0.1&c=12.6~2% (see
+    search.LatticeQuery).
+
+    """
+
+    queryset = models.SubsetLattice.objects.select_related("dataset").order_by(
+        "-subset"
+    )
+    serializer_class = serializers.LatticeSerializer
+    pagination_class = LargeResultsSetPagination
+
+    def get_queryset(self):
+        try:
+            query = search.LatticeQuery.from_params(self.request.query_params)
+        except ValueError as e:
+            raise ValidationError(str(e))
+        return query.filter(super().get_queryset())
 
-class PropertyViewSet(viewsets.ModelViewSet):
+
+class PropertyViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = models.Property.objects.all().order_by("-pk")
     serializer_class = serializers.PropertySerializer
     permission_classes = (permissions.IsStaffOrReadOnly,)
@@ -517,7 +900,7 @@ class PropertyViewSet(viewsets.ModelViewSet):
         serializer.save(created_by=self.request.user)
 
 
-class UnitViewSet(viewsets.ModelViewSet):
+class UnitViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = models.Unit.objects.all().order_by("-pk")
     serializer_class = serializers.UnitSerializer
     permission_classes = (permissions.IsStaffOrReadOnly,)
@@ -543,7 +926,7 @@ def dataset_to_zip(request, dataset):
     return in_memory_object
 
 
-class DatasetViewSet(viewsets.ReadOnlyModelViewSet):
+class DatasetViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = models.Dataset.objects.all().order_by("-pk")
     serializer_class = serializers.DatasetSerializer
     filter_backends = [
@@ -560,6 +943,21 @@ class DatasetViewSet(viewsets.ReadOnlyModelViewSet):
     }
     search_fields = filterset_fields
 
+    def get_queryset(self):
+        return self.queryset.visible_to(self.request.user)
+
+    def get_serializer(self, *args, **kwargs):
+        """Read the packed values of all subsets being serialized at once."""
+        if args and self.action in ("list", "retrieve"):
+            datasets = args[0] if kwargs.get("many") else [args[0]]
+            kwargs["context"] = dict(
+                self.get_serializer_context(),
+                packed_values=packing.packed_arrays(
+                    models.Subset.objects.filter(dataset__in=[x.pk for x in datasets])
+                ),
+            )
+        return super().get_serializer(*args, **kwargs)
+
     @action(detail=True)
     def info(self, request, pk):
         dataset = self.get_object()
@@ -568,7 +966,7 @@ class DatasetViewSet(viewsets.ReadOnlyModelViewSet):
 
     @action(detail=False)
     def summary(self, request):
-        filtered_queryset = self.filter_queryset(self.get_queryset())
+        filtered_queryset = self.filter_queryset(self.get_queryset().with_summary())
         page = self.paginate_queryset(filtered_queryset)
         if page is not None:
             serializer = serializers.DatasetSerializerSummary(page, many=True)
@@ -872,16 +1270,16 @@ def submit_data(request):
         stoichiometry_value = form.cleaned_data["stoichiometry"]
         system_stoichiometry = System_Stoichiometry.objects.create(
             system=dataset.system, stoichiometry=stoichiometry_value
-        ).save()
+        )
         elements_info = stoichiometry_value.split(",")
         for element_info in elements_info:
             element, quantity = element_info.split(":")
             Stoichiometry_Elements.objects.create(
                 system_stoichiometry=system_stoichiometry,
-                element=element,
-                string_value=quantity,
+                element=element.strip(),
+                string_value=quantity.strip(),
                 float_value=float(quantity),
-            ).save()
+            )
 
     # For best performance, the main data should be inserted with
     # calls to bulk_create. The following work arrays are are
@@ -1135,6 +1533,11 @@ def submit_data(request):
     )
     add_datapoint_ids(symbols, len(symbols), len(datapoints))
     models.Symbol.objects.bulk_create(symbols)
+    search.update_value_ranges(dataset)
+    packing.pack_subsets(list(dataset.subsets.values_list("pk", flat=True)))
+    derived.update_summaries([dataset.pk])
+    if dataset.primary_property.name == "atomic structure":
+        search.update_lattices(dataset.subsets.all())
     # Linked data sets
     for pk in form.cleaned_data["related_data_sets"].split():
         try:
@@ -1266,8 +1669,102 @@ def autofill_input_data(request):
     return HttpResponse("\n".join(lines))
 
 
+def search_export(request):
+    """Stream all systems of earlier search results as CSV or NDJSON.
+
+    The parameters are the token of the results, any selected facets,
+    and format ("csv" or "ndjson"). Systems are read in chunks so that
+    large result sets are never held in memory at once.
+
+    """
+    results = search.FacetedResults.load(request.GET.get("results", ""))
+    if results is None:
+        raise Http404("These search results have expired. Please search again.")
+    selected = search.FacetedResults.selected(request.GET.getlist("facet"))
+    pks = results.narrow(selected)
+    fields = (
+        "pk",
+        "compound_name",
+        "formula",
+        "group",
+        "iupac",
+        "organic",
+        "inorganic",
+    )
+
+    def rows():
+        for i in range(0, len(pks), 1000):
+            chunk = pks[i : i + 1000]
+            systems = models.System.objects.filter(pk__in=chunk).values_list(*fields)
+            systems = {x[0]: x for x in systems.iterator()}
+            for pk in chunk:
+                if pk in systems:
+                    yield systems[pk]
+
+    if request.GET.get("format") == "ndjson":
+        lines = (json.dumps(dict(zip(fields, row))) + "\n" for row in rows())
+        response = StreamingHttpResponse(lines, content_type="application/x-ndjson")
+        extension = "ndjson"
+    else:
+
+        class Echo:
+            """Pseudo-buffer that returns what csv.writer writes to it."""
+
+            def write(self, value):
+                return value
+
+        writer = csv.writer(Echo())
+        lines = (writer.writerow(row) for row in itertools.chain([fields], rows()))
+        response = StreamingHttpResponse(lines, content_type="text/csv")
+        extension = "csv"
+    response[
+        "Content-Disposition"
+    ] = f'attachment; filename="search_results.{extension}"'
+    return response
+
+
+@staff_status_required
+def search_cache_stats(request):
+    """Return hit and miss counts of the search result cache."""
+    return JsonResponse(search.result_cache_stats())
+
+
+def autocomplete(request):
+    """Return suggestions for the quick search box of the search page."""
+    try:
+        limit = min(int(request.GET.get("limit", 10)), 50)
+    except ValueError:
+        limit = 10
+    suggestions = search.autocomplete_index.suggest(request.GET.get("q", ""), limit)
+    return JsonResponse({"results": suggestions})
+
+
+@condition(etag_func=negotiated_etag(dataset_etag))
 def data_for_chart(request, pk):
-    dataset = models.Dataset.objects.get(pk=pk)
+    """Return the curves of a data set for Chart.js.
+
+    The optional x_min and x_max parameters restrict the curves to a
+    range of x-values. With the optional max_points parameter, curves
+    with more points are downsampled (see utils.downsample_lttb). In the binary
+    representation the values of subset i are the arrays x-i and y-i,
+    which are float64 unless dtype=float32 is given.
+
+    """
+    dataset = get_object_or_404(
+        models.Dataset.objects.visible_to(request.user).select_related(
+            "primary_property", "primary_unit", "secondary_property", "secondary_unit"
+        ),
+        pk=pk,
+    )
+    try:
+        max_points = int(request.GET["max_points"])
+    except (KeyError, ValueError):
+        max_points = None
+    try:
+        x_min = float(request.GET.get("x_min", "-inf"))
+        x_max = float(request.GET.get("x_max", "inf"))
+    except ValueError:
+        x_min, x_max = -numpy.inf, numpy.inf
     if dataset.primary_unit:
         primary_unit_label = dataset.primary_unit.label
     else:
@@ -1290,12 +1787,43 @@ def data_for_chart(request, pk):
             f"{dataset.secondary_property.name} "
             f"({dataset.secondary_property_label})"
         )
-    for subset in dataset.subsets.all():
+    subsets = list(
+        dataset.subsets.order_by("pk")
+        .select_related("packed")
+        .prefetch_related(
+            Prefetch(
+                "fixed_values",
+                queryset=models.NumericalValueFixed.objects.select_related(
+                    "physical_property", "unit"
+                ),
+            )
+        )
+    )
+    packed = packing.read_all_packed(
+        subset.packed for subset in subsets if hasattr(subset, "packed")
+    )
+    # Values of the remaining subsets in one go, as columns of subset,
+    # data point, qualifier, and value
+    values = numpy.array(
+        models.NumericalValue.objects.filter(
+            datapoint__subset__in=[x.pk for x in subsets if x.pk not in packed]
+        )
+        .order_by("datapoint__subset", "datapoint", "qualifier")
+        .values_list("datapoint__subset", "datapoint", "qualifier", "value"),
+        dtype=float,
+    ).reshape(-1, 4)
+    primary = values[values[:, 2] == models.NumericalValue.PRIMARY]
+    secondary = values[values[:, 2] == models.NumericalValue.SECONDARY]
+    # Pair primary (y) and secondary (x) values of the same data point
+    _, i_y, i_x = numpy.intersect1d(primary[:, 1], secondary[:, 1], return_indices=True)
+    subset_pks, y, x = primary[i_y, 0], primary[i_y, 3], secondary[i_x, 3]
+    curves = []
+    for subset in subsets:
         response["data"].append({})
         this_subset = response["data"][-1]
         this_subset["subset-label"] = subset.label
         fixed_values = []
-        for value in models.NumericalValueFixed.objects.filter(subset=subset):
+        for value in subset.fixed_values.all():
             fixed_values.append(
                 f" {value.physical_property} = " f"{value.formatted()} {value.unit}"
             )
@@ -1308,40 +1836,200 @@ def data_for_chart(request, pk):
         this_subset[
             "subset-label"
         ] += f" ({models.Subset.CRYSTAL_SYSTEMS[subset.crystal_system][1]})"
-        values = (
-            models.NumericalValue.objects.filter(datapoint__subset=subset)
-            .order_by("datapoint_id", "qualifier")
-            .values_list("value", flat=True)
+        if subset.pk in packed:
+            # Packed subsets have either no or all x-values
+            arrays = packed[subset.pk]
+            subset_x = arrays.get("x", numpy.empty(0))
+            subset_y = arrays["y"] if "x" in arrays else subset_x
+        else:
+            in_subset = subset_pks == subset.pk
+            subset_x, subset_y = x[in_subset], y[in_subset]
+        if x_min > -numpy.inf or x_max < numpy.inf:
+            in_window = (subset_x >= x_min) & (subset_x <= x_max)
+            subset_x, subset_y = subset_x[in_window], subset_y[in_window]
+        if max_points is not None:
+            kept = utils.downsample_lttb(subset_x, subset_y, max_points)
+            subset_x, subset_y = subset_x[kept], subset_y[kept]
+        curves.append((subset_x, subset_y))
+    if accepts_binary(request):
+        dtype = numpy.float32 if request.GET.get("dtype") == "float32" else float
+        arrays = {}
+        for i_subset, (subset_x, subset_y) in enumerate(curves):
+            arrays[f"x-{i_subset}"] = subset_x.astype(dtype)
+            arrays[f"y-{i_subset}"] = subset_y.astype(dtype)
+        response = HttpResponse(
+            utils.pack_arrays(response, arrays), content_type=BINARY_CONTENT_TYPE
         )
-        this_subset["values"] = []
-        for i in range(0, len(values), 2):
-            this_subset["values"].append({"y": values[i], "x": values[i + 1]})
-    return JsonResponse(response)
+    else:
+        for this_subset, (subset_x, subset_y) in zip(response["data"], curves):
+            this_subset["values"] = [
+                {"y": y_value, "x": x_value}
+                for y_value, x_value in zip(subset_y.tolist(), subset_x.tolist())
+            ]
+        response = JsonResponse(response)
+    patch_vary_headers(response, ["Accept"])
+    return response
+
+
+def subset_arrays(user, subset_pks):
+    """Return the value arrays of the given subsets by subset pk.
 
+    Packed values are used where available and the remaining subsets
+    are read from the rows in one more query (see packing.value_arrays).
+    Subsets without values or of data sets that user may not see are
+    left out.
 
+    """
+    subsets = models.Subset.objects.filter(
+        pk__in=subset_pks, dataset__in=models.Dataset.objects.visible_to(user)
+    )
+    arrays = packing.packed_arrays(subsets)
+    unpacked = [pk for pk in subset_pks if pk not in arrays]
+    if unpacked:
+        values = packing.values_by_subset(subsets.filter(pk__in=unpacked))
+        for subset, subset_values in values.items():
+            arrays[subset] = packing.value_arrays(subset_values)
+    return {pk: arrays[pk] for pk in sorted(arrays) if arrays[pk]}
+
+
+def format_subset_values(arrays):
+    """Return the rows of the table of values of a subset."""
+    axes = packing.format_arrays(arrays)
+    rows = [{"y": value} for value in axes.get("y", [])]
+    for row, value in zip(rows, axes.get("x", [])):
+        row["x"] = value
+    return rows
+
+
+def subset_values_response(request, header, arrays, data):
+    """Return subset values as packed arrays or as JSON."""
+    if accepts_binary(request):
+        value_types = [label for _, label in models.NumericalValue.VALUE_TYPES]
+        response = HttpResponse(
+            utils.pack_arrays(dict(header, **{"value-types": value_types}), arrays),
+            content_type=BINARY_CONTENT_TYPE,
+        )
+    else:
+        response = JsonResponse(data, safe=False)
+    patch_vary_headers(response, ["Accept"])
+    return response
+
+
+def parse_window(request):
+    """Return the offset and limit parameters or None if malformed."""
+    try:
+        offset = int(request.GET.get("offset", 0))
+        limit = request.GET.get("limit")
+        limit = None if limit is None else int(limit)
+        if offset < 0 or limit is not None and limit < 0:
+            raise ValueError
+    except ValueError:
+        return None
+    return offset, limit
+
+
+def window_error():
+    return JsonResponse(
+        {"error": "offset and limit must be non-negative integers"}, status=400
+    )
+
+
+@condition(etag_func=negotiated_etag(subset_etag))
 def get_subset_values(request, pk):
-    """Return the numerical values of a subset as a formatted list."""
-    values = (
-        models.NumericalValue.objects.filter(datapoint__subset__pk=pk)
-        .select_related("error")
-        .select_related("upperbound")
-        .order_by("qualifier", "datapoint__pk")
+    """Return the numerical values of a subset as a formatted list.
+
+    Large subsets can be fetched in pages of data points with the
+    optional offset and limit parameters. Only those data points are
+    read if the subset is packed into a file. See packing.value_arrays
+    for the binary representation, whose header also holds the total
+    number of data points as num-datapoints.
+
+    """
+    window = parse_window(request)
+    if window is None:
+        return window_error()
+    arrays = subset_arrays(request.user, [pk]).get(pk)
+    if not arrays:
+        raise Http404
+    num_datapoints = len(arrays.get("y", ()))
+    offset, limit = window
+    stop = None if limit is None else offset + limit
+    arrays = {name: x[offset:stop] for name, x in arrays.items()}
+    return subset_values_response(
+        request,
+        {"num-datapoints": num_datapoints},
+        arrays,
+        format_subset_values(arrays),
+    )
+
+
+def parse_subset_pks(request):
+    """Return the subsets of ?subsets=<pk>,<pk>,... or None if malformed."""
+    try:
+        return sorted({int(pk) for pk in request.GET["subsets"].split(",")})
+    except (KeyError, ValueError):
+        return None
+
+
+def subsets_etag(request):
+    subset_pks = parse_subset_pks(request)
+    if not subset_pks:
+        return None
+    dataset_pks = (
+        models.Subset.objects.filter(pk__in=subset_pks)
+        .order_by("dataset")
+        .values_list("dataset", flat=True)
+        .distinct()
+    )
+    return datasets_etag(request, *dataset_pks)
+
+
+@condition(etag_func=negotiated_etag(subsets_etag))
+def get_subsets_values(request):
+    """Return the numerical values of several subsets at once.
+
+    The subsets are given as ?subsets=<pk>,<pk>,... The JSON response
+    maps each subset to the same list as get_subset_values. In the
+    binary representation the names of the arrays are prefixed with
+    "<pk>-" and the header lists the subsets found under "subsets".
+    Subsets without values or of data sets that the user may not see
+    are left out.
+
+    """
+    subset_pks = parse_subset_pks(request)
+    if not subset_pks:
+        return JsonResponse({"error": "Expected ?subsets=<pk>,<pk>,..."}, status=400)
+    arrays = subset_arrays(request.user, subset_pks)
+    prefixed = {}
+    for subset, x in arrays.items():
+        prefixed.update({f"{subset}-{name}": array for name, array in x.items()})
+    return subset_values_response(
+        request,
+        {"subsets": list(arrays)},
+        prefixed,
+        {subset: format_subset_values(x) for subset, x in arrays.items()},
     )
-    total_len = len(values)
-    y_len = total_len
-    # With both x- and y-values, the y-values make up half the list.
-    if values.last().qualifier == models.NumericalValue.SECONDARY:
-        y_len = int(y_len / 2)
-    response = []
-    for i in range(y_len):
-        response.append({"y": values[i].formatted()})
-    for i in range(y_len, total_len):
-        response[i - y_len]["x"] = values[i].formatted()
-    return JsonResponse(response, safe=False)
 
 
+@condition(etag_func=subset_etag)
 def get_atomic_coordinates(request, pk):
-    return JsonResponse(utils.atomic_coordinates_as_json(pk))
+    """Return the lattice vectors and atomic coordinates of a subset.
+
+    Large cells can be fetched in pages of atoms with the optional
+    offset and limit parameters. The total number of atoms is returned
+    as num-atoms.
+
+    """
+    get_object_or_404(
+        models.Subset.objects.filter(
+            dataset__in=models.Dataset.objects.visible_to(request.user)
+        ),
+        pk=pk,
+    )
+    window = parse_window(request)
+    if window is None:
+        return window_error()
+    return JsonResponse(utils.atomic_coordinates_as_json(pk, *window))
 
 
 def get_jsmol_input(request, pk):
@@ -1353,9 +2041,9 @@ def get_jsmol_input(request, pk):
     JSmol. If there are no geometry files return an empty response.
 
     """
-    dataset = models.Dataset.objects.get(pk=pk)
-    if not dataset:
-        return HttpResponse()
+    dataset = get_object_or_404(
+        models.Dataset.objects.visible_to(request.user), pk=pk
+    )
     if dataset.input_files.exists():
         filename = os.path.basename(dataset.input_files.first().dataset_file.path)
         return HttpResponse(
@@ -1364,6 +2052,27 @@ def get_jsmol_input(request, pk):
     return HttpResponse()
 
 
+@condition(etag_func=dataset_etag)
+def dataset_card(request, pk):
+    """Return the body of a data set card on the system page.
+
+    Used by the progressive system page, which fetches the card bodies
+    only when they are scrolled into view. The cached part is the same
+    as on the full page, followed by the actions for the current user.
+
+    """
+    dataset = get_object_or_404(
+        models.Dataset.objects.visible_to(request.user).for_listing(), pk=pk
+    )
+    attach_dataset_cards([dataset], **SYSTEM_CARD_OPTIONS)
+    return_path = reverse("materials:system", kwargs={"pk": dataset.system_id})
+    return render(
+        request,
+        "materials/dataset_card.html",
+        {"dataset": dataset, "view_name": "system", "return_path": return_path},
+    )
+
+
 def report_issue(request):
     pk = request.POST["pk"]
     description = request.POST["description"]